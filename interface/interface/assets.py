@@ -0,0 +1,56 @@
+import hashlib
+import os
+import threading
+
+# a year, the longest max-age browsers honour
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+class AssetManifest(object):
+    """
+    Content-hashed names for the files in a static folder, like interface.3f2a9c1b.js for interface.js.
+
+    Since the name changes whenever the content does, browsers can cache a hashed file forever. Hashes are
+    recomputed only when a file's mtime changes.
+    """
+
+    def __init__(self, static_folder, hash_length=8):
+        self.static_folder = static_folder
+        self.hash_length = hash_length
+        self._hashes = {}  # filename -> (mtime, hash)
+        self._lock = threading.Lock()
+
+    def _hash(self, filename):
+        full_path = os.path.join(self.static_folder, filename)
+        mtime = os.stat(full_path).st_mtime_ns
+        with self._lock:
+            cached = self._hashes.get(filename)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+
+        md5 = hashlib.md5()
+        with open(full_path, 'rb') as infile:
+            for chunk in iter(lambda: infile.read(1 << 16), b''):
+                md5.update(chunk)
+        digest = md5.hexdigest()[:self.hash_length]
+
+        with self._lock:
+            self._hashes[filename] = (mtime, digest)
+        return digest
+
+    def hashed_name(self, filename):
+        root, ext = os.path.splitext(filename)
+        return '{:s}.{:s}{:s}'.format(root, self._hash(filename), ext)
+
+    def resolve(self, hashed_name):
+        """
+        :return: the real filename for a hashed name, or None if it doesn't match the file's current content
+        """
+        root, ext = os.path.splitext(hashed_name)
+        root, _, digest = root.rpartition('.')
+        filename = root + ext
+        if not root or not os.path.isfile(os.path.join(self.static_folder, filename)):
+            return None
+        if self._hash(filename) != digest:
+            return None
+        return filename
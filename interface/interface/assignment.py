@@ -0,0 +1,220 @@
+import heapq
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+class SampleAssigner(object):
+    """
+    Hands out the least covered samples first.
+
+    Every sample has a count of its responses plus the assignments handed out for it that haven't been answered yet
+    (leases). The samples sit in a min-heap on that count, so assigning a sample is O(log N) instead of a scan over
+    every sample. Stale heap entries are skipped rather than removed when a count changes (each push bumps the
+    sample's version, and only the entry with the current version is live), and cleared out when they reach the top
+    or pile up. Ties are broken randomly, so samples with the same coverage still come out shuffled.
+
+    A lease that isn't answered within lease_seconds (the labeler closed the page) is given back.
+
+    The samples a labeler has labeled are never handed to them again. Those urls are kept per labeler here, loaded
+    with set_labeled() the first time a labeler asks and added to by record_response(), so a page of samples doesn't
+    read them from the database every time. Assigning walks the heap in order without popping it, so the samples the
+    labeler has labeled that are less covered than the ones handed out cost O(log k) each to step over, for k of them
+    stepped over, and nothing is pushed back for them. Once more than max_skips entries were stepped over, the rest
+    comes from a scan over every sample instead, O(N log n) for n samples, so a labeler who has labeled most of the
+    least covered samples costs no more than the scan the heap replaced.
+
+    The counts live in memory and are loaded from the database on first use, so each server process has its own.
+    Call invalidate() when the samples table changes. A labeler's urls are only reloaded after labeled_seconds, so a
+    response posted to another server process can take that long to be excluded here.
+    """
+
+    def __init__(self, target_responses=None, lease_seconds=3600, seed=None, labeled_seconds=600, max_labelers=4096,
+                 max_skips=1024):
+        """
+        :param target_responses: samples with this many responses are not handed out anymore. None for no limit.
+        :param lease_seconds: how long an assignment counts toward a sample's coverage before it's answered
+        :param seed: seed for breaking ties
+        :param labeled_seconds: how long the urls loaded for a labeler are used before they're loaded again
+        :param max_labelers: number of labelers whose urls are kept, the least recently used are dropped
+        :param max_skips: heap entries stepped over in one assignment before scanning every sample instead
+        """
+        self.target_responses = target_responses
+        self.lease_seconds = lease_seconds
+        self.labeled_seconds = labeled_seconds
+        self.max_labelers = max_labelers
+        self.max_skips = max_skips
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._counts = {}
+        self._versions = {}
+        self._heap = []
+        self._num_under_target = 0
+        self._leases = {}  # (experiment_id, url) -> time it was handed out
+        self._lease_order = deque()  # (time, experiment_id, url), oldest first
+        self._experiment_urls = {}  # experiment_id -> set of urls leased to it
+        self._labeled = OrderedDict()  # labeler_id -> (time loaded, set of urls labeled), least recently used first
+
+    def _under_target(self, count):
+        return self.target_responses is None or count < self.target_responses
+
+    def _push(self, url):
+        version = self._versions[url] + 1
+        self._versions[url] = version
+        heapq.heappush(self._heap, (self._counts[url], self._random.random(), version, url))
+
+    def _rebuild_heap(self):
+        self._versions = dict.fromkeys(self._counts, 0)
+        self._heap = [(count, self._random.random(), 0, url) for url, count in self._counts.items()]
+        heapq.heapify(self._heap)
+
+    def _set_count(self, url, count):
+        if url not in self._counts:
+            return
+        self._num_under_target += int(self._under_target(count)) - int(self._under_target(self._counts[url]))
+        self._counts[url] = count
+        self._push(url)
+
+    def load(self, sample_counts):
+        """
+        :param sample_counts: dict from every sample url to its number of responses
+        """
+        with self._lock:
+            self._counts = dict(sample_counts)
+            self._rebuild_heap()
+            self._num_under_target = sum(1 for count in self._counts.values() if self._under_target(count))
+            self._leases = {}
+            self._lease_order = deque()
+            self._experiment_urls = {}
+            self._loaded = True
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def invalidate(self):
+        """ forces a reload from the database before the next assignment """
+        self._loaded = False
+
+    def needs_labeled(self, labeler_id):
+        """ :return: whether set_labeled() has to be called for this labeler before assigning to it """
+        with self._lock:
+            entry = self._labeled.get(labeler_id)
+            return entry is None or entry[0] < time.time() - self.labeled_seconds
+
+    def set_labeled(self, labeler_id, urls):
+        """
+        :param urls: every url the labeler has labeled, from the database
+        """
+        with self._lock:
+            entry = self._labeled.pop(labeler_id, None)
+            urls = set(urls)
+            if entry is not None:
+                # keep responses recorded while the urls were read, the database may not have had them yet
+                urls |= entry[1]
+            self._labeled[labeler_id] = (time.time(), urls)
+            while len(self._labeled) > self.max_labelers:
+                self._labeled.popitem(last=False)
+
+    def _labeled_urls(self, labeler_id):
+        if labeler_id not in self._labeled:
+            return set()
+        self._labeled.move_to_end(labeler_id)
+        return self._labeled[labeler_id][1]
+
+    def _drop_lease(self, experiment_id, url):
+        del self._leases[(experiment_id, url)]
+        urls = self._experiment_urls[experiment_id]
+        urls.discard(url)
+        if len(urls) == 0:
+            del self._experiment_urls[experiment_id]
+
+    def _expire_leases(self, now):
+        while len(self._lease_order) > 0 and self._lease_order[0][0] < now - self.lease_seconds:
+            stamp, experiment_id, url = self._lease_order.popleft()
+            # skip leases that were answered, or handed out again since
+            if self._leases.get((experiment_id, url)) != stamp:
+                continue
+            self._drop_lease(experiment_id, url)
+            self._set_count(url, self._counts[url] - 1)
+
+    def assign(self, experiment_id, n, labeler_id):
+        """
+        Leases up to n of the least covered samples to an experiment
+        :param experiment_id: the experiment asking. It's never given the same sample twice.
+        :param n: number of samples wanted
+        :param labeler_id: the labeler doing the experiment, it's not given samples it has labeled (see set_labeled())
+        :return: list of urls, fewer than n if there aren't enough samples left under the target
+        """
+        with self._lock:
+            now = time.time()
+            self._expire_leases(now)
+
+            labeled = self._labeled_urls(labeler_id)
+            leased = self._experiment_urls.get(experiment_id, set())
+            taken = []
+            skipped = 0
+            # visit the heap's entries smallest first with a second heap of (entry, index) holding the children of
+            # the entries visited so far. The heap itself isn't touched until the samples taken are pushed again.
+            frontier = [(self._heap[0], 0)] if len(self._heap) > 0 else []
+            while len(frontier) > 0 and len(taken) < n:
+                if skipped > self.max_skips:
+                    # the labeler has labeled most of the least covered samples, so a scan is cheaper than the walk
+                    taken.extend(self._scan(n - len(taken), labeled | leased | set(taken)))
+                    break
+                (count, _, version, url), i = heapq.heappop(frontier)
+                for child in (2 * i + 1, 2 * i + 2):
+                    if child < len(self._heap):
+                        heapq.heappush(frontier, (self._heap[child], child))
+                if self._versions.get(url) != version:
+                    # stale entry, the sample's count changed since it was pushed
+                    skipped += 1
+                    continue
+                if not self._under_target(count):
+                    # everything after this is at the target too
+                    break
+                if url in labeled or url in leased:
+                    skipped += 1
+                    continue
+                taken.append(url)
+
+            for url in taken:
+                self._leases[(experiment_id, url)] = now
+                self._lease_order.append((now, experiment_id, url))
+                self._experiment_urls.setdefault(experiment_id, set()).add(url)
+                self._set_count(url, self._counts[url] + 1)
+
+            # the entries of the samples taken are stale now, drop the ones on top so the next walk doesn't visit them
+            while len(self._heap) > 0 and self._versions.get(self._heap[0][3]) != self._heap[0][2]:
+                heapq.heappop(self._heap)
+
+            # the rest pile up as counts change, so start over once they outnumber the live ones
+            if len(self._heap) > 4 * len(self._counts) + 64:
+                self._rebuild_heap()
+
+            return taken
+
+    def _scan(self, n, exclude):
+        """ the n least covered samples under the target that aren't in exclude, in O(N log n) """
+        candidates = ((count, self._random.random(), url) for url, count in self._counts.items()
+                      if self._under_target(count) and url not in exclude)
+        return [url for _, _, url in heapq.nsmallest(n, candidates)]
+
+    def record_response(self, experiment_id, url, labeler_id=None):
+        """ counts a response, unless it answers a lease which was already counted """
+        with self._lock:
+            if labeler_id in self._labeled:
+                self._labeled[labeler_id][1].add(url)
+            if (experiment_id, url) in self._leases:
+                self._drop_lease(experiment_id, url)
+            elif url in self._counts:
+                self._set_count(url, self._counts[url] + 1)
+
+    def num_available(self, labeler_id):
+        """ number of samples under the target the labeler hasn't labeled """
+        with self._lock:
+            labeled = self._labeled_urls(labeler_id)
+            excluded = sum(1 for url in labeled if url in self._counts and self._under_target(self._counts[url]))
+            return self._num_under_target - excluded
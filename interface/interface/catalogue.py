@@ -0,0 +1,62 @@
+import os
+import threading
+
+
+class SampleCatalogue(object):
+    """
+    The mp3 samples in the subdirectories of samples_root.
+
+    Listing tens of thousands of files on every request is slow, so the listing of each subdirectory is kept along
+    with the directory's mtime, and a subdirectory is only listed again when its mtime changes (a file was added,
+    removed or renamed in it). Checking for changes costs one listing of samples_root and one stat per subdirectory.
+    """
+
+    def __init__(self, samples_root, url_prefix):
+        self.samples_root = samples_root
+        self.url_prefix = url_prefix
+        self._subdirs = {}  # subdir -> (mtime, list of samples)
+        self._samples = []
+        self._lock = threading.Lock()
+
+    def _list_subdir(self, subdir, full_subdir):
+        samples = []
+        for entry in os.scandir(full_subdir):
+            # skip empty strings, non-files, and non mp3s
+            if not entry.name:
+                continue
+            elif not entry.is_file():
+                continue
+            elif not entry.name.endswith("mp3"):
+                continue
+
+            samples.append({
+                'url': os.path.join(self.url_prefix, subdir, entry.name),
+                'name': entry.name
+            })
+        samples.sort(key=lambda sample: sample['url'])
+        return samples
+
+    def samples(self):
+        """ all the samples, sorted by url. The list is shared, so don't modify it. """
+        with self._lock:
+            changed = False
+            subdirs = {}
+            for entry in os.scandir(self.samples_root):
+                if not entry.is_dir():
+                    continue
+
+                mtime = entry.stat().st_mtime_ns
+                cached = self._subdirs.get(entry.name)
+                if cached is not None and cached[0] == mtime:
+                    subdirs[entry.name] = cached
+                else:
+                    subdirs[entry.name] = (mtime, self._list_subdir(entry.name, entry.path))
+                    changed = True
+
+            if changed or subdirs.keys() != self._subdirs.keys():
+                self._subdirs = subdirs
+                self._samples = []
+                for subdir in sorted(subdirs.keys()):
+                    self._samples.extend(subdirs[subdir][1])
+
+            return self._samples
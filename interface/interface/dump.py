@@ -0,0 +1,134 @@
+import json
+import os
+from array import array
+
+import numpy as np
+
+
+class JsonDumpWriter(object):
+    """ the original {"dataset": [...]} format, written one response at a time """
+
+    def __init__(self, outfile):
+        self.outfile = outfile
+        self.first = True
+        self.outfile.write('{"dataset": [\n')
+
+    def write(self, response):
+        if not self.first:
+            self.outfile.write(',\n')
+        self.first = False
+        self.outfile.write(json.dumps(response))
+
+    def close(self):
+        self.outfile.write('\n]}\n')
+        self.outfile.close()
+
+
+class NdjsonDumpWriter(object):
+    """ one json object per line, so dumps can be appended to and read back a line at a time """
+
+    def __init__(self, outfile):
+        self.outfile = outfile
+
+    def write(self, response):
+        self.outfile.write(json.dumps(response))
+        self.outfile.write('\n')
+
+    def close(self):
+        self.outfile.close()
+
+
+class NdjsonAppendWriter(object):
+    """ appends ndjson to filename, which is only opened (and created) once there's a response to write """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.writer = None
+
+    def write(self, response):
+        if self.writer is None:
+            self.writer = NdjsonDumpWriter(open(self.filename, 'a'))
+        self.writer.write(response)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class NpzDumpWriter(object):
+    """
+    Columnar dump for analysis. Each field of the responses is one array, and the markers of all responses are
+    concatenated into marker_timestamps/marker_sizes, with response i's markers at
+    marker_offsets[i]:marker_offsets[i + 1]. The edit history is left out.
+
+    Columns are kept in compact typed buffers and written out by close(), since npz files can't be appended to.
+    """
+
+    def __init__(self, outfile):
+        self.outfile = outfile
+        self.ids = array('q')
+        self.urls = []
+        self.stamps = []
+        self.labeler_ids = []
+        self.experiment_ids = []
+        self.durations = array('d')
+        self.marker_offsets = array('q', [0])
+        self.marker_timestamps = array('d')
+        self.marker_sizes = []
+
+    def write(self, response):
+        self.ids.append(response['id'])
+        self.urls.append(response['url'])
+        self.stamps.append(response['stamp'])
+        self.labeler_ids.append(response['labeler_id'])
+        self.experiment_ids.append(response['experiment_id'])
+        self.durations.append(float(response['data'].get('duration_seconds', -1)))
+        for marker in response['data']['final_response']:
+            self.marker_timestamps.append(float(marker['timestamp']))
+            self.marker_sizes.append(marker.get('size', ''))
+        self.marker_offsets.append(len(self.marker_timestamps))
+
+    def close(self):
+        np.savez_compressed(self.outfile,
+                            id=np.frombuffer(self.ids, dtype=np.int64),
+                            url=np.array(self.urls, dtype=str),
+                            stamp=np.array(self.stamps, dtype=str),
+                            labeler_id=np.array(self.labeler_ids, dtype=str),
+                            experiment_id=np.array(self.experiment_ids, dtype=str),
+                            duration_seconds=np.frombuffer(self.durations, dtype=np.float64),
+                            marker_offsets=np.frombuffer(self.marker_offsets, dtype=np.int64),
+                            marker_timestamps=np.frombuffer(self.marker_timestamps, dtype=np.float64),
+                            marker_sizes=np.array(self.marker_sizes, dtype=str))
+        self.outfile.close()
+
+
+class NullDumpWriter(object):
+    """ for when only the terminal output is wanted """
+
+    def write(self, response):
+        pass
+
+    def close(self):
+        pass
+
+
+def read_checkpoint(checkpoint_filename):
+    """ the last responses.id written by the previous incremental dump """
+    with open(checkpoint_filename, 'r') as infile:
+        return json.load(infile)['last_id']
+
+
+def write_checkpoint(checkpoint_filename, last_id):
+    # write then rename, so a crash never leaves a half written checkpoint
+    tmp_filename = checkpoint_filename + '.tmp'
+    with open(tmp_filename, 'w') as outfile:
+        json.dump({'last_id': last_id}, outfile)
+    os.replace(tmp_filename, checkpoint_filename)
+
+
+# format name -> (writer class, mode to open the output file in)
+DUMP_FORMATS = {
+    'json': (JsonDumpWriter, 'w'),
+    'ndjson': (NdjsonDumpWriter, 'w'),
+    'npz': (NpzDumpWriter, 'wb'),
+}
@@ -0,0 +1,139 @@
+import json
+import queue
+import sqlite3
+import threading
+import time
+
+
+class ResponseWriter(object):
+    """
+    Commits responses to the database on a background thread.
+
+    Request handlers submit rows to a bounded queue and return right away. The writer thread takes whatever has
+    queued up (up to max_batch rows) and commits it in one transaction, so a burst of submissions pays for one fsync
+    instead of one each. When the queue is full, submit() waits up to put_timeout seconds and then raises queue.Full,
+    which the caller should turn into a "try again" response.
+    """
+
+    def __init__(self, pool, write_batch, max_queue=1000, max_batch=100, put_timeout=1.0, max_retries=5,
+                 fallback_file=None):
+        """
+        :param pool: ConnectionPool for the database to write to
+        :param write_batch: function(db, rows) that executes the inserts for a list of rows, without committing
+        :param max_queue: number of rows that can wait to be written before submit() blocks
+        :param max_batch: most rows committed in one transaction
+        :param put_timeout: seconds submit() waits on a full queue before giving up
+        :param max_retries: attempts at writing a batch before it's given up on
+        :param fallback_file: batches that can't be written are appended to this file as json lines, so they can be
+                              recovered by hand. If None, they are printed.
+        """
+        self.pool = pool
+        self.write_batch = write_batch
+        self.max_batch = max_batch
+        self.put_timeout = put_timeout
+        self.max_retries = max_retries
+        self.fallback_file = fallback_file
+        self._queue = queue.Queue(maxsize=max_queue)
+        # held while checking _stopping and queueing, so nothing is queued behind the sentinel stop() queues
+        self._submit_lock = threading.Lock()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='ResponseWriter', daemon=True)
+        self._thread.start()
+
+    def submit(self, row):
+        deadline = time.monotonic() + self.put_timeout
+        if not self._submit_lock.acquire(timeout=self.put_timeout):
+            raise queue.Full("response queue is full")
+        try:
+            if self._stopping:
+                raise queue.Full("response writer is shutting down")
+            self._queue.put(row, timeout=max(0.0, deadline - time.monotonic()))
+        finally:
+            self._submit_lock.release()
+
+    def depth(self):
+        """ number of rows waiting to be written """
+        return self._queue.qsize()
+
+    def flush(self):
+        """ blocks until every row submitted so far has been committed (or given up on) """
+        self._queue.join()
+
+    def stop(self):
+        """ refuses new rows, writes everything still queued, and stops the writer thread """
+        with self._submit_lock:
+            if self._stopping:
+                return
+            self._stopping = True
+            self._queue.put(None)
+        self._thread.join()
+
+    def _take_batch(self):
+        batch = [self._queue.get()]
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            stop = None in batch
+            rows = [row for row in batch if row is not None]
+
+            try:
+                if len(rows) > 0:
+                    self._write(rows)
+            except Exception as e:
+                # the thread has to keep going, or the queue fills up and every later response is turned away
+                print("Failed to write or save {:d} responses: {}".format(len(rows), e))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+            if stop:
+                # the sentinel is only queued after _stopping is set, so nothing can be queued behind it
+                break
+
+    def _write(self, rows):
+        for attempt in range(self.max_retries):
+            db = None
+            try:
+                # PoolTimeout when every connection is busy is retried like a locked database
+                db = self.pool.acquire()
+                self.write_batch(db, rows)
+                db.commit()
+                return
+            except Exception as e:
+                print("Failed to write {:d} responses (attempt {:d}): {}".format(len(rows), attempt + 1, e))
+            finally:
+                if db is not None:
+                    self._release(db)
+            time.sleep(0.1 * 2 ** attempt)
+
+        self._save_unwritten(rows)
+
+    def _release(self, db):
+        # release() rolls back a failed transaction, which can fail too on a broken connection
+        try:
+            self.pool.release(db)
+        except sqlite3.Error as e:
+            print("Failed to release a connection: {}".format(e))
+
+    def _save_unwritten(self, rows):
+        lines = [json.dumps(row, default=str) for row in rows]
+        if self.fallback_file is not None:
+            print("Giving up on writing {:d} responses, saving them to {:s}".format(len(rows), self.fallback_file))
+            try:
+                with open(self.fallback_file, 'a') as outfile:
+                    for line in lines:
+                        outfile.write(line + '\n')
+                return
+            except OSError as e:
+                print("Failed to save them to {:s}: {}".format(self.fallback_file, e))
+
+        print("Giving up on writing these responses:")
+        for line in lines:
+            print(line)
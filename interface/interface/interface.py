@@ -1,17 +1,30 @@
+import atexit
+import hmac
 import json
 import os
+import queue
 import shutil
 import socket
 import sqlite3
+import threading
+import time
+import urllib.request
 import uuid
 from collections import OrderedDict
 from datetime import datetime
 
 import click
-import numpy as np
-import requests
 from colorama import init, Fore, Style
-from flask import Flask, render_template, g, request, Response, url_for, redirect, make_response
+from flask import Flask, render_template, g, request, Response, url_for, redirect, make_response, abort, \
+    send_from_directory
+
+from .assets import AssetManifest, IMMUTABLE_CACHE_CONTROL
+from .assignment import SampleAssigner
+from .catalogue import SampleCatalogue
+from .dump import DUMP_FORMATS, NdjsonAppendWriter, NullDumpWriter, read_checkpoint, write_checkpoint
+from .ingest import ResponseWriter
+from .metrics import Metrics, timed_connection_factory
+from .pool import ConnectionPool
 
 app = Flask(__name__)
 app.config.from_object(__name__)
@@ -20,10 +33,37 @@ app.config.update(dict(
     DATABASE=os.path.join(app.root_path, 'db', 'interface.db'),
     SECRET_KEY='C796D37C6D491E8F0C6E9B83EED34C15C0F377F9F0F3CBB3216FBBF776DA6325',
     USERNAME='admin',
-    PASSWORD='password'
+    PASSWORD='password',
+    DATABASE_POOL_SIZE=8,
+    DATABASE_BUSY_TIMEOUT_MS=5000,
+    DATABASE_CACHED_STATEMENTS=100,
+    DATABASE_SYNCHRONOUS='NORMAL',
+    # 'sync' commits each response inside the request, 'batched' queues it for a background writer
+    RESPONSE_INGEST_MODE='sync',
+    RESPONSE_QUEUE_SIZE=1000,
+    RESPONSE_BATCH_SIZE=100,
+    RESPONSE_QUEUE_TIMEOUT_S=1.0,
+    # samples with this many responses aren't handed out anymore, None to keep handing out every sample
+    SAMPLE_TARGET_RESPONSES=None,
+    # how long a handed out sample counts toward its coverage before the labeler answers it
+    SAMPLE_LEASE_SECONDS=60 * 60,
+    # serve the sample mp3s from SAMPLES_ROOT through /audio instead of linking to SAMPLES_URL_PREFIX
+    SERVE_SAMPLES_LOCALLY=False,
+    # how many of the upcoming samples the labeling page downloads ahead of time
+    PRELOAD_SAMPLES=2,
+    # time every request and sql statement, for /metrics and "flask stats"
+    METRICS=True,
+    # /metrics only answers requests with this in their X-Metrics-Token header, and is off while it's None. Behind a
+    # reverse proxy every request comes from the proxy's address, so the peer address can't tell who's asking.
+    METRICS_TOKEN=None,
 ))
 
 DEFAULT_SAMPLES_PER_PARTICIPANT = 500
+SAMPLES_PAGE_SIZE = 10
+MAX_SAMPLES_PAGE_SIZE = 100
+MANAGE_PAGE_SIZE = 100
+MAX_MANAGE_PAGE_SIZE = 1000
+DEDUP_MODES = ['report', 'skip']
 SAMPLES_URL_PREFIX = 'https://mprlab.wpi.edu/'
 SAMPLES_ROOT = '/var/www/html/grouping'
 APP_ROOT = os.path.dirname(os.path.abspath(__file__))  # refers to application_top
@@ -32,14 +72,58 @@ NO_LABELER_ID = "NO_LABELER_ID"
 NOT_MTURK = "NO_MTURK"
 EXPERIMENT_ID_NOT_AVAILABLE = "EXPERIMENT_ID_NOT_AVAILABLE"
 LABELER_ID_COOKIE_KEY = 'labeler_id'
+METRICS_TOKEN_HEADER = 'X-Metrics-Token'
+
+# Statements run on every request are kept as constants so their text is identical each time,
+# which lets each pooled connection reuse the prepared statement from its cache.
+INSERT_RESPONSE_SQL = ('INSERT INTO responses'
+                       '(url, ip_addr, stamp, labeler_id, experiment_id, metadata, data)'
+                       'VALUES (?, ?, ?, ?, ?, ?, ?)')
+INSERT_LABELER_SQL = 'INSERT OR IGNORE INTO labelers (labeler_id) VALUES (?) '
+INSERT_MARKER_SQL = 'INSERT INTO markers (response_id, timestamp, size) VALUES (?, ?, ?)'
+INSERT_FINGERPRINT_SQL = 'INSERT OR REPLACE INTO fingerprints (url, hashes) VALUES (?, ?)'
+LABELED_URLS_SQL = 'SELECT url FROM responses WHERE labeler_id = ?'
+SAMPLE_COUNTS_SQL = ('SELECT samples.url, COUNT(responses.id) FROM samples '
+                     'LEFT JOIN responses ON responses.url = samples.url '
+                     'GROUP BY samples.url')
+
+catalogue = SampleCatalogue(SAMPLES_ROOT, SAMPLES_URL_PREFIX)
+assets = AssetManifest(APP_STATIC)
+_pools = {}
+_pools_lock = threading.Lock()
+_response_writer = None
+_response_writer_lock = threading.Lock()
+_assigner = None
+_assigner_lock = threading.Lock()
+metrics = Metrics()
+TimedConnection = timed_connection_factory(metrics)
 
 
 @app.cli.command('dumpdb')
 @click.option('--outfile', help="name for output file containing the responses database", type=click.Path())
 @click.option('--database', help='database file to use, a *.db file', default=None)
-def dumpdb_command(outfile, database):
-    """ Print the database (can save to CSV) """
-    dump_db(outfile, database)
+@click.option('--format', 'fmt', help='format of the output file', type=click.Choice(sorted(DUMP_FORMATS.keys())),
+              default='json')
+@click.option('--quiet/--no-quiet', help="don't print the responses to the terminal", default=False)
+@click.option('--since', help='only dump responses recorded at or after this time', type=click.DateTime(),
+              default=None)
+@click.option('--experiment', help='only dump responses from this experiment id', default=None)
+@click.option('--incremental/--no-incremental', help='only dump responses added since the last incremental dump to '
+                                                     'OUTFILE, appending them to OUTFILE.delta', default=False)
+def dumpdb_command(outfile, database, fmt, quiet, since, experiment, incremental):
+    """ Print the database (can save to json, ndjson, or npz) """
+    if incremental:
+        if not outfile:
+            raise click.UsageError("--incremental needs an --outfile")
+        if fmt == 'npz':
+            raise click.UsageError("npz dumps can't be appended to, use json or ndjson with --incremental")
+        if since is not None or experiment is not None:
+            # the checkpoint is the last id dumped, so rows left out by a filter would never be dumped later
+            raise click.UsageError("--incremental dumps every new response, it can't be used with --since or "
+                                   "--experiment")
+        dump_db_incremental(outfile, database, fmt=fmt, quiet=quiet)
+    else:
+        dump_db(outfile, database, fmt=fmt, quiet=quiet, since=since, experiment_id=experiment)
 
 
 @app.cli.command('remove_experiment')
@@ -59,12 +143,43 @@ def remove_command(sample_name, force):
 @app.cli.command('load')
 @click.argument('directory')
 @click.option('--database', help='database file to use, a *.db file', default=None)
-def load_command(directory, database):
+@click.option('--dry-run/--no-dry-run', help="only print which samples would be added", default=False)
+@click.option('--dedup', help="fingerprint the new samples, and report or skip ones with the same audio as another "
+                              "sample", type=click.Choice(DEDUP_MODES), default=None)
+def load_command(directory, database, dry_run, dedup):
     """ insert ALL the files from the given folder """
-    success = load(directory)
+    load(directory, database, dry_run, dedup)
 
-    if success:
-        dump_db(False, database)
+
+@app.cli.command('upgradedb')
+@click.option('--database', help='database file to use, a *.db file', default=None)
+def upgradedb_command(database):
+    """Applies upgrade.sql to an existing database without deleting data."""
+    upgrade_db(database)
+
+
+@app.cli.command('backfill_markers')
+@click.option('--database', help='database file to use, a *.db file', default=None)
+def backfill_markers_command(database):
+    """Fills the markers table from responses recorded before it existed."""
+    backfill_markers(database)
+
+
+@app.cli.command('backfill_fingerprints')
+@click.option('--database', help='database file to use, a *.db file', default=None)
+def backfill_fingerprints_command(database):
+    """Fingerprints the samples loaded before the fingerprints table existed."""
+    backfill_fingerprints(database)
+
+
+@app.cli.command('stats')
+@click.option('--url', help='metrics endpoint of the running server', default='http://127.0.0.1:5000/metrics')
+@click.option('--queries', help='number of sql statements to show, slowest in total first', default=10)
+@click.option('--json/--no-json', 'as_json', help='print the raw metrics instead of a summary', default=False)
+@click.option('--token', help='METRICS_TOKEN of the server, defaults to the one in this config', default=None)
+def stats_command(url, queries, as_json, token):
+    """Summarizes request and sql latencies of a running server."""
+    stats(url, queries, as_json, token or app.config['METRICS_TOKEN'])
 
 
 @app.cli.command('initdb')
@@ -78,25 +193,32 @@ def initdb_command(database, force):
         dump_db(False, database)
 
 
-def connect_db(alternate_db_path=None):
-    """Connects to the specific database."""
+def get_pool(alternate_db_path=None):
+    """Returns the connection pool for the database, creating it the first time it's used."""
     if alternate_db_path is None:
-        print("Using default database path:", app.config['DATABASE'])
-        rv = sqlite3.connect(app.config['DATABASE'], detect_types=sqlite3.PARSE_DECLTYPES)
+        db_path = app.config['DATABASE']
     else:
-        rv = sqlite3.connect(alternate_db_path, detect_types=sqlite3.PARSE_DECLTYPES)
-
-    rv.row_factory = sqlite3.Row
+        db_path = alternate_db_path
 
-    return rv
+    with _pools_lock:
+        if db_path not in _pools:
+            print("Using database path:", db_path)
+            _pools[db_path] = ConnectionPool(db_path,
+                                             size=app.config['DATABASE_POOL_SIZE'],
+                                             busy_timeout_ms=app.config['DATABASE_BUSY_TIMEOUT_MS'],
+                                             cached_statements=app.config['DATABASE_CACHED_STATEMENTS'],
+                                             synchronous=app.config['DATABASE_SYNCHRONOUS'],
+                                             factory=TimedConnection if app.config['METRICS'] else sqlite3.Connection)
+        return _pools[db_path]
 
 
 def get_db(alternate_db_path=None):
-    """Opens a new database connection if there is none yet for the
+    """Takes a database connection from the pool if there is none yet for the
     current application context.
     """
     if not hasattr(g, 'sqlite_db'):
-        g.sqlite_db = connect_db(alternate_db_path)
+        g.sqlite_pool = get_pool(alternate_db_path)
+        g.sqlite_db = g.sqlite_pool.acquire()
     return g.sqlite_db
 
 
@@ -124,8 +246,125 @@ def init_db(alternate_db_path, force):
     return True
 
 
-def load(directory):
-    db = get_db()
+def upgrade_db(alternate_db_path):
+    db = get_db(alternate_db_path)
+
+    with app.open_resource('upgrade.sql', mode='r') as f:
+        db.cursor().executescript(f.read())
+
+    db.commit()
+
+    print(Fore.BLUE + "Database Upgraded" + Style.RESET_ALL)
+    return True
+
+
+def backfill_markers(alternate_db_path, batch_size=1000):
+    db = get_db(alternate_db_path)
+
+    # responses without any markers. Ones with an empty final_response are parsed again each time, which is harmless
+    responses_cur = db.execute('SELECT id, data FROM responses '
+                               'WHERE NOT EXISTS (SELECT 1 FROM markers WHERE markers.response_id = responses.id)')
+    num_responses = 0
+    num_markers = 0
+    while True:
+        entries = responses_cur.fetchmany(batch_size)
+        if len(entries) == 0:
+            break
+
+        markers = []
+        for entry in entries:
+            response = json.loads(entry['data'])
+            for timestamp, size in response_markers(response):
+                markers.append((entry['id'], timestamp, size))
+
+        # a separate cursor, so the one we are reading from is left alone
+        db.cursor().executemany(INSERT_MARKER_SQL, markers)
+        num_responses += len(entries)
+        num_markers += len(markers)
+
+    db.commit()
+
+    print(Fore.BLUE + "Added {:d} markers from {:d} responses".format(num_markers, num_responses) + Style.RESET_ALL)
+    return True
+
+
+def sample_path(sample_url):
+    """ where a sample's mp3 is on this machine """
+    return os.path.join(SAMPLES_ROOT, sample_url[len(SAMPLES_URL_PREFIX):])
+
+
+def backfill_fingerprints(alternate_db_path, batch_size=100):
+    # sample_generator isn't needed to run the server, so it's only imported for the commands that use it
+    from sample_generator import fingerprint
+
+    db = get_db(alternate_db_path)
+
+    urls_cur = db.execute('SELECT url FROM samples '
+                          'WHERE NOT EXISTS (SELECT 1 FROM fingerprints WHERE fingerprints.url = samples.url)')
+    urls = [row[0] for row in urls_cur]
+
+    num_missing = 0
+    for i in range(0, len(urls), batch_size):
+        rows = []
+        for url in urls[i:i + batch_size]:
+            path = sample_path(url)
+            if not os.path.isfile(path):
+                num_missing += 1
+                continue
+            rows.append((url, fingerprint.to_blob(fingerprint.fingerprint_file(path))))
+        db.executemany(INSERT_FINGERPRINT_SQL, rows)
+        db.commit()
+
+    print(Fore.BLUE + "Fingerprinted {:d} samples".format(len(urls) - num_missing) + Style.RESET_ALL)
+    if num_missing > 0:
+        print(Fore.YELLOW + "{:d} samples have no file under {:s}".format(num_missing, SAMPLES_ROOT) + Style.RESET_ALL)
+    return True
+
+
+def find_duplicate_samples(db, directory, sample_urls, skip):
+    """
+    Fingerprints the samples that aren't in the database yet, and looks each one up among the fingerprints of the
+    samples in the database and the ones before it.
+    :param directory: where the samples' files are
+    :param skip: leave duplicates out of the returned urls
+    :return: the urls to add, a list of (url, (duplicated url, overlap, bit error rate)), and the fingerprints
+             table rows for the urls to add
+    """
+    from sample_generator import fingerprint
+
+    index = fingerprint.FingerprintIndex()
+    for url, hashes in db.execute('SELECT url, hashes FROM fingerprints'):
+        index.add(url, fingerprint.from_blob(hashes))
+
+    existing = existing_samples(db, sample_urls)
+    kept_urls = []
+    duplicates = []
+    fingerprint_rows = []
+    for url in sample_urls:
+        if url in existing:
+            kept_urls.append(url)
+            continue
+
+        hashes = fingerprint.fingerprint_file(os.path.join(directory, os.path.basename(url)))
+        match = index.find(hashes)
+        if match is not None:
+            duplicates.append((url, match))
+            if skip:
+                continue
+        index.add(url, hashes)
+        kept_urls.append(url)
+        fingerprint_rows.append((url, fingerprint.to_blob(hashes)))
+
+    return kept_urls, duplicates, fingerprint_rows
+
+
+def response_markers(sample_response):
+    """ (timestamp, size) of each marker in the final_response of one response """
+    return [(float(marker['timestamp']), marker.get('size')) for marker in sample_response['final_response']]
+
+
+def load(directory, alternate_db_path=None, dry_run=False, dedup=None):
+    db = get_db(alternate_db_path)
 
     if not os.path.isdir(directory):
         print(Fore.RED, end='')
@@ -142,45 +381,199 @@ def load(directory):
     subdir = os.path.split(abs_path)[-1]
 
     # insert ALL the files from the file system
-    sample_names = os.listdir(directory)
-    for sample_name in sample_names:
-        if not sample_name:
-            print(Fore.YELLOW, "Skipping empty", Fore.RESET)
-            continue
-        elif not os.path.isfile(os.path.join(directory, sample_name)):
-            print(Fore.YELLOW, "Skipping directory:", Fore.RESET, sample_name)
-            continue
-        elif not sample_name.endswith("mp3"):
-            print(Fore.YELLOW, "Skipping non-mp3:", Fore.RESET, sample_name)
+    sample_urls = []
+    num_ignored = 0
+    for entry in os.scandir(directory):
+        if not entry.name or not entry.is_file() or not entry.name.endswith("mp3"):
+            num_ignored += 1
             continue
-        else:
-            sample_url = os.path.join(SAMPLES_URL_PREFIX, subdir, sample_name)
-            try:
-                db.execute('INSERT INTO samples (url) VALUES (?) ', [sample_url])
-                print(Fore.BLUE, end='')
-                print("Added", sample_url)
-                print(Fore.RESET, end='')
-            except sqlite3.IntegrityError:
-                # skip this because the sample already exists!
-                print(Fore.YELLOW, end='')
-                print("Skipped", sample_url)
-                print(Fore.RESET, end='')
+        sample_urls.append(os.path.join(SAMPLES_URL_PREFIX, subdir, entry.name))
+    sample_urls.sort()
+
+    duplicates = []
+    fingerprint_rows = []
+    if dedup is not None:
+        sample_urls, duplicates, fingerprint_rows = find_duplicate_samples(db, directory, sample_urls,
+                                                                           skip=dedup == 'skip')
+        print(Fore.YELLOW, end='')
+        for sample_url, (duplicated_url, overlap, error_rate) in duplicates:
+            print("~ {:s} duplicates {:s} ({:.0%} overlap, {:.1%} of bits differ)".format(
+                sample_url, duplicated_url, overlap, error_rate))
+        print(Fore.RESET, end='')
+
+    additions, skipped = add_samples(db, sample_urls, dry_run)
+    if dedup == 'skip':
+        dedup_message = ", {:d} duplicates".format(len(duplicates))
+    elif dedup == 'report':
+        dedup_message = " ({:d} of the added are duplicates)".format(len(duplicates))
+    else:
+        dedup_message = ""
+
+    if dry_run:
+        print(Fore.BLUE, end='')
+        for sample_url in additions:
+            print("+", sample_url)
+        print(Fore.RESET, end='')
+        print("Would add {:d} samples, skip {:d} already in the database{:s}, and ignore {:d} non-mp3 files".format(
+            len(additions), len(skipped), dedup_message, num_ignored))
+        return True
 
+    db.executemany(INSERT_FINGERPRINT_SQL, fingerprint_rows)
     db.commit()
 
+    print(Fore.BLUE, end='')
+    print("Added {:d} samples, skipped {:d} already in the database{:s}, ignored {:d} non-mp3 files".format(
+        len(additions), len(skipped), dedup_message, num_ignored))
+    print(Fore.RESET, end='')
+
     return True
 
 
-def dump_db(outfile_name, database):
+def format_ms(ms):
+    return '-' if ms is None else '{:.1f}'.format(ms)
+
+
+def stats(url, num_queries=10, as_json=False, token=None):
+    headers = {METRICS_TOKEN_HEADER: token} if token else {}
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=10) as r:
+            data = json.loads(r.read().decode())
+    except (OSError, ValueError) as e:
+        print(Fore.RED + "Couldn't get metrics from {:s}: {}".format(url, e) + Style.RESET_ALL)
+        return
+
+    if as_json:
+        print(json.dumps(data, indent=2))
+        return
+
+    print(Fore.GREEN + "Server process {:d}, up {:.0f}s".format(data['pid'], data['uptime_s']) + Style.RESET_ALL)
+
+    row_format = '{:<40s} {:>7s} {:>6s} {:>8s} {:>8s} {:>8s} {:>8s} {:>8s}'
+    print(Style.BRIGHT + row_format.format('route', 'count', '5xx', 'mean ms', 'p50', 'p90', 'p99', 'max')
+          + Style.RESET_ALL)
+    for route in data['routes']:
+        errors = sum(count for status, count in route['statuses'].items() if status.startswith('5'))
+        print(row_format.format(route['method'] + ' ' + route['route'], str(route['count']), str(errors),
+                                format_ms(route['mean_ms']), format_ms(route['p50_ms']), format_ms(route['p90_ms']),
+                                format_ms(route['p99_ms']), format_ms(route['max_ms'])))
+
+    print()
+    row_format = '{:>10s} {:>7s} {:>8s} {:>8s} {:>8s}  {:s}'
+    print(Style.BRIGHT + row_format.format('total ms', 'count', 'mean ms', 'p99', 'max', 'sql') + Style.RESET_ALL)
+    for query in data['queries'][:num_queries]:
+        sql = query['sql'] if len(query['sql']) <= 60 else query['sql'][:57] + '...'
+        print(row_format.format(format_ms(query['total_ms']), str(query['count']), format_ms(query['mean_ms']),
+                                format_ms(query['p99_ms']), format_ms(query['max_ms']), sql))
+
+    print()
+    for name, queue_stats in data['queues'].items():
+        print("{:s} queue: {:d} waiting, at most {:d}".format(name, queue_stats['depth'], queue_stats['max_depth']))
+    for path, pool_stats in data['pools'].items():
+        print("{:s}: {:d} of {:d} connections open, {:d} idle".format(
+            path, pool_stats['open'], pool_stats['size'], pool_stats['idle']))
+
+
+def invalidate_assigner():
+    """Makes the sample assigner reload from the database, for after the samples table changes."""
+    if _assigner is not None:
+        _assigner.invalidate()
+
+
+def existing_samples(db, sample_urls, chunk_size=500):
+    """ the subset of sample_urls that are in the samples table """
+    existing = set()
+    for i in range(0, len(sample_urls), chunk_size):
+        chunk = sample_urls[i:i + chunk_size]
+        placeholders = ', '.join(['?'] * len(chunk))
+        existing_cur = db.execute('SELECT url FROM samples WHERE url IN (' + placeholders + ')', chunk)
+        existing.update(row[0] for row in existing_cur)
+    return existing
+
+
+def add_samples(db, sample_urls, dry_run=False):
+    """
+    Inserts samples in one executemany, without committing
+    :return: the urls that were added, and the urls skipped because they were already in the samples table
+    """
+    sample_urls = list(OrderedDict.fromkeys(sample_urls))
+    existing = existing_samples(db, sample_urls)
+    additions = [url for url in sample_urls if url not in existing]
+    skipped = [url for url in sample_urls if url in existing]
+
+    if not dry_run:
+        # OR IGNORE covers samples added by someone else since we checked
+        db.executemany('INSERT OR IGNORE INTO samples (url) VALUES (?)', [(url,) for url in additions])
+
+    return additions, skipped
+
+
+def remove_samples(db, sample_urls, dry_run=False):
+    """
+    Deletes samples in one executemany, without committing
+    :return: the urls that were removed, and the urls skipped because they weren't in the samples table
+    """
+    sample_urls = list(OrderedDict.fromkeys(sample_urls))
+    existing = existing_samples(db, sample_urls)
+    removals = [url for url in sample_urls if url in existing]
+    skipped = [url for url in sample_urls if url not in existing]
+
+    if not dry_run:
+        db.executemany('DELETE FROM samples WHERE url = ?', [(url,) for url in removals])
+        db.executemany('DELETE FROM fingerprints WHERE url = ?', [(url,) for url in removals])
+
+    return removals, skipped
+
+
+def dump_db_incremental(outfile_name, database, fmt='json', quiet=False):
+    """
+    The first time, this is a normal dump to outfile_name. After that, only responses with an id greater than the
+    last one dumped are appended, as ndjson, to outfile_name + '.delta'. The last id dumped is kept in
+    outfile_name + '.checkpoint'. response_processing.util merges the base dump and its delta when loading.
+
+    There's no filtering by time or experiment, because everything up to the checkpoint counts as dumped.
+    """
+    # the dump reader is shared with response_processing, so it's only imported for the command that uses it
+    from response_processing.util import read_dump
+
+    checkpoint_name = outfile_name + '.checkpoint'
+
+    if os.path.isfile(checkpoint_name):
+        after_id = read_checkpoint(checkpoint_name)
+    elif os.path.isfile(outfile_name):
+        # a full dump from before there were checkpoints, so pick up where it ends
+        after_id = max([response['id'] for response in read_dump(outfile_name)], default=0)
+    else:
+        after_id = None
+
+    if after_id is None:
+        last_id = dump_db(outfile_name, database, fmt=fmt, quiet=quiet)
+    else:
+        # the delta is only created once there's a new response for it
+        writer = NdjsonAppendWriter(outfile_name + '.delta')
+        last_id = dump_db(None, database, quiet=quiet, after_id=after_id, writer=writer)
+
+    # with no new responses the checkpoint is already right
+    if last_id is not None:
+        write_checkpoint(checkpoint_name, last_id)
+
+
+def dump_db(outfile_name, database, fmt='json', quiet=False, since=None, experiment_id=None, after_id=None,
+            writer=None, batch_size=1000):
+    """
+    :return: the largest responses.id dumped, or None if nothing was
+    """
     # for pretty terminal output
     init()
 
     db = get_db(database)
 
-    if outfile_name:
-        outfile = open(outfile_name, 'w')
+    if writer is not None:
+        pass
+    elif outfile_name:
+        writer_class, mode = DUMP_FORMATS[fmt]
+        writer = writer_class(open(outfile_name, mode))
     else:
-        outfile = open(os.devnull, 'w')
+        writer = NullDumpWriter()
 
     def print_samples_db():
         samples_cur = db.execute('SELECT url FROM samples')
@@ -206,11 +599,25 @@ def dump_db(outfile_name, database):
         print("=" * w)
 
     def print_response_db():
+        conditions = []
+        params = []
+        if since is not None:
+            conditions.append('stamp >= ?')
+            params.append(since)
+        if experiment_id is not None:
+            conditions.append('experiment_id = ?')
+            params.append(experiment_id)
+        if after_id is not None:
+            conditions.append('id > ?')
+            params.append(after_id)
+        where = ''
+        if len(conditions) > 0:
+            where = 'WHERE ' + ' AND '.join(conditions) + ' '
+
+        # stream the rows in id order rather than loading the whole table
         responses_cur = db.execute(
-            'SELECT id, url, stamp, labeler_id, experiment_id, metadata, data FROM responses ORDER BY stamp DESC')
-        entries = responses_cur.fetchall()
-
-        json_responses = []
+            'SELECT id, url, stamp, labeler_id, experiment_id, metadata, data FROM responses ' + where +
+            'ORDER BY id', params)
 
         headers = OrderedDict()
         headers['id'] = 3
@@ -224,44 +631,63 @@ def dump_db(outfile_name, database):
         for k, w in headers.items():
             fmt += "{:<" + str(w) + "." + str(w) + "s} "
         fmt = fmt.strip(' ')
-        header = fmt.format(*headers.keys())
-        print("=" * total_width)
-        print(header)
-        for entry in entries:
-            response = json.loads(entry[6])
-            json_responses.append({
-                'id': entry[0],
-                'url': entry[1],
-                'stamp': str(entry[2]),
-                'labeler_id': entry[3],
-                'experiment_id': entry[4],
-                'metadata': json.loads(entry[5]),
-                'data': response,
-            })
-            cols = [str(col) for col in entry]
-            cols[1] = cols[1].strip(SAMPLES_URL_PREFIX)
-            cols.pop(4)
-            cols.pop(4)
-            data = "["
-            for d in response['final_response']:
-                s = "%0.2f, " % d['timestamp']
-                if len(data + s) > headers['data'] - 4:
-                    data += "..., "
-                    break
-                data += s
-            if len(data) == 0:
-                cols[4] = data + "]"
-            else:
-                cols[4] = data[:-2] + "]"
-            if len(cols[4]) > headers['data']:
-                cols[4] = cols[4][0:headers['data'] - 3] + '...'
-            print(fmt.format(*cols))
-        print("=" * total_width)
+        if not quiet:
+            header = fmt.format(*headers.keys())
+            print("=" * total_width)
+            print(header)
+
+        num_responses = 0
+        last_id = None
+        while True:
+            entries = responses_cur.fetchmany(batch_size)
+            if len(entries) == 0:
+                break
+
+            for entry in entries:
+                response = json.loads(entry[6])
+                writer.write({
+                    'id': entry[0],
+                    'url': entry[1],
+                    'stamp': str(entry[2]),
+                    'labeler_id': entry[3],
+                    'experiment_id': entry[4],
+                    'metadata': json.loads(entry[5]),
+                    'data': response,
+                })
+                num_responses += 1
+                last_id = entry[0]
+
+                if quiet:
+                    continue
+
+                cols = [str(col) for col in entry]
+                cols[1] = cols[1].strip(SAMPLES_URL_PREFIX)
+                cols.pop(4)
+                cols.pop(4)
+                data = "["
+                for d in response['final_response']:
+                    s = "%0.2f, " % d['timestamp']
+                    if len(data + s) > headers['data'] - 4:
+                        data += "..., "
+                        break
+                    data += s
+                if len(data) == 0:
+                    cols[4] = data + "]"
+                else:
+                    cols[4] = data[:-2] + "]"
+                if len(cols[4]) > headers['data']:
+                    cols[4] = cols[4][0:headers['data'] - 3] + '...'
+                print(fmt.format(*cols))
+
+        if quiet:
+            print("Dumped {:d} responses".format(num_responses))
+        else:
+            print("=" * total_width)
 
-        json_out = {'dataset': json_responses}
-        json.dump(json_out, outfile, indent=2)
+        writer.close()
+        return last_id
 
-    print_response_db()
+    return print_response_db()
 
 
 def remove_experiment(experiment_id, database):
@@ -291,6 +717,7 @@ def remove_experiment(experiment_id, database):
                     continue
 
                 remove_cur = db.execute('DELETE FROM responses WHERE id=?', [id])
+                db.execute('DELETE FROM markers WHERE response_id=?', [id])
 
                 if remove_cur.rowcount == 1:
                     print(Fore.BLUE, end='')
@@ -323,6 +750,7 @@ def remove_from_sample_db(sample, force=False):
             remove_cur = db.execute('DELETE FROM samples WHERE url=?', [sample_url])
 
         if remove_cur.rowcount == 1:
+            db.execute('DELETE FROM fingerprints WHERE url=?', [sample_url])
             print(Fore.BLUE, end='')
             print("Removed", sample_url)
             print(Fore.RESET, end='')
@@ -338,63 +766,110 @@ def remove_from_sample_db(sample, force=False):
     db.commit()
 
 
-def sample_new_urls(entries, samples_per_participant):
-    """ samples from a*x^a-1 """
-    a = 10
-    sample_indeces = []
-    while True:
-        idx = int(np.random.power(a) * entries.shape[0])
-        if idx not in sample_indeces:
-            sample_indeces.append(idx)
-        if len(sample_indeces) == samples_per_participant:
-            break
-    sample_indeces = np.array(sample_indeces)
-    return entries[sample_indeces]
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def remember_status(response):
+    g.response_status = response.status_code
+    return response
+
+
+@app.teardown_request
+def record_request_time(error):
+    """ counts every request under the route it matched, so /audio/<path:path> is one route """
+    if not app.config['METRICS'] or 'request_start' not in g:
+        return
+    route = request.url_rule.rule if request.url_rule is not None else '<unmatched>'
+    # an exception skips after_request
+    status = g.get('response_status', 500)
+    metrics.record_request(request.method, route, status, time.perf_counter() - g.request_start)
 
 
 @app.teardown_appcontext
 def close_db(error):
-    """Closes the database again at the end of the request."""
+    """Returns the database connection to the pool at the end of the request."""
     if hasattr(g, 'sqlite_db'):
-        g.sqlite_db.close()
+        g.sqlite_pool.release(g.sqlite_db)
+
+
+def get_response_writer():
+    """Returns the background response writer, starting it the first time it's used."""
+    global _response_writer
+    with _response_writer_lock:
+        if _response_writer is None:
+            pool = get_pool()
+            _response_writer = ResponseWriter(pool, insert_responses,
+                                              max_queue=app.config['RESPONSE_QUEUE_SIZE'],
+                                              max_batch=app.config['RESPONSE_BATCH_SIZE'],
+                                              put_timeout=app.config['RESPONSE_QUEUE_TIMEOUT_S'],
+                                              fallback_file=pool.database + '.unwritten.jsonl')
+            # write out everything still queued when the server shuts down
+            atexit.register(_response_writer.stop)
+        return _response_writer
+
+
+def insert_responses(db, rows):
+    """
+    Inserts responses, their markers, and their labelers without committing.
+    :param rows: lists of [url, ip_addr, stamp, labeler_id, experiment_id, metadata, data, markers], where markers
+                 is a list of (timestamp, size) from the final response
+    """
+    for row in rows:
+        response_cur = db.execute(INSERT_RESPONSE_SQL, row[:7])
+        response_id = response_cur.lastrowid
+        db.executemany(INSERT_MARKER_SQL, [(response_id, timestamp, size) for timestamp, size in row[7]])
+        # add the labeler if not already present
+        db.execute(INSERT_LABELER_SQL, [row[3]])
 
 
 @app.route('/responses', methods=['POST'])
 def responses():
-    db = get_db()
     labeler_id = request.cookies.get(LABELER_ID_COOKIE_KEY, NO_LABELER_ID)
 
     if labeler_id == NO_LABELER_ID:
         return Response("No labeler id cookie", status=400, mimetype='application/json')
 
-    req_data = request.get_json()
-    sample = req_data['sample']
-    ip_addr = request.remote_addr
-    stamp = datetime.now()
-    metadata = req_data['metadata']
-    experiment_id = req_data['experiment_id']
-
-    sample_response = req_data['response']
-    url = sample['url']
-    # sort the final response by timestamps for sanity
-    sorted_final_response = sorted(sample_response['final_response'], key=lambda d: d['timestamp'])
-    sample_response['final_response'] = sorted_final_response
-
-    # Insert the full response details
-    db.execute(
-        'INSERT INTO responses'
-        '(url, ip_addr, stamp, labeler_id, experiment_id, metadata, data)'
-        'VALUES (?, ?, ?, ?, ?, ?, ?)',
-        [url, ip_addr, stamp, labeler_id, experiment_id, json.dumps(metadata), json.dumps(sample_response)])
-
-    # add the labeler if not already present
     try:
-        db.execute('INSERT INTO labelers (labeler_id) VALUES (?) ', [labeler_id])
-    except sqlite3.IntegrityError:
-        # skip this because the sample already exists!
-        pass
+        req_data = request.get_json()
+        sample = req_data['sample']
+        ip_addr = request.remote_addr
+        stamp = datetime.now()
+        metadata = req_data['metadata']
+        experiment_id = req_data['experiment_id']
+
+        sample_response = req_data['response']
+        url = sample['url']
+        # sort the final response by timestamps for sanity
+        sorted_final_response = sorted(sample_response['final_response'], key=lambda d: float(d['timestamp']))
+        sample_response['final_response'] = sorted_final_response
+        markers = response_markers(sample_response)
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return Response("Malformed response", status=400, mimetype='application/json')
+
+    row = [url, ip_addr, stamp, labeler_id, experiment_id, json.dumps(metadata), json.dumps(sample_response), markers]
+
+    if app.config['RESPONSE_INGEST_MODE'] == 'batched':
+        writer = get_response_writer()
+        try:
+            writer.submit(row)
+            metrics.record_queue_depth('responses', writer.depth())
+        except queue.Full:
+            metrics.record_queue_depth('responses', writer.depth())
+            # the writer is behind, so tell the client to back off and send it again
+            resp = Response(json.dumps({'status': 'busy'}), status=503, mimetype='application/json')
+            resp.headers['Retry-After'] = '1'
+            return resp
+    else:
+        # Insert the full response details
+        db = get_db()
+        insert_responses(db, [row])
+        db.commit()
 
-    db.commit()
+    if _assigner is not None:
+        _assigner.record_response(experiment_id, url, labeler_id)
 
     # submit the answers to mechanical turk if necessary as well
     # url = "https://www.mturk.com/mturk/externalSubmit"
@@ -452,32 +927,22 @@ def manage_post():
     req_data = request.get_json()
     selected_samples = req_data['selected_samples']
     unselected_samples = req_data['unselected_samples']
-    # set database contents to these selected samples
-    additions = []
-    skipped_additions = []
-    removals = []
-    skipped_removals = []
+    # with dry_run, only report what would change
+    dry_run = req_data.get('dry_run', False)
     db = get_db()
 
-    # Add samples (skip duplicates)
-    for sample_url in selected_samples:
-        try:
-            db.execute('INSERT INTO samples (url) VALUES (?) ', [sample_url])
-            additions.append(sample_url)
-        except sqlite3.IntegrityError:
-            # skip this because the sample already exists!
-            skipped_additions.append(sample_url)
-
-    # Remove samples
-    for sample_url in unselected_samples:
-        try:
-            db.execute('DELETE FROM samples WHERE url= ?', [sample_url])
-            removals.append(sample_url)
-        except sqlite3.IntegrityError:
-            skipped_removals.append(sample_url)
+    # set database contents to these selected samples, all in one transaction
+    additions, skipped_additions = add_samples(db, selected_samples, dry_run)
+    removals, skipped_removals = remove_samples(db, unselected_samples, dry_run)
+
+    if dry_run:
+        db.rollback()
+    else:
+        db.commit()
+        invalidate_assigner()
 
-    db.commit()
     return json.dumps({'status': 'success',
+                       'dry_run': dry_run,
                        'additions': additions,
                        'skipped_additions': skipped_additions,
                        'removals': removals,
@@ -486,44 +951,80 @@ def manage_post():
 
 @app.route('/manage', methods=['GET'])
 def manage_get():
-    # get list of possible samples
+    # the samples themselves are fetched a page at a time from /manage/samples
+    if not os.path.isdir(SAMPLES_ROOT):
+        return render_template('error.html', reason="Failed to find the samples directory " + SAMPLES_ROOT)
+
+    return render_template('manage.html', page_size=MANAGE_PAGE_SIZE)
+
+
+@app.route('/manage/samples', methods=['GET'])
+def manage_samples():
+    """
+    One page of the catalogue of samples on disk, each marked with whether it's in the samples table.
+    Query parameters:
+        filter: only samples whose name contains this
+        status: 'all', 'in_db', or 'not_in_db'
+        offset, limit: which page
+    """
+    name_filter = request.args.get('filter', '')
+    status = request.args.get('status', 'all')
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = max(1, min(request.args.get('limit', MANAGE_PAGE_SIZE, type=int), MAX_MANAGE_PAGE_SIZE))
+
     try:
+        samples = catalogue.samples()
+    except OSError as e:
+        return Response(json.dumps({'status': 'error', 'reason': str(e)}), status=500, mimetype='application/json')
 
-        samples = []
-        subdirs = os.listdir(SAMPLES_ROOT)
-
-        for subdir in subdirs:
-            full_subdir = os.path.join(SAMPLES_ROOT, subdir)
-            if os.path.isdir(full_subdir):
-                sample_names = os.listdir(full_subdir)
-
-                for sample_name in sample_names:
-                    # skip empty strings, non-files, and non mp3s
-                    if not sample_name:
-                        continue
-                    elif not os.path.isfile(os.path.join(full_subdir, sample_name)):
-                        continue
-                    elif not sample_name.endswith("mp3"):
-                        continue
-
-                    sample = {
-                        'url': os.path.join(SAMPLES_URL_PREFIX, subdir, sample_name),
-                        'name': sample_name
-                    }
-                    samples.append(sample)
+    if name_filter:
+        samples = [sample for sample in samples if name_filter in sample['name']]
 
-        db = get_db()
-        samples_cur = db.execute('SELECT url FROM samples')
-        entries = samples_cur.fetchall()
-        db_samples = []
-        for entry in entries:
-            db_samples.append({
-                'url': entry[0],
-            })
+    db = get_db()
+    if status in ('in_db', 'not_in_db'):
+        db_sample_urls = set(row[0] for row in db.execute('SELECT url FROM samples'))
+        want_in_db = status == 'in_db'
+        samples = [sample for sample in samples if (sample['url'] in db_sample_urls) == want_in_db]
+        page = samples[offset:offset + limit]
+        page_in_db = [want_in_db] * len(page)
+    else:
+        page = samples[offset:offset + limit]
+        page_urls = [sample['url'] for sample in page]
+        db_sample_urls = set()
+        if len(page_urls) > 0:
+            placeholders = ', '.join(['?'] * len(page_urls))
+            db_sample_urls = set(row[0] for row in
+                                 db.execute('SELECT url FROM samples WHERE url IN (' + placeholders + ')', page_urls))
+        page_in_db = [sample['url'] in db_sample_urls for sample in page]
 
-        return render_template('manage.html', samples=json.dumps(samples), db_samples=db_samples)
-    except requests.exceptions.ProxyError:
-        return render_template('error.html', reason="Failed to contact sever for list of samples.")
+    page = [{'url': sample['url'], 'name': sample['name'], 'in_db': in_db} for sample, in_db in zip(page, page_in_db)]
+
+    data = {'samples': page, 'total': len(samples), 'offset': offset}
+    return Response(json.dumps(data), status=200, mimetype='application/json')
+
+
+@app.route('/manage/index.txt', methods=['GET'])
+def manage_index():
+    """ names of the samples in the samples table, one per line """
+    db = get_db()
+    names = [os.path.basename(row[0]) for row in db.execute('SELECT url FROM samples ORDER BY url')]
+    return Response(''.join(name + '\n' for name in names), status=200, mimetype='text/plain')
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_page():
+    """ request and sql latencies of this server process as json, only for requests with the METRICS_TOKEN """
+    token = app.config['METRICS_TOKEN']
+    if not token or not hmac.compare_digest(request.headers.get(METRICS_TOKEN_HEADER, ''), token):
+        abort(404)
+
+    if _response_writer is not None:
+        metrics.record_queue_depth('responses', _response_writer.depth())
+    data = metrics.snapshot()
+    data['pid'] = os.getpid()
+    data['pools'] = {path: {'open': pool.num_open(), 'idle': pool.num_idle(), 'size': pool.size}
+                     for path, pool in sorted(_pools.items())}
+    return Response(json.dumps(data), status=200, mimetype='application/json')
 
 
 @app.route('/wpi_participant_pool', methods=['GET'])
@@ -536,6 +1037,99 @@ def root():
     return redirect(url_for('interface'))
 
 
+@app.route('/samples', methods=['GET'])
+def samples_page():
+    labeler_id = request.cookies.get(LABELER_ID_COOKIE_KEY, NO_LABELER_ID)
+
+    if labeler_id == NO_LABELER_ID:
+        return Response("No labeler id cookie", status=400, mimetype='application/json')
+
+    experiment_id = request.args.get('experiment_id')
+    if experiment_id is None:
+        return Response("No experiment id", status=400, mimetype='application/json')
+
+    limit = request.args.get('limit', SAMPLES_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MAX_SAMPLES_PAGE_SIZE))
+
+    db = get_db()
+    samples = assign_samples(db, labeler_id, experiment_id, limit)
+
+    # a short page means there was nothing left to hand out
+    data = {'samples': samples, 'more': len(samples) == limit}
+    js = json.dumps(data)
+    resp = Response(js, status=200, mimetype='application/json')
+    return resp
+
+
+def get_assigner(db):
+    """Returns the sample assigner, (re)loading the response counts from the database if needed."""
+    global _assigner
+    with _assigner_lock:
+        if _assigner is None:
+            _assigner = SampleAssigner(target_responses=app.config['SAMPLE_TARGET_RESPONSES'],
+                                       lease_seconds=app.config['SAMPLE_LEASE_SECONDS'])
+        if not _assigner.loaded:
+            _assigner.load({row[0]: row[1] for row in db.execute(SAMPLE_COUNTS_SQL)})
+        return _assigner
+
+
+def get_labeled_urls(db, labeler_id):
+    return set(row[0] for row in db.execute(LABELED_URLS_SQL, [labeler_id]))
+
+
+def get_labeler_assigner(db, labeler_id):
+    """Returns the sample assigner, loading the urls this labeler has labeled into it if it doesn't have them."""
+    assigner = get_assigner(db)
+    if assigner.needs_labeled(labeler_id):
+        assigner.set_labeled(labeler_id, get_labeled_urls(db, labeler_id))
+    return assigner
+
+
+def assign_samples(db, labeler_id, experiment_id, limit):
+    """
+    The next samples for this experiment, least covered first, skipping any this labeler has already labeled
+    :return: list of up to limit samples
+    """
+    urls = get_labeler_assigner(db, labeler_id).assign(experiment_id, limit, labeler_id)
+    return [{'url': url, 'audio_url': audio_url(url)} for url in urls]
+
+
+def audio_url(sample_url):
+    """ where the labeling page should play a sample from. 'url' stays the sample's id in the database. """
+    if app.config['SERVE_SAMPLES_LOCALLY'] and sample_url.startswith(SAMPLES_URL_PREFIX):
+        return url_for('audio', path=sample_url[len(SAMPLES_URL_PREFIX):])
+    return sample_url
+
+
+@app.route('/audio/<path:path>', methods=['GET'])
+def audio(path):
+    """
+    Sample mp3s with Range support for seeking, and ETags. Sample names end in a uuid and are never rewritten,
+    so browsers may cache them forever.
+    """
+    resp = send_from_directory(SAMPLES_ROOT, path, conditional=True)
+    resp.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return resp
+
+
+@app.route('/assets/<path:hashed_name>', methods=['GET'])
+def asset(hashed_name):
+    """ files from static/ under their content-hashed names, see hashed_static() """
+    filename = assets.resolve(hashed_name)
+    if filename is None:
+        abort(404)
+
+    resp = send_from_directory(APP_STATIC, filename, conditional=True)
+    resp.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return resp
+
+
+@app.template_global()
+def hashed_static(filename):
+    """ use in templates instead of url_for('static', ...) for files that change between deploys """
+    return url_for('asset', hashed_name=assets.hashed_name(filename))
+
+
 @app.route('/interface', methods=['GET'])
 def interface():
     # unique ID for this labeler
@@ -545,34 +1139,31 @@ def interface():
         labeler_id = str(uuid.uuid4())
 
     db = get_db()
-    # get the list of samples that this labeler has already labeled
-    labeled_cur = db.execute('SELECT responses.url FROM responses '
-                             'JOIN samples ON samples.url = responses.url '
-                             'WHERE responses.labeler_id=?', [labeler_id])
-    labeled_sample_urls = [row['url'] for row in labeled_cur.fetchall()]
-    all_cur = db.execute('SELECT url FROM samples')
-    all_sample_urls = [row['url'] for row in all_cur.fetchall()]
-
-    # remove any samples that have already been labeled
-    unlabeled_sample_urls = [s for s in all_sample_urls if s not in labeled_sample_urls]
-
-    if len(unlabeled_sample_urls) <= 0:
-        return render_template('thankyou.html')
+    num_samples = get_labeler_assigner(db, labeler_id).num_available(labeler_id)
 
-    # explicitly shuffle them
-    np.random.shuffle(unlabeled_sample_urls)
+    if num_samples <= 0:
+        return render_template('thankyou.html')
 
     # Generate new UUID for this experiment. An experiment is one session by one labeler done without refreshing.
+    # The rest of the samples are fetched in pages from /samples as the labeler works through them.
     experiment_id = str(uuid.uuid4())
-
-    samples = [{'url': url} for url in unlabeled_sample_urls]
+    samples = assign_samples(db, labeler_id, experiment_id, SAMPLES_PAGE_SIZE)
+    more_samples = len(samples) == SAMPLES_PAGE_SIZE
 
     href = "thankyou?"
-    template = render_template('interface.html', samples=json.dumps(samples), experiment_id=experiment_id,
-                               next_href=href, labeler_id=labeler_id)
+    template = render_template('interface.html', samples=json.dumps(samples),
+                               more_samples=json.dumps(more_samples), num_samples=num_samples,
+                               experiment_id=experiment_id, next_href=href, labeler_id=labeler_id,
+                               preload_samples=app.config['PRELOAD_SAMPLES'])
     resp = make_response(template)
     resp.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
 
+    # let the browser start downloading the first samples while it's still loading the page
+    preload = ['<{:s}>; rel=preload; as=audio'.format(sample['audio_url'])
+               for sample in samples[:app.config['PRELOAD_SAMPLES']]]
+    if len(preload) > 0:
+        resp.headers['Link'] = ', '.join(preload)
+
     if app.debug:
         max_age_seconds = None  # when debugging, delete cookie when browser exits
     else:
@@ -0,0 +1,152 @@
+import bisect
+import functools
+import re
+import sqlite3
+import threading
+import time
+
+# upper bounds of the latency buckets in milliseconds, the last bucket takes everything slower
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+_placeholder_list = re.compile(r'\?(\s*,\s*\?)+')
+_whitespace = re.compile(r'\s+')
+
+
+@functools.lru_cache(maxsize=1024)
+def normalize_sql(sql):
+    """ collapses whitespace and lists of placeholders, so an IN (?, ?, ?) query is one query whatever its length """
+    return _placeholder_list.sub('?, ...', _whitespace.sub(' ', sql).strip())
+
+
+class LatencyHistogram(object):
+    """ counts of durations in the LATENCY_BUCKETS_MS buckets, plus their total and maximum """
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, q):
+        """ :return: upper bound of the bucket the q-th percentile falls in, the maximum for the last bucket """
+        if self.count == 0:
+            return None
+        rank = q / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS_MS, self.counts):
+            seen += count
+            if seen >= rank:
+                return round(min(bound, self.max_ms), 3)
+        return round(self.max_ms, 3)
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total_ms': round(self.total_ms, 3),
+            'mean_ms': round(self.total_ms / self.count, 3) if self.count > 0 else None,
+            'p50_ms': self.percentile(50),
+            'p90_ms': self.percentile(90),
+            'p99_ms': self.percentile(99),
+            'max_ms': round(self.max_ms, 3),
+            'buckets_ms': LATENCY_BUCKETS_MS,
+            'bucket_counts': list(self.counts),
+        }
+
+
+class Metrics(object):
+    """
+    Latencies of requests per route and of sql statements, and the largest depth seen of any queue that reports
+    one.
+
+    Everything is kept in memory, so every server process has its own, counted from when it started.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self._requests = {}  # (method, route) -> LatencyHistogram
+            self._statuses = {}  # (method, route) -> {status: count}
+            self._queries = {}  # normalized sql -> LatencyHistogram
+            self._queue_depths = {}  # name -> (last depth, max depth)
+
+    def record_request(self, method, route, status, seconds):
+        key = (method, route)
+        with self._lock:
+            self._requests.setdefault(key, LatencyHistogram()).add(seconds * 1000)
+            statuses = self._statuses.setdefault(key, {})
+            statuses[status] = statuses.get(status, 0) + 1
+
+    def record_query(self, sql, seconds):
+        sql = normalize_sql(sql)
+        with self._lock:
+            self._queries.setdefault(sql, LatencyHistogram()).add(seconds * 1000)
+
+    def record_queue_depth(self, name, depth):
+        with self._lock:
+            _, max_depth = self._queue_depths.get(name, (0, 0))
+            self._queue_depths[name] = (depth, max(depth, max_depth))
+
+    def snapshot(self):
+        """ :return: everything recorded so far as a dict that can be dumped to json """
+        with self._lock:
+            routes = []
+            for (method, route), histogram in sorted(self._requests.items(), key=lambda item: item[0][1]):
+                entry = histogram.to_dict()
+                entry.update({'method': method, 'route': route,
+                              'statuses': {str(status): count
+                                           for status, count in sorted(self._statuses[(method, route)].items())}})
+                routes.append(entry)
+
+            queries = []
+            for sql, histogram in sorted(self._queries.items(), key=lambda item: -item[1].total_ms):
+                entry = histogram.to_dict()
+                entry['sql'] = sql
+                queries.append(entry)
+
+            queues = {name: {'depth': depth, 'max_depth': max_depth}
+                      for name, (depth, max_depth) in sorted(self._queue_depths.items())}
+
+            return {'started': self.started, 'uptime_s': round(time.time() - self.started, 3), 'routes': routes,
+                    'queries': queries, 'queues': queues}
+
+
+def timed_connection_factory(metrics):
+    """
+    :return: a sqlite3.Connection subclass, for sqlite3.connect(factory=...), which records how long each execute,
+             executemany and commit takes in metrics. Rows fetched after execute returns aren't counted.
+    """
+
+    class TimedConnection(sqlite3.Connection):
+
+        def execute(self, sql, *args):
+            t0 = time.perf_counter()
+            try:
+                return super().execute(sql, *args)
+            finally:
+                metrics.record_query(sql, time.perf_counter() - t0)
+
+        def executemany(self, sql, *args):
+            t0 = time.perf_counter()
+            try:
+                return super().executemany(sql, *args)
+            finally:
+                metrics.record_query(sql, time.perf_counter() - t0)
+
+        def commit(self):
+            t0 = time.perf_counter()
+            try:
+                return super().commit()
+            finally:
+                metrics.record_query('COMMIT', time.perf_counter() - t0)
+
+    return TimedConnection
@@ -0,0 +1,117 @@
+import queue
+import sqlite3
+import threading
+import time
+
+
+class PoolTimeout(Exception):
+    """ raised when no connection became free within the busy timeout """
+    pass
+
+
+class ConnectionPool(object):
+    """
+    A fixed size pool of sqlite3 connections to one database file.
+
+    Connections are opened lazily, put in WAL mode so readers don't block the writer, and reused across requests.
+    Because they live as long as the pool, each connection's statement cache works like a set of prepared statements
+    for the queries the app runs over and over.
+    """
+
+    def __init__(self, database, size=8, busy_timeout_ms=5000, cached_statements=100, synchronous='NORMAL',
+                 setup=None, factory=sqlite3.Connection):
+        """
+        :param database: path to the sqlite3 database file
+        :param size: maximum number of open connections
+        :param busy_timeout_ms: how long to wait on a locked database, and on a free connection
+        :param cached_statements: number of prepared statements kept per connection
+        :param synchronous: value for PRAGMA synchronous. NORMAL is safe against corruption in WAL mode.
+        :param setup: called with each new connection, for registering functions and such
+        :param factory: sqlite3.Connection or a subclass of it to open the connections as
+        """
+        self.database = database
+        self.size = size
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cached_statements = cached_statements
+        self.synchronous = synchronous
+        self.setup = setup
+        self.factory = factory
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database, detect_types=sqlite3.PARSE_DECLTYPES,
+                               timeout=self.busy_timeout_ms / 1000.0, check_same_thread=False,
+                               cached_statements=self.cached_statements, factory=self.factory)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous={:s}'.format(self.synchronous))
+        conn.execute('PRAGMA busy_timeout={:d}'.format(self.busy_timeout_ms))
+        if self.setup is not None:
+            self.setup(conn)
+        return conn
+
+    def acquire(self):
+        deadline = time.monotonic() + self.busy_timeout_ms / 1000.0
+        while True:
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+
+            with self._lock:
+                open_new = self._opened < self.size
+                if open_new:
+                    self._opened += 1
+
+            if open_new:
+                try:
+                    return self._connect()
+                except sqlite3.Error:
+                    with self._lock:
+                        self._opened -= 1
+                    raise
+
+            # wait in short slices, since a broken connection dropped by release() frees a slot without waking anyone
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise PoolTimeout("no free connection to {:s} after {:d}ms".format(self.database,
+                                                                                  self.busy_timeout_ms))
+            try:
+                return self._idle.get(timeout=min(remaining, 0.05))
+            except queue.Empty:
+                pass
+
+    def release(self, conn):
+        try:
+            # never hand the next request a half finished transaction
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            # the connection is broken or the database stayed locked, so drop it and free its slot for a new one
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+            with self._lock:
+                self._opened -= 1
+            return
+        self._idle.put(conn)
+
+    def num_open(self):
+        with self._lock:
+            return self._opened
+
+    def num_idle(self):
+        return self._idle.qsize()
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._opened -= 1
@@ -1,7 +1,7 @@
 -- Create table for samples
 drop table if exists samples;
 create table samples (
-  url text not null primary key,
+  url text not null primary key
 );
 
 -- Create table for labelers
@@ -25,3 +25,30 @@ create table responses (
   CONSTRAINT key_labeler FOREIGN KEY (labeler_id) REFERENCES labelers (labeler_id),
   CONSTRAINT key_url FOREIGN KEY (url) REFERENCES samples (url)
 );
+
+-- Index used to find the samples a labeler has not labeled yet
+create index responses_labeler_url on responses (labeler_id, url);
+
+-- Index used to count the responses to each sample
+create index responses_url on responses (url);
+
+-- Create table for the markers of each response's final_response, so they can be read without parsing responses.data
+drop table if exists markers;
+create table markers (
+  id integer primary key autoincrement,
+  response_id integer not null,
+  timestamp real not null, -- seconds from the start of the sample
+  size text,
+  CONSTRAINT key_response FOREIGN KEY (response_id) REFERENCES responses (id)
+);
+
+create index markers_response on markers (response_id);
+
+-- Audio fingerprints of samples, used to find duplicates when loading samples. Fill it in for samples loaded before
+-- it existed with `flask backfill_fingerprints`
+drop table if exists fingerprints;
+create table fingerprints (
+  url text not null primary key,
+  hashes blob not null, -- one little endian uint32 per frame, see sample_generator/fingerprint.py
+  CONSTRAINT key_url FOREIGN KEY (url) REFERENCES samples (url)
+);
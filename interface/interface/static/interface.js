@@ -8,6 +8,12 @@ let start_time = 0;
 let marker_id_counter = 0;
 let trial_start_time;
 let iface_enabled = false;
+let samples_request = null;
+let pending_posts = 0;
+// audio elements downloading upcoming samples, by url
+let preloaded_audio = {};
+// fetch the next page of samples when this few are left in the queue
+let samples_prefetch_threshold = 3;
 
 function Action(type, id) {
   return {
@@ -63,8 +69,9 @@ let instruction_idx = 0;
 
 window.onload = function() {
   sample_idx = 0;
-  audio_src.src = samples[sample_idx]['url'];
+  audio_src.src = sample_audio_url(samples[sample_idx]);
   audio.load();
+  preload_upcoming_samples();
   audio.loop = true;
   let iface = $('#interface');
   iface.css('background', background_color);
@@ -75,7 +82,8 @@ window.onload = function() {
   make_interface();
 
   // update progress indicator
-  $('#progress_indicator').html('Sample ' + (sample_idx + 1) + '/' + samples.length);
+  $('#progress_indicator').html('Sample ' + (sample_idx + 1) + '/' + num_samples);
+  prefetch_samples();
 
   $('#prev_instruction').css('visibility', 'hidden');
   $('#instruction').html(instructions[0]);
@@ -104,6 +112,28 @@ function get_cookie(key) {
   return "";
 }
 
+function fetch_samples() {
+  // only one page request in flight at a time
+  if (samples_request === null) {
+    samples_request = $.getJSON('/samples', {
+      'experiment_id': experiment_id,
+    }).done(function(data) {
+      samples = samples.concat(data['samples']);
+      more_samples = data['more'];
+      preload_upcoming_samples();
+    }).always(function() {
+      samples_request = null;
+    });
+  }
+  return samples_request;
+}
+
+function prefetch_samples() {
+  if (more_samples && samples.length - sample_idx <= samples_prefetch_threshold) {
+    fetch_samples();
+  }
+}
+
 function prev_instruction() {
   if (instruction_idx > 0) {
     instruction_idx -= 1;
@@ -275,7 +305,6 @@ function next_submit() {
   trial_start_time = now;
 
   // HTTP POST to server
-  let request = new XMLHttpRequest();
   let metadata = {
     'assignment_id': assignment_id
   };
@@ -285,34 +314,104 @@ function next_submit() {
     'sample': samples[sample_idx],
     'response': responses[sample_idx],
   };
+  post_response(post_data);
+
+  if (sample_idx === num_samples - 1) {
+    finish();
+  }
+  else if (sample_idx + 1 < samples.length) {
+    load_next_sample();
+  }
+  else if (more_samples) {
+    // the labeler got ahead of the prefetch, so wait for the next page
+    fetch_samples().done(function() {
+      if (sample_idx + 1 < samples.length) {
+        load_next_sample();
+      }
+      else {
+        finish();
+      }
+    }).fail(finish);
+  }
+  else {
+    // there are fewer samples left than when the page was loaded
+    finish();
+  }
+}
+
+function post_response(post_data) {
+  let request = new XMLHttpRequest();
   let url = '/responses';
+  pending_posts += 1;
+  request.onreadystatechange = function() {
+    if (request.readyState !== XMLHttpRequest.DONE) {
+      return;
+    }
+    pending_posts -= 1;
+    if (request.status === 503) {
+      // the server is busy writing responses, so send it again once it asks us to
+      let retry_after_s = parseFloat(request.getResponseHeader('Retry-After')) || 1;
+      pending_posts += 1;
+      setTimeout(function() {
+        pending_posts -= 1;
+        post_response(post_data);
+      }, retry_after_s * 1000);
+    }
+  };
   request.open('POST', url, true);
   request.setRequestHeader('Content-Type', 'application/json;charset=UTF-8');
   request.send(JSON.stringify(post_data));
+}
 
-  if (sample_idx === samples.length - 1) {
-    $('#next-submit-button').prop('disabled', true);
+function finish() {
+  $('#next-submit-button').prop('disabled', true);
 
-    window.location.href = next_href;
+  // don't leave the page until the server has every response
+  if (pending_posts > 0) {
+    setTimeout(finish, 100);
+    return;
   }
-  else {
-
-    // load the next sample
-    sample_idx += 1;
-    audio_src.src = samples[sample_idx]['url'];
-    audio.load();
 
-    // create response object for new trial
-    responses[sample_idx] = Response();
+  window.location.href = next_href;
+}
 
-    // update progress indicator
-    $('#progress_indicator').html('Sample ' + (sample_idx + 1) + '/' + samples.length);
+function sample_audio_url(sample) {
+  // samples may be played from somewhere other than the url that identifies them
+  return sample['audio_url'] || sample['url'];
+}
 
-    // change next button to submit button if it's the last sample
-    if (sample_idx === samples.length - 1) {
-      $('#next-submit-button').prop('innerHTML', 'Submit');
+function preload_upcoming_samples() {
+  let upcoming = {};
+  for (let i = sample_idx + 1; i < Math.min(samples.length, sample_idx + 1 + preload_samples); i++) {
+    let url = sample_audio_url(samples[i]);
+    upcoming[url] = preloaded_audio[url] || new Audio();
+    if (!(url in preloaded_audio)) {
+      upcoming[url].preload = 'auto';
+      upcoming[url].src = url;
     }
   }
+  // let go of the ones that have been played, the browser cache still has them
+  preloaded_audio = upcoming;
+}
+
+function load_next_sample() {
+  sample_idx += 1;
+  audio_src.src = sample_audio_url(samples[sample_idx]);
+  audio.load();
+  preload_upcoming_samples();
+
+  // create response object for new trial
+  responses[sample_idx] = Response();
+
+  // update progress indicator
+  $('#progress_indicator').html('Sample ' + (sample_idx + 1) + '/' + num_samples);
+
+  // change next button to submit button if it's the last sample
+  if (sample_idx === num_samples - 1) {
+    $('#next-submit-button').prop('innerHTML', 'Submit');
+  }
+
+  prefetch_samples();
 }
 
 /////////////////////////////////////////////////////////
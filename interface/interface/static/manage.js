@@ -1,94 +1,181 @@
-let sample_map = {};
+// url -> true to add to the database, false to remove. Only these are sent when committing.
+let changes = {};
+let offset = 0;
+let total = 0;
 
 window.onload = function() {
-    for (let i=0; i < samples.length; ++i) {
-        let sample = samples[i];
-        add_sample(sample['url'], sample['name']);
-    }
+    load_page();
+}
 
-    // check all the samples that are already in the database
-    for (let i=0; i < db_samples.length; ++i) {
-        let db_sample = db_samples[i];
-        let list_element = sample_map[db_sample['url']];
-        let checkbox = $(list_element.getElementsByTagName("input"));
-        checkbox.prop("checked", true);
+function load_page() {
+    let params = {
+        'offset': offset,
+        'limit': page_size,
+        'filter': $('#name_filter').val(),
+        'status': $('#status_filter').val(),
+    };
+    $.getJSON('/manage/samples', params).done(function(data) {
+        total = data['total'];
+        $("#input_samples").empty();
+        for (let i=0; i < data['samples'].length; ++i) {
+            let sample = data['samples'][i];
+            add_sample(sample['url'], sample['name'], sample['in_db']);
+        }
+        update_indicators();
+    });
+}
+
+function update_indicators() {
+    let last = Math.min(offset + page_size, total);
+    if (total === 0) {
+        $('#page_indicator').html('No samples');
+    }
+    else {
+        $('#page_indicator').html((offset + 1) + '-' + last + ' of ' + total);
     }
+    $('#prev_page').prop('disabled', offset === 0);
+    $('#next_page').prop('disabled', last >= total);
+    $('#changes_indicator').html(Object.keys(changes).length + ' uncommitted changes');
+}
+
+function prev_page() {
+    offset = Math.max(offset - page_size, 0);
+    load_page();
 }
 
-function add_sample(url, name) {
+function next_page() {
+    offset += page_size;
+    load_page();
+}
+
+function filter() {
+    offset = 0;
+    load_page();
+}
+
+function add_sample(url, name, in_db) {
     let new_audio_item = document.createElement("li");
     let new_audio = document.createElement("AUDIO");
     let new_src = document.createElement("source");
     let checkbox = document.createElement("input");
     let text = document.createTextNode(name);
     new_audio.setAttribute("style", "width:90%");
+    // don't download anything until someone presses play
+    new_audio.preload = "none";
     checkbox.type="checkbox";
     checkbox.setAttribute("style", "margin-left:30px");
+    if (url in changes) {
+        checkbox.checked = changes[url];
+    }
+    else {
+        checkbox.checked = in_db;
+    }
+    checkbox.onchange = function() {
+        if (checkbox.checked === in_db) {
+            // back to what the database already has
+            delete changes[url];
+        }
+        else {
+            changes[url] = checkbox.checked;
+        }
+        update_indicators();
+    };
     new_src.type = "audio/mpeg";
     new_src.src = url;
     new_audio.controls = true;
-    new_audio.load();
     new_audio.appendChild(new_src);
     new_audio_item.className = "list-group-item";
     new_audio_item.appendChild(text);
     new_audio_item.appendChild(checkbox);
     new_audio_item.appendChild(new_audio);
     $("#input_samples").append(new_audio_item);
-    sample_map[url] = new_audio_item
 }
 
 function update() {
-    // send a request to the app asking to add or remove various files
+    // send a request to the app asking to add or remove only the samples that were changed
     let selected_samples = [];
     let unselected_samples = [];
 
-    for (let i=0; i < samples.length; ++i) {
-        let sample = samples[i];
-        let list_element = sample_map[sample['url']];
-        let checkbox = $(list_element.getElementsByTagName("input"));
-        if (checkbox.prop("checked")) {
-            selected_samples.push(sample['url']);
+    for (let url in changes) {
+        if (changes[url]) {
+            selected_samples.push(url);
         } else {
-            unselected_samples.push(sample['url']);
+            unselected_samples.push(url);
         }
     }
 
     let post_data = {
         'selected_samples': selected_samples,
-        'unselected_samples': unselected_samples
+        'unselected_samples': unselected_samples,
+        'dry_run': true
     };
+
+    // ask the server what would change, and only commit once that's confirmed
+    post_manage(post_data, function(diff) {
+        let message = 'Add ' + diff['additions'].length + ' samples' +
+            ' (' + diff['skipped_additions'].length + ' already in the database)\n' +
+            'Remove ' + diff['removals'].length + ' samples' +
+            ' (' + diff['skipped_removals'].length + ' not in the database)\n\n' +
+            'Commit these changes?';
+        if (!confirm(message)) {
+            return;
+        }
+
+        post_data['dry_run'] = false;
+        post_manage(post_data, function() {
+            // refresh the page once the request has finished
+            location.reload();
+        });
+    });
+}
+
+function post_manage(post_data, on_done) {
     let url = '/manage';
     let request = new XMLHttpRequest();
     request.open('POST', url, true);
     request.setRequestHeader('Content-Type', 'application/json;charset=UTF-8');
-    request.send(JSON.stringify(post_data));
-
-    // refresh the page once the request has finished
     request.onreadystatechange = function() {
-        location.reload();
-    }
+        if (request.readyState === XMLHttpRequest.DONE) {
+            on_done(JSON.parse(request.responseText));
+        }
+    };
+    request.send(JSON.stringify(post_data));
 }
 
 function download() {
-    let text = "";
-
-    for (let i=0; i < samples.length; ++i) {
-        let sample = samples[i];
-        let list_element = sample_map[sample['url']];
-        let checkbox = $(list_element.getElementsByTagName("input"));
-        if (checkbox.prop("checked")) {
-            text += sample['name'] + "\n";
+    // the samples in the database, with the uncommitted changes applied
+    $.get('/manage/index.txt').done(function(index) {
+        let names = {};
+        let lines = index.split("\n");
+        for (let i=0; i < lines.length; ++i) {
+            if (lines[i]) {
+                names[lines[i]] = true;
+            }
+        }
+        for (let url in changes) {
+            let name = url.substring(url.lastIndexOf('/') + 1);
+            if (changes[url]) {
+                names[name] = true;
+            }
+            else {
+                delete names[name];
+            }
+        }
+
+        let text = "";
+        for (let name in names) {
+            text += name + "\n";
         }
-    }
 
-    let element = document.createElement('a');
-    element.setAttribute('href', 'data:text/plain;charset=utf-8,' + encodeURIComponent(text));
-    element.setAttribute('download', "index.txt");
+        let element = document.createElement('a');
+        element.setAttribute('href', 'data:text/plain;charset=utf-8,' + encodeURIComponent(text));
+        element.setAttribute('download', "index.txt");
 
-    element.style.display = 'none';
-    document.body.appendChild(element);
+        element.style.display = 'none';
+        document.body.appendChild(element);
 
-    element.click();
+        element.click();
 
-    document.body.removeChild(element);
+        document.body.removeChild(element);
+    });
 }
@@ -0,0 +1,27 @@
+-- Statements that bring an existing database up to date with schema.sql.
+-- Every statement must be safe to run more than once.
+
+-- Index used to find the samples a labeler has not labeled yet
+create index if not exists responses_labeler_url on responses (labeler_id, url);
+
+-- Index used to count the responses to each sample
+create index if not exists responses_url on responses (url);
+
+-- Markers of each response's final_response. Fill it in for old responses with `flask backfill_markers`
+create table if not exists markers (
+  id integer primary key autoincrement,
+  response_id integer not null,
+  timestamp real not null, -- seconds from the start of the sample
+  size text,
+  CONSTRAINT key_response FOREIGN KEY (response_id) REFERENCES responses (id)
+);
+
+create index if not exists markers_response on markers (response_id);
+
+-- Audio fingerprints of samples, used to find duplicates when loading samples. Fill it in for samples loaded before
+-- it existed with `flask backfill_fingerprints`
+create table if not exists fingerprints (
+  url text not null primary key,
+  hashes blob not null, -- one little endian uint32 per frame, see sample_generator/fingerprint.py
+  CONSTRAINT key_url FOREIGN KEY (url) REFERENCES samples (url)
+);
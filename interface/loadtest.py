@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import argparse
+import csv
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+
+import numpy as np
+import requests
+
+
+def post_responses(base_url, sample_url, stop_time, latencies, errors):
+    """ POST trial responses as one labeler until stop_time, recording the latency of each request """
+    session = requests.Session()
+    session.cookies.set('labeler_id', str(uuid.uuid4()))
+    experiment_id = str(uuid.uuid4())
+    post_data = {
+        'metadata': {'assignment_id': 'LOAD_TEST'},
+        'experiment_id': experiment_id,
+        'sample': {'url': sample_url},
+        'response': {
+            'final_response': [{'timestamp': 1.5, 'size': 'large'}, {'timestamp': 0.5, 'size': 'small'}],
+            'edit_history': [{'type': 'add', 'id': 0, 'at': 0.5}, {'type': 'add', 'id': 1, 'at': 1.5}],
+            'duration_seconds': 30.0,
+        },
+    }
+
+    while time.time() < stop_time:
+        t0 = time.time()
+        try:
+            r = session.post(base_url + '/responses', json=post_data)
+            ok = r.status_code == 200
+        except requests.exceptions.RequestException:
+            ok = False
+        t1 = time.time()
+
+        if ok:
+            latencies.append(t1 - t0)
+        else:
+            errors.append(t1 - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser("load tests the /responses endpoint of a running labeling server.",
+                                     epilog="Do not point this at the live server, it writes fake responses.")
+    parser.add_argument('base_url', help='where the server is running (EX: http://localhost:5000)')
+    parser.add_argument('--threads', '-t', type=int, default=16, help='number of labelers posting at once')
+    parser.add_argument('--duration', '-d', type=float, default=10, help='seconds to run for')
+    parser.add_argument('--sample-url', default='https://mprlab.wpi.edu/load_test/sample.mp3',
+                        help='sample url to put in the fake responses')
+    parser.add_argument('--label', '-l', default='', help='name for this run in the record (EX: before, after)')
+    parser.add_argument('--record', '-r', help='csv file to append the results to')
+
+    args = parser.parse_args()
+
+    base_url = args.base_url.rstrip('/')
+    latencies = []
+    errors = []
+    start_time = time.time()
+    stop_time = start_time + args.duration
+    threads = []
+    for _ in range(args.threads):
+        t = threading.Thread(target=post_responses, args=(base_url, args.sample_url, stop_time, latencies, errors))
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start_time
+
+    posts_per_second = len(latencies) / elapsed
+    if len(latencies) > 0:
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1000
+    else:
+        p50, p90, p99 = np.nan, np.nan, np.nan
+
+    print("{:>10s}, {:>8s}, {:>8s}, {:>10s}, {:>10s}, {:>10s}".format(
+        "posts/s", "ok", "failed", "p50 (ms)", "p90 (ms)", "p99 (ms)"))
+    print("{:10.1f}, {:8d}, {:8d}, {:10.1f}, {:10.1f}, {:10.1f}".format(
+        posts_per_second, len(latencies), len(errors), p50, p90, p99))
+
+    if args.record:
+        new_file = not os.path.isfile(args.record)
+        with open(args.record, 'a') as record:
+            writer = csv.writer(record)
+            if new_file:
+                writer.writerow(['stamp', 'label', 'threads', 'duration', 'posts_per_second', 'ok', 'failed',
+                                 'p50_ms', 'p90_ms', 'p99_ms'])
+            writer.writerow([datetime.now(), args.label, args.threads, args.duration, posts_per_second,
+                             len(latencies), len(errors), p50, p90, p99])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+import unittest
+from unittest import mock
+
+from interface.interface.assignment import SampleAssigner
+
+
+def make_assigner(counts, **kwargs):
+    assigner = SampleAssigner(seed=0, **kwargs)
+    assigner.load(counts)
+    return assigner
+
+
+class TestSampleAssigner(unittest.TestCase):
+
+    def test_least_covered_first(self):
+        counts = {'url{:d}'.format(i): i % 4 for i in range(40)}
+        assigner = make_assigner(counts)
+        urls = assigner.assign('e1', 10, 'l1')
+        self.assertEqual([counts[url] for url in urls], [0] * 10)
+        urls = assigner.assign('e1', 10, 'l1')
+        self.assertEqual([counts[url] for url in urls], [1] * 10)
+
+        # the leases count as coverage, so the samples with no responses are at 1 now, and those with one are at 2
+        # like the ones with two
+        urls = assigner.assign('e2', 20, 'l2')
+        coverage = sorted(counts[url] for url in urls)
+        self.assertEqual(coverage[:10], [0] * 10)
+        self.assertTrue(all(count in (1, 2) for count in coverage[10:]))
+
+    def test_ties_shuffled(self):
+        counts = dict.fromkeys(('url{:d}'.format(i) for i in range(20)), 0)
+        urls = make_assigner(counts).assign('e1', 20, 'l1')
+        self.assertEqual(sorted(urls), sorted(counts))
+        self.assertNotEqual(urls, sorted(urls))
+
+    def test_never_labeled_twice(self):
+        counts = {'url{:d}'.format(i): 0 for i in range(30)}
+        for max_skips in [0, 1024]:
+            assigner = make_assigner(counts, max_skips=max_skips)
+            labeled = set(['url{:d}'.format(i) for i in range(10)])
+            assigner.set_labeled('l1', labeled)
+            self.assertEqual(assigner.num_available('l1'), 20)
+
+            urls = assigner.assign('e1', 5, 'l1')
+            self.assertFalse(labeled & set(urls))
+            for url in urls:
+                assigner.record_response('e1', url, 'l1')
+                labeled.add(url)
+
+            # less covered than what's left, but labeled by l1 in the first experiment
+            urls = assigner.assign('e2', 30, 'l1')
+            self.assertEqual(len(urls), 15)
+            self.assertFalse(labeled & set(urls))
+            self.assertEqual(len(assigner.assign('e3', 10, 'l2')), 10)
+
+    def test_same_experiment_not_twice(self):
+        assigner = make_assigner({'a': 0, 'b': 0, 'c': 5})
+        self.assertEqual(sorted(assigner.assign('e1', 2, 'l1')), ['a', 'b'])
+        self.assertEqual(assigner.assign('e1', 2, 'l1'), ['c'])
+        self.assertEqual(assigner.assign('e1', 2, 'l1'), [])
+
+    def test_response_to_lease_counts_once(self):
+        assigner = make_assigner({'a': 0, 'b': 1})
+        self.assertEqual(assigner.assign('e1', 1, 'l1'), ['a'])
+        # answers the lease, which already counted, so a stays at 1
+        assigner.record_response('e1', 'a', 'l1')
+        # not leased, so b goes up to 2
+        assigner.record_response('e9', 'b', 'l9')
+        self.assertEqual(assigner.assign('e2', 1, 'l2'), ['a'])
+
+    def test_lease_expiry(self):
+        with mock.patch('interface.interface.assignment.time.time') as now:
+            now.return_value = 1000.0
+            assigner = make_assigner({'a': 0, 'b': 1, 'c': 1}, lease_seconds=60)
+            self.assertEqual(assigner.assign('e1', 1, 'l1'), ['a'])
+            # a is leased, so it counts as covered as b and c
+            self.assertEqual(sorted(assigner.assign('e2', 3, 'l2')), ['a', 'b', 'c'])
+
+            now.return_value = 1000.0 + 61
+            # both leases of a ran out, so it's the least covered again
+            self.assertEqual(assigner.assign('e3', 1, 'l3'), ['a'])
+
+            # a late response to an expired lease still counts once
+            assigner.record_response('e1', 'a', 'l1')
+            self.assertEqual(sorted(assigner.assign('e4', 2, 'l4')), ['b', 'c'])
+
+    def test_target_responses(self):
+        assigner = make_assigner({'a': 0, 'b': 1, 'c': 2}, target_responses=2)
+        self.assertEqual(assigner.num_available('l1'), 2)
+        self.assertEqual(sorted(assigner.assign('e1', 3, 'l1')), ['a', 'b'])
+        # b is at the target while leased to e1
+        self.assertEqual(assigner.assign('e2', 3, 'l2'), ['a'])
+        self.assertEqual(assigner.assign('e3', 3, 'l3'), [])
+        assigner.record_response('e1', 'b', 'l1')
+        assigner.record_response('e1', 'a', 'l1')
+        assigner.record_response('e2', 'a', 'l2')
+        self.assertEqual(assigner.num_available('l4'), 0)
+        self.assertEqual(assigner.assign('e4', 3, 'l4'), [])
+
+    def test_reload(self):
+        assigner = make_assigner({'a': 0})
+        assigner.invalidate()
+        self.assertFalse(assigner.loaded)
+        assigner.load({'a': 3, 'b': 0})
+        self.assertTrue(assigner.loaded)
+        self.assertEqual(assigner.assign('e1', 1, 'l1'), ['b'])
+
+    def test_labeled_reloaded(self):
+        with mock.patch('interface.interface.assignment.time.time') as now:
+            now.return_value = 1000.0
+            assigner = make_assigner({'a': 0}, labeled_seconds=600)
+            self.assertTrue(assigner.needs_labeled('l1'))
+            assigner.set_labeled('l1', [])
+            self.assertFalse(assigner.needs_labeled('l1'))
+            now.return_value = 1000.0 + 601
+            self.assertTrue(assigner.needs_labeled('l1'))
+
+    def test_many_stale_entries(self):
+        # lots of count changes leave stale heap entries, which must never be handed out
+        counts = {'url{:d}'.format(i): 0 for i in range(50)}
+        assigner = make_assigner(counts)
+        for i in range(200):
+            urls = assigner.assign('e{:d}'.format(i), 5, 'l{:d}'.format(i))
+            self.assertEqual(len(urls), 5)
+            for url in urls:
+                assigner.record_response('e{:d}'.format(i), url, 'l{:d}'.format(i))
+                counts[url] += 1
+        self.assertEqual(max(counts.values()) - min(counts.values()), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
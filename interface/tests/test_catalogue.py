@@ -0,0 +1,155 @@
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+from interface.interface import interface
+from interface.interface.catalogue import SampleCatalogue
+
+URL_PREFIX = 'https://example.com/'
+
+
+class CountingCatalogue(SampleCatalogue):
+
+    def __init__(self, *args, **kwargs):
+        super(CountingCatalogue, self).__init__(*args, **kwargs)
+        self.listed = []
+
+    def _list_subdir(self, subdir, full_subdir):
+        self.listed.append(subdir)
+        return super(CountingCatalogue, self)._list_subdir(subdir, full_subdir)
+
+
+class TestSampleCatalogue(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.mtime = 1000000000
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def touch(self, subdir, name):
+        directory = os.path.join(self.root, subdir)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        open(os.path.join(directory, name), 'w').close()
+        self.bump(subdir)
+
+    def bump(self, subdir):
+        # set the mtime explicitly, two changes in a row can get the same one from a coarse filesystem clock
+        self.mtime += 1
+        os.utime(os.path.join(self.root, subdir), (self.mtime, self.mtime))
+
+    def names(self, catalogue):
+        return [sample['name'] for sample in catalogue.samples()]
+
+    def test_listing(self):
+        self.touch('b', '2.mp3')
+        self.touch('a', '1.mp3')
+        self.touch('a', 'notes.txt')
+        os.makedirs(os.path.join(self.root, 'a', 'nested.mp3'))
+        self.bump('a')
+        catalogue = SampleCatalogue(self.root, URL_PREFIX)
+        samples = catalogue.samples()
+        self.assertEqual([sample['url'] for sample in samples], [URL_PREFIX + 'a/1.mp3', URL_PREFIX + 'b/2.mp3'])
+
+    def test_refresh(self):
+        self.touch('a', '1.mp3')
+        self.touch('b', '2.mp3')
+        catalogue = CountingCatalogue(self.root, URL_PREFIX)
+        self.assertEqual(self.names(catalogue), ['1.mp3', '2.mp3'])
+        self.assertEqual(sorted(catalogue.listed), ['a', 'b'])
+
+        # nothing changed, so nothing is listed again and the same list comes back
+        catalogue.listed = []
+        samples = catalogue.samples()
+        self.assertIs(catalogue.samples(), samples)
+        self.assertEqual(catalogue.listed, [])
+
+        # only the subdirectory that changed is listed again
+        self.touch('b', '3.mp3')
+        self.assertEqual(self.names(catalogue), ['1.mp3', '2.mp3', '3.mp3'])
+        self.assertEqual(catalogue.listed, ['b'])
+
+        os.remove(os.path.join(self.root, 'a', '1.mp3'))
+        self.bump('a')
+        self.assertEqual(self.names(catalogue), ['2.mp3', '3.mp3'])
+
+        # new and removed subdirectories
+        self.touch('c', '4.mp3')
+        self.assertEqual(self.names(catalogue), ['2.mp3', '3.mp3', '4.mp3'])
+        shutil.rmtree(os.path.join(self.root, 'b'))
+        self.assertEqual(self.names(catalogue), ['4.mp3'])
+
+
+class TestManageSamples(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp_dir, 'samples')
+        os.makedirs(os.path.join(self.root, 'new'))
+        for i in range(25):
+            open(os.path.join(self.root, 'new', 'sample{:02d}.mp3'.format(i)), 'w').close()
+
+        database = os.path.join(self.tmp_dir, 'test.db')
+        with sqlite3.connect(database) as db, interface.app.open_resource('schema.sql', mode='r') as schema:
+            db.executescript(schema.read())
+            # every third sample is in the samples table
+            db.executemany('INSERT INTO samples (url) VALUES (?)',
+                           [(URL_PREFIX + 'new/sample{:02d}.mp3'.format(i),) for i in range(0, 25, 3)])
+        db.close()
+
+        patches = [mock.patch.dict(interface.app.config, {'DATABASE': database}),
+                   mock.patch.object(interface, 'catalogue', SampleCatalogue(self.root, URL_PREFIX))]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.client = interface.app.test_client()
+        self.database = database
+
+    def tearDown(self):
+        pool = interface._pools.pop(self.database, None)
+        if pool is not None:
+            pool.close_all()
+        shutil.rmtree(self.tmp_dir)
+
+    def page(self, **params):
+        response = self.client.get('/manage/samples', query_string=params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data)
+
+    def test_paging(self):
+        pages = [self.page(offset=offset, limit=10) for offset in (0, 10, 20, 30)]
+        self.assertEqual([page['total'] for page in pages], [25] * 4)
+        self.assertEqual([page['offset'] for page in pages], [0, 10, 20, 30])
+        self.assertEqual([len(page['samples']) for page in pages], [10, 10, 5, 0])
+        samples = [sample for page in pages for sample in page['samples']]
+        self.assertEqual([sample['name'] for sample in samples], ['sample{:02d}.mp3'.format(i) for i in range(25)])
+        self.assertEqual([sample['in_db'] for sample in samples], [i % 3 == 0 for i in range(25)])
+
+    def test_status_and_filter(self):
+        page = self.page(status='in_db', offset=2, limit=3)
+        self.assertEqual(page['total'], 9)
+        self.assertEqual([sample['name'] for sample in page['samples']],
+                         ['sample06.mp3', 'sample09.mp3', 'sample12.mp3'])
+        page = self.page(status='not_in_db', limit=100)
+        self.assertEqual(page['total'], 16)
+        self.assertFalse(any(sample['in_db'] for sample in page['samples']))
+        page = self.page(filter='sample1')
+        self.assertEqual(page['total'], 10)
+
+    def test_new_sample(self):
+        self.assertEqual(self.page()['total'], 25)
+        open(os.path.join(self.root, 'new', 'sample99.mp3'), 'w').close()
+        os.utime(os.path.join(self.root, 'new'), (2000000000, 2000000000))
+        page = self.page(offset=25)
+        self.assertEqual(page['total'], 26)
+        self.assertEqual([sample['name'] for sample in page['samples']], ['sample99.mp3'])
+
+
+if __name__ == '__main__':
+    unittest.main()
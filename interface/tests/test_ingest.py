@@ -0,0 +1,114 @@
+import json
+import os
+import queue
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from interface.interface.ingest import ResponseWriter
+from interface.interface.pool import ConnectionPool
+
+
+class TestResponseWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.database = os.path.join(self.tmp_dir, 'test.db')
+        self.fallback_file = os.path.join(self.tmp_dir, 'unwritten.jsonl')
+        with sqlite3.connect(self.database) as db:
+            db.execute('CREATE TABLE t (x integer)')
+        db.close()
+        self.pool = ConnectionPool(self.database, size=2)
+        self.batches = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def tearDown(self):
+        self.pool.close_all()
+        shutil.rmtree(self.tmp_dir)
+
+    def write_batch(self, db, rows):
+        self.release.wait()
+        self.batches.append(list(rows))
+        for row in rows:
+            if row == 'bad':
+                raise ValueError("can't write {}".format(row))
+            db.execute('INSERT INTO t VALUES (?)', [row])
+
+    def writer(self, **kwargs):
+        return ResponseWriter(self.pool, self.write_batch, max_retries=2, fallback_file=self.fallback_file, **kwargs)
+
+    def committed(self):
+        # read with a connection of our own, so only what's committed shows up
+        with sqlite3.connect(self.database) as db:
+            rows = [row[0] for row in db.execute('SELECT x FROM t ORDER BY x')]
+        db.close()
+        return rows
+
+    def test_flush(self):
+        writer = self.writer(max_batch=10)
+        # hold the writer thread so the rows queue up and go in batches
+        self.release.clear()
+        for i in range(25):
+            writer.submit(i)
+        self.release.set()
+        writer.flush()
+        self.assertEqual(self.committed(), list(range(25)))
+        self.assertEqual(writer.depth(), 0)
+        self.assertTrue(all(len(batch) <= 10 for batch in self.batches))
+        self.assertLess(len(self.batches), 25)
+        writer.stop()
+
+    def test_stop(self):
+        writer = self.writer()
+        self.release.clear()
+        for i in range(5):
+            writer.submit(i)
+        threading.Timer(0.05, self.release.set).start()
+        writer.stop()
+        self.assertEqual(self.committed(), list(range(5)))
+        with self.assertRaises(queue.Full):
+            writer.submit(5)
+        # stopping twice is harmless, like when atexit runs after a manual stop
+        writer.stop()
+
+    def test_full(self):
+        writer = self.writer(max_queue=2, max_batch=1, put_timeout=0.05)
+        self.release.clear()
+        writer.submit(0)
+        # the writer thread may have taken the first row already, so fill the queue behind it
+        with self.assertRaises(queue.Full):
+            for i in range(1, 4):
+                writer.submit(i)
+        self.release.set()
+        writer.stop()
+
+    def test_failed_batch(self):
+        writer = self.writer(max_batch=1)
+        writer.submit(1)
+        writer.submit('bad')
+        writer.flush()
+        # the thread carries on with the rows after the one it gave up on
+        writer.submit(2)
+        writer.flush()
+        self.assertEqual(self.committed(), [1, 2])
+        with open(self.fallback_file, 'r') as infile:
+            self.assertEqual([json.loads(line) for line in infile], ['bad'])
+        # tried max_retries times
+        self.assertEqual(self.batches.count(['bad']), 2)
+        writer.stop()
+
+    def test_failed_fallback(self):
+        # neither the database nor the fallback file can be written, the thread still keeps going
+        self.fallback_file = os.path.join(self.tmp_dir, 'missing', 'unwritten.jsonl')
+        writer = self.writer(max_batch=1)
+        writer.submit('bad')
+        writer.submit(3)
+        writer.stop()
+        self.assertEqual(self.committed(), [3])
+
+
+if __name__ == '__main__':
+    unittest.main()
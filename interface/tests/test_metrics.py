@@ -0,0 +1,32 @@
+import json
+import unittest
+from unittest import mock
+
+from interface.interface import interface
+
+
+class TestMetricsPage(unittest.TestCase):
+
+    def get(self, token=None, **config):
+        headers = {interface.METRICS_TOKEN_HEADER: token} if token is not None else {}
+        with mock.patch.dict(interface.app.config, config):
+            # the test client's requests come from 127.0.0.1, like every request behind the reverse proxy
+            return interface.app.test_client().get('/metrics', headers=headers)
+
+    def test_off_without_token(self):
+        self.assertEqual(self.get(METRICS_TOKEN=None).status_code, 404)
+        self.assertEqual(self.get('', METRICS_TOKEN=None).status_code, 404)
+        self.assertEqual(self.get('', METRICS_TOKEN='').status_code, 404)
+
+    def test_token(self):
+        self.assertEqual(self.get(METRICS_TOKEN='secret').status_code, 404)
+        self.assertEqual(self.get('wrong', METRICS_TOKEN='secret').status_code, 404)
+        response = self.get('secret', METRICS_TOKEN='secret')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertIn('routes', data)
+        self.assertIn('pools', data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+from interface.interface.pool import ConnectionPool, PoolTimeout
+
+
+class FlakyConnection(sqlite3.Connection):
+    """ a connection whose rollback fails once fail_rollback is set, like one whose database stays locked """
+    fail_rollback = False
+
+    def rollback(self):
+        if self.fail_rollback:
+            raise sqlite3.OperationalError("database is locked")
+        super(FlakyConnection, self).rollback()
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.database = os.path.join(self.tmp_dir, 'test.db')
+        self.pools = []
+
+    def tearDown(self):
+        for pool in self.pools:
+            pool.close_all()
+        shutil.rmtree(self.tmp_dir)
+
+    def pool(self, **kwargs):
+        pool = ConnectionPool(self.database, **kwargs)
+        self.pools.append(pool)
+        return pool
+
+    def test_reuse(self):
+        pool = self.pool(size=2)
+        conn = pool.acquire()
+        self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        pool.release(conn)
+        self.assertIs(pool.acquire(), conn)
+        self.assertEqual(pool.num_open(), 1)
+        pool.release(conn)
+        self.assertEqual(pool.num_idle(), 1)
+
+    def test_rollback_on_release(self):
+        pool = self.pool(size=1)
+        conn = pool.acquire()
+        conn.execute('CREATE TABLE t (x integer)')
+        conn.commit()
+        conn.execute('INSERT INTO t VALUES (1)')
+        pool.release(conn)
+        conn = pool.acquire()
+        self.assertFalse(conn.in_transaction)
+        self.assertEqual(conn.execute('SELECT COUNT(*) FROM t').fetchone()[0], 0)
+        pool.release(conn)
+
+    def test_exhausted(self):
+        pool = self.pool(size=2, busy_timeout_ms=100)
+        conns = [pool.acquire(), pool.acquire()]
+        t0 = time.monotonic()
+        with self.assertRaises(PoolTimeout):
+            pool.acquire()
+        self.assertGreaterEqual(time.monotonic() - t0, 0.09)
+        self.assertEqual(pool.num_open(), 2)
+
+        # a waiter gets the connection released while it waits
+        threading.Timer(0.05, pool.release, [conns[0]]).start()
+        self.assertIs(pool.acquire(), conns[0])
+        for conn in conns:
+            pool.release(conn)
+
+    def test_failed_rollback(self):
+        pool = self.pool(size=1, busy_timeout_ms=1000, factory=FlakyConnection)
+        conn = pool.acquire()
+        conn.execute('CREATE TABLE t (x integer)')
+        conn.execute('INSERT INTO t VALUES (1)')
+        conn.fail_rollback = True
+
+        # a request waiting for the only connection gets a new one once the broken one is dropped
+        acquired = []
+        waiter = threading.Thread(target=lambda: acquired.append(pool.acquire()))
+        waiter.start()
+        time.sleep(0.05)
+        pool.release(conn)
+        waiter.join(2)
+        self.assertEqual(len(acquired), 1)
+        self.assertIsNot(acquired[0], conn)
+        self.assertEqual(pool.num_open(), 1)
+        with self.assertRaises(sqlite3.ProgrammingError):
+            conn.execute('SELECT 1')
+        pool.release(acquired[0])
+        self.assertEqual(pool.num_idle(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
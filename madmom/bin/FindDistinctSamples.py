@@ -1,85 +1,223 @@
 #!/usr/bin/env python
 
 import argparse
-from time import sleep
+import csv
 import os
 import sys
-import wave
+from time import sleep
 
 import numpy as np
-import pyaudio
+
+from madmom.audio.chroma import PitchClassProfile
+from madmom.audio.signal import FramedSignal, Signal
+from madmom.audio.spectrogram import LogarithmicFilteredSpectrogram, Spectrogram
+from madmom.features.onsets import superflux
+
+AUDIO_EXTENSIONS = ('.wav', '.mp3', '.flac')
+SAMPLE_RATE = 44100
+CHROMA_FPS = 10
+CHROMA_FRAME_SIZE = 8192
+ONSET_FPS = 100
+ONSET_FRAME_SIZE = 2048
+# the onset strength autocorrelation up to MAX_LAG_S is summarised in this many bins. Its peaks are the periods
+# the rhythm repeats at.
+NUM_LAG_BINS = 20
+MAX_LAG_S = 2.0
+RMS_LEVEL = 0.1
+PAIR_FIELDS = ['sample_a', 'sample_b', 'similarity', 'decision']
+
+
+def embed(full_path):
+    """
+    A fixed length summary of a sample's harmony and rhythm.
+
+    :param full_path: audio file
+    :return: float array, the mean and standard deviation of the sample's chroma, followed by the autocorrelation of
+             its onset strength. Nothing in it depends on the sample's loudness or length.
+    """
+    signal = Signal(full_path, sample_rate=SAMPLE_RATE, num_channels=1, dtype=np.float32)
+    # the onset strength is taken from a log spectrogram, so bring every sample to the same level first
+    rms = np.sqrt(np.mean(np.square(signal)))
+    signal = Signal(signal * (RMS_LEVEL / max(rms, 1e-10)), sample_rate=SAMPLE_RATE)
+
+    frames = FramedSignal(signal, frame_size=CHROMA_FRAME_SIZE, fps=CHROMA_FPS)
+    chroma = np.asarray(PitchClassProfile(Spectrogram(frames)))
+    chroma = chroma / np.maximum(chroma.sum(axis=1, keepdims=True), 1e-10)
+
+    frames = FramedSignal(signal, frame_size=ONSET_FRAME_SIZE, fps=ONSET_FPS)
+    onsets = np.asarray(superflux(LogarithmicFilteredSpectrogram(frames, num_bands=24)), dtype=np.float64)
+    onsets -= onsets.mean()
+    num_lags = int(MAX_LAG_S * ONSET_FPS)
+    autocorrelation = np.correlate(onsets, onsets, mode='full')[len(onsets):len(onsets) + num_lags]
+    autocorrelation /= max(np.dot(onsets, onsets), 1e-10)
+    lag_bins = np.array_split(autocorrelation, NUM_LAG_BINS)
+
+    return np.concatenate([chroma.mean(axis=0), chroma.std(axis=0), [lag_bin.mean() for lag_bin in lag_bins]])
+
+
+def load_embeddings(samples_dir, files, cache_file):
+    """
+    Embeds every file, reusing the ones in cache_file whose sample hasn't changed since.
+
+    :return: (len(files), embedding size) array
+    """
+    cached = {}
+    if cache_file is not None and os.path.exists(cache_file):
+        cache = np.load(cache_file)
+        for name, mtime, embedding in zip(cache['names'], cache['mtimes'], cache['embeddings']):
+            cached[str(name)] = (mtime, embedding)
+
+    mtimes = [os.stat(os.path.join(samples_dir, name)).st_mtime_ns for name in files]
+    embeddings = []
+    num_computed = 0
+    for name, mtime in zip(files, mtimes):
+        if name in cached and cached[name][0] == mtime:
+            embeddings.append(cached[name][1])
+            continue
+        embeddings.append(embed(os.path.join(samples_dir, name)))
+        num_computed += 1
+        if num_computed % 100 == 0:
+            print("embedded {:d} samples".format(num_computed))
+    embeddings = np.array(embeddings)
+    print("embedded {:d} samples, {:d} from {}".format(num_computed, len(files) - num_computed, cache_file))
+
+    if cache_file is not None and num_computed > 0:
+        np.savez(cache_file, names=np.array(files), mtimes=np.array(mtimes, dtype=np.int64), embeddings=embeddings)
+    return embeddings
+
+
+def normalize(embeddings):
+    """
+    Standardizes every dimension over all the samples, so that similarity is measured against the rest of the
+    collection, then scales each row to unit length so that their dot products are cosine similarities. The chroma
+    and the onset dimensions count the same in total.
+    """
+    standardized = (embeddings - embeddings.mean(axis=0)) / np.maximum(embeddings.std(axis=0), 1e-10)
+    num_chroma = embeddings.shape[1] - NUM_LAG_BINS
+    standardized[:, :num_chroma] /= np.sqrt(num_chroma)
+    standardized[:, num_chroma:] /= np.sqrt(NUM_LAG_BINS)
+    norms = np.linalg.norm(standardized, axis=1, keepdims=True)
+    return (standardized / np.maximum(norms, 1e-10)).astype(np.float32)
+
+
+def similar_pairs(vectors, min_similarity, batch_size=1024, matrix=None):
+    """
+    Finds every pair of samples at least min_similarity apart, a block of rows of the similarity matrix at a time so
+    the whole matrix never has to be in memory.
+
+    :param vectors: unit length rows
+    :param matrix: optional (n, n) array the full similarity matrix is written into
+    :return: list of (similarity, i, j) with i < j, most similar first
+    """
+    n = len(vectors)
+    pairs = []
+    for start in range(0, n, batch_size):
+        block = vectors[start:start + batch_size].dot(vectors.T)
+        if matrix is not None:
+            matrix[start:start + batch_size] = block
+        rows, cols = np.nonzero(block >= min_similarity)
+        rows += start
+        upper = rows < cols
+        pairs.extend(zip(block[rows[upper] - start, cols[upper]].tolist(), rows[upper].tolist(), cols[upper].tolist()))
+    pairs.sort(reverse=True)
+    return pairs
 
 
 def play(full_path):
-    wav_file = wave.open(full_path, 'rb')
+    import pyaudio
+
+    signal = Signal(full_path, dtype=np.int16)
     p = pyaudio.PyAudio()
-    stream = p.open(format=p.get_format_from_width(wav_file.getsampwidth()),
-                    channels=wav_file.getnchannels(),
-                    rate=wav_file.getframerate(),
+    stream = p.open(format=pyaudio.paInt16,
+                    channels=signal.num_channels,
+                    rate=signal.sample_rate,
                     output=True)
 
-    chunk = 1024
-    data = wav_file.readframes(chunk)
-    while len(data) > 0:
-        data = wav_file.readframes(chunk)
-        stream.write(data)
+    chunk = 1024 * signal.num_channels
+    data = np.ascontiguousarray(signal).ravel()
+    for start in range(0, len(data), chunk):
+        stream.write(data[start:start + chunk].tobytes())
 
     stream.close()
+    p.terminate()
+
+
+def listen(full_path_a, full_path_b, name_a, name_b):
+    """ plays two samples and asks how similar they are, 'r' to play them again """
+    while True:
+        play(full_path_a)
+        sleep(0.2)
+        play(full_path_b)
+        while True:
+            inp = input("Similarity between {} and {}? ".format(name_a, name_b))
+            if inp == 'r':
+                break
+            try:
+                return int(inp)
+            except ValueError:
+                continue
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('samples_dir', help='samples directory')
+    parser.add_argument('--threshold', '-t', type=float, default=0.9,
+                        help='pairs with at least this cosine similarity are too similar')
+    parser.add_argument('--borderline', '-b', type=float, default=0.75,
+                        help='pairs between this and the threshold are borderline')
+    parser.add_argument('--listen', '-l', action='store_true',
+                        help='listen to the borderline pairs and rate them, 5 or more means too similar')
+    parser.add_argument('--embeddings', '-e', help='npz file to keep the embeddings in between runs')
+    parser.add_argument('--pairs', '-p', default='to_remove.csv', help='csv file for the pairs that are too similar')
+    parser.add_argument('--matrix', '-m', help='also save the full similarity matrix to this file, n x n')
+    parser.add_argument('--batch-size', type=int, default=1024, help='rows of the similarity matrix per block')
     args = parser.parse_args()
 
     if not os.path.exists(args.samples_dir):
         print("Samples directory does not exist: ", args.samples_dir)
+        return 1
+    if args.borderline > args.threshold:
+        parser.error("--borderline must not be above --threshold")
 
-    # create a list of pairs of samples
-    files = os.listdir(args.samples_dir)
+    files = sorted(name for name in os.listdir(args.samples_dir) if name.lower().endswith(AUDIO_EXTENSIONS))
     n = len(files)
-    cov = np.zeros((n, n))
-    p = np.random.permutation(n)
-    q = np.random.permutation(n)
-    file_indeces = []
-    for p_ in p:
-        for q_ in q:
-            if p_ != q_:
-                file_indeces.append((p_, q_))
-    np.random.shuffle(file_indeces)
-
-    # sub sample so this doesn't take hours
-    samples = 50
-    to_remove = []
-
-    for i, j in file_indeces[:samples]:
-        full_path_a = os.path.join(args.samples_dir, files[i])
-        full_path_b = os.path.join(args.samples_dir, files[j])
+    if n < 2:
+        print("Need at least two samples, found {:d}".format(n))
+        return 1
 
-        while True:
-            play(full_path_a)
-            sleep(0.2)
-            play(full_path_b)
-            while True:
-                inp = input("Similarity between {} and {}? ".format(files[i], files[j]))
-                if inp == 'r':
-                    break
-                try:
-                    s = int(inp)
-                except ValueError:
-                    continue
-                break
-            if inp != 'r':
-                break
+    vectors = normalize(load_embeddings(args.samples_dir, files, args.embeddings))
+    matrix = np.zeros((n, n), dtype=np.float32) if args.matrix else None
+    pairs = similar_pairs(vectors, args.borderline, args.batch_size, matrix)
 
-        s = int(inp)
+    to_remove = []
+    num_borderline = 0
+    for similarity, i, j in pairs:
+        if similarity >= args.threshold:
+            to_remove.append((files[i], files[j], similarity, 'auto'))
+            continue
+
+        num_borderline += 1
+        if not args.listen:
+            to_remove.append((files[i], files[j], similarity, 'borderline'))
+            continue
+        s = listen(os.path.join(args.samples_dir, files[i]), os.path.join(args.samples_dir, files[j]),
+                   files[i], files[j])
         if s >= 5:
-            to_remove.append((files[i], files[j]))
-        cov[i][j] = s
+            to_remove.append((files[i], files[j], similarity, 'confirmed'))
+
+    with open(args.pairs, 'w', newline='') as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(PAIR_FIELDS)
+        for name_a, name_b, similarity, decision in to_remove:
+            writer.writerow([name_a, name_b, '{:.4f}'.format(similarity), decision])
+
+    if matrix is not None:
+        np.savetxt(args.matrix, matrix, fmt='%.4f')
 
-    print(cov)
-    print(to_remove)
-    np.savetxt("cov.csv", cov)
+    print("{:d} samples, {:d} pairs above {:.2f}, {:d} borderline".format(
+        n, len(pairs) - num_borderline, args.threshold, num_borderline))
+    for name_a, name_b, similarity, decision in to_remove:
+        print("{:.3f} {:s} {:s} {:s}".format(similarity, decision, name_a, name_b))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,372 @@
+"""
+Datasets of network input features and labels, stored in shards.
+
+A dataset is a directory with an index.json and, for every shard of up to
+shard_size examples, the files <shard>.x.npy (frames, features) and
+<shard>.labels.npy (frames,) with the frames of all the shard's examples one
+after the other, <shard>.offsets.npy where example i is frames offsets[i] to
+offsets[i + 1], and <shard>.names.npy. Examples can have any number of
+frames. The writer keeps only the current shard in memory, and the reader
+memory-maps the shards, so neither needs the whole dataset to fit in memory.
+"""
+
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+INDEX_FILENAME = 'index.json'
+FORMAT_VERSION = 2
+DTYPES = ['float16', 'float32']
+
+
+def _save_npy(filename, array):
+    tmp_file = filename + '.tmp'
+    with open(tmp_file, 'wb') as outfile:
+        np.save(outfile, array)
+    os.replace(tmp_file, filename)
+
+
+def pad_batch(xs, labels, dtype=np.float32):
+    """
+    Pads examples of different lengths with zeros to the length of the
+    longest.
+
+    Parameters
+    ----------
+    xs : list of numpy arrays
+        Features of each example, (frames, features).
+    labels : list of numpy arrays
+        Labels of each example, one per frame.
+
+    Returns
+    -------
+    x : numpy array
+        (examples, frames, features)
+    labels : numpy array
+        (examples, frames)
+    mask : numpy array
+        (examples, frames), 1 for the frames of the examples and 0 for the
+        padding
+    """
+    max_len = max(len(x) for x in xs) if len(xs) > 0 else 0
+    num_features = xs[0].shape[1] if len(xs) > 0 else 0
+    x_batch = np.zeros((len(xs), max_len, num_features), dtype=dtype)
+    labels_batch = np.zeros((len(xs), max_len), dtype=np.float32)
+    mask = np.zeros((len(xs), max_len), dtype=np.float32)
+    for i, (x, example_labels) in enumerate(zip(xs, labels)):
+        x_batch[i, :len(x)] = x
+        labels_batch[i, :len(x)] = example_labels
+        mask[i, :len(x)] = 1
+    return x_batch, labels_batch, mask
+
+
+class ShardedDatasetWriter(object):
+    """
+    Writes a dataset one example at a time.
+
+    Parameters
+    ----------
+    directory : str
+        Directory to write the dataset to, created if needed.
+    shard_size : int
+        Number of examples per shard.
+    dtype : str
+        'float16' or 'float32', what the features are stored as. Labels are
+        always float32.
+    """
+
+    def __init__(self, directory, shard_size=256, dtype='float16'):
+        if dtype not in DTYPES:
+            raise ValueError("dtype must be one of {}, not {}".format(
+                DTYPES, dtype))
+        self.directory = directory
+        self.shard_size = shard_size
+        self.dtype = dtype
+        self.num_features = None
+        self._x = []
+        self._labels = []
+        self._names = []
+        self._shards = []
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def __len__(self):
+        num_written = sum(shard['num_examples'] for shard in self._shards)
+        return num_written + len(self._x)
+
+    def add(self, x, labels, name):
+        """
+        Parameters
+        ----------
+        x : numpy array
+            Features, (frames, features). Examples can have any number of
+            frames, but the same number of features.
+        labels : numpy array
+            One label per frame.
+        name : str
+            Name of the sample the example comes from.
+        """
+        if x.ndim != 2:
+            raise ValueError("examples need to be (frames, features), got "
+                             "shape {}".format(x.shape))
+        if self.num_features is None:
+            self.num_features = x.shape[1]
+        if x.shape[1] != self.num_features:
+            raise ValueError("examples need {} features, got shape "
+                             "{}".format(self.num_features, x.shape))
+        if len(labels) != len(x):
+            raise ValueError("{} labels for {} frames".format(len(labels),
+                                                              len(x)))
+        self._x.append(np.asarray(x, dtype=self.dtype))
+        self._labels.append(np.asarray(labels, dtype=np.float32))
+        self._names.append(name)
+        if len(self._x) >= self.shard_size:
+            self._flush()
+
+    def _flush(self):
+        if len(self._x) == 0:
+            return
+        shard_name = 'shard-{:05d}'.format(len(self._shards))
+        prefix = os.path.join(self.directory, shard_name)
+        offsets = np.concatenate([[0], np.cumsum([len(x) for x in self._x])])
+        offsets = offsets.astype(np.int64)
+        _save_npy(prefix + '.x.npy', np.concatenate(self._x))
+        _save_npy(prefix + '.labels.npy', np.concatenate(self._labels))
+        _save_npy(prefix + '.offsets.npy', offsets)
+        _save_npy(prefix + '.names.npy', np.array(self._names))
+        self._shards.append({'name': shard_name,
+                             'num_examples': len(self._x),
+                             'num_frames': int(offsets[-1])})
+        self._x = []
+        self._labels = []
+        self._names = []
+
+    def close(self):
+        """
+        Writes the last shard and the index. The dataset can only be read
+        after this.
+        """
+        self._flush()
+        index = {'version': FORMAT_VERSION, 'dtype': self.dtype,
+                 'shard_size': self.shard_size,
+                 'num_features': self.num_features,
+                 'num_examples': len(self), 'shards': self._shards}
+        index_file = os.path.join(self.directory, INDEX_FILENAME)
+        with open(index_file + '.tmp', 'w') as outfile:
+            json.dump(index, outfile, indent=2)
+        os.replace(index_file + '.tmp', index_file)
+
+
+class ShardedDataset(object):
+    """
+    Reads a dataset written by ShardedDatasetWriter.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of the dataset.
+    mmap : bool
+        Memory-map the features instead of reading them, so only the examples
+        used are read from disk.
+    max_open_shards : int
+        Without mmap, the number of shards kept loaded, the least recently
+        used one is dropped to load another. Memory-mapped shards are all
+        kept open, the OS pages them in and out.
+    """
+
+    def __init__(self, directory, mmap=True, max_open_shards=2):
+        self.directory = directory
+        self.mmap = mmap
+        self.max_open_shards = max_open_shards
+        with open(os.path.join(directory, INDEX_FILENAME), 'r') as infile:
+            self.index = json.load(infile)
+        if self.index['version'] != FORMAT_VERSION:
+            raise ValueError("{} has dataset format version {}, this reads "
+                             "{}. Make it again with make_dataset_v2.py."
+                             .format(directory, self.index['version'],
+                                     FORMAT_VERSION))
+        self._shards = OrderedDict()
+        self._offsets = {}
+
+    def __len__(self):
+        return self.index['num_examples']
+
+    @property
+    def num_shards(self):
+        return len(self.index['shards'])
+
+    def _prefix(self, i):
+        return os.path.join(self.directory, self.index['shards'][i]['name'])
+
+    def shard(self, i):
+        """
+        Returns
+        -------
+        x, labels, offsets, sample_names of the i-th shard. x and labels hold
+        the frames of all its examples, example j is frames offsets[j] to
+        offsets[j + 1]. x is memory-mapped if the dataset is.
+        """
+        if i in self._shards:
+            self._shards.move_to_end(i)
+            return self._shards[i]
+
+        self._shards[i] = self._load_shard(i)
+        while not self.mmap and len(self._shards) > self.max_open_shards:
+            self._shards.popitem(last=False)
+        return self._shards[i]
+
+    def _load_shard(self, i):
+        prefix = self._prefix(i)
+        mmap_mode = 'r' if self.mmap else None
+        return (np.load(prefix + '.x.npy', mmap_mode=mmap_mode),
+                np.load(prefix + '.labels.npy', mmap_mode=mmap_mode),
+                self.offsets(i), np.load(prefix + '.names.npy'))
+
+    def offsets(self, i):
+        """
+        Offsets of the examples of the i-th shard. They're small, so they're
+        kept for every shard.
+        """
+        if i not in self._offsets:
+            self._offsets[i] = np.load(self._prefix(i) + '.offsets.npy')
+        return self._offsets[i]
+
+    def example(self, shard, j):
+        """ :return: x, labels, sample_name of the j-th example in a shard """
+        x, labels, offsets, names = self.shard(shard)
+        start, stop = offsets[j], offsets[j + 1]
+        return x[start:stop], labels[start:stop], names[j]
+
+    def __iter__(self):
+        """ yields (x, labels, sample_name) for every example """
+        for i in range(self.num_shards):
+            for j in range(len(self.offsets(i)) - 1):
+                yield self.example(i, j)
+
+    def lengths(self):
+        """
+        :return: list of (shard, example in the shard, number of frames) for
+                 every example
+        """
+        lengths = []
+        for i in range(self.num_shards):
+            shard_lengths = np.diff(self.offsets(i))
+            lengths.extend((i, j, int(length))
+                           for j, length in enumerate(shard_lengths))
+        return lengths
+
+    def head(self, n, dtype=np.float32):
+        """
+        The first n examples, padded to the same length.
+
+        Returns
+        -------
+        x, labels, mask, sample_names, see pad_batch()
+        """
+        examples = []
+        for example in self:
+            if len(examples) >= n:
+                break
+            examples.append(example)
+        x, labels, mask = pad_batch([e[0] for e in examples],
+                                    [e[1] for e in examples], dtype)
+        return x, labels, mask, np.array([e[2] for e in examples])
+
+    def batches(self, batch_size, shuffle=True, seed=None, dtype=np.float32):
+        """
+        Padded batches of examples of about the same length, so little of
+        each batch is padding.
+
+        The examples are sorted by length (ties broken randomly when
+        shuffling) and cut into batches of batch_size. With shuffle, the
+        order of the batches is random too. With mmap, examples of the whole
+        dataset are batched together. Without it, the shards are split into
+        groups of max_open_shards (in random order when shuffling) whose
+        examples are batched separately, so each shard is loaded once per
+        epoch, at the cost of batches a little less even in length.
+
+        Yields
+        ------
+        x, labels, mask, sample_names, see pad_batch()
+        """
+        rng = np.random.RandomState(seed)
+        lengths = self.lengths()
+        if shuffle:
+            tie_breaks = rng.random_sample(len(lengths))
+        else:
+            tie_breaks = np.arange(len(lengths))
+        order = np.lexsort((tie_breaks,
+                            [length for _, _, length in lengths]))
+
+        if self.mmap:
+            groups = [order]
+        else:
+            if shuffle:
+                shard_order = rng.permutation(self.num_shards)
+            else:
+                shard_order = np.arange(self.num_shards)
+            shards = np.array([shard for shard, _, _ in lengths])[order]
+            groups = []
+            for start in range(0, self.num_shards, self.max_open_shards):
+                group = shard_order[start:start + self.max_open_shards]
+                groups.append(order[np.in1d(shards, group)])
+
+        for group in groups:
+            batches = [group[start:start + batch_size]
+                       for start in range(0, len(group), batch_size)]
+            if shuffle:
+                rng.shuffle(batches)
+
+            for batch in batches:
+                # read the examples shard by shard, then put them back in
+                # order
+                examples = {k: self.example(lengths[k][0], lengths[k][1])
+                            for k in sorted(batch,
+                                            key=lambda k: lengths[k][:2])}
+                examples = [examples[k] for k in batch]
+                x, labels, mask = pad_batch([e[0] for e in examples],
+                                            [e[1] for e in examples], dtype)
+                yield x, labels, mask, np.array([e[2] for e in examples])
+
+
+class NpzDataset(ShardedDataset):
+    """
+    The single npz file written by make_dataset_v2.py before datasets were
+    sharded, as one shard.
+    """
+
+    def __init__(self, filename):
+        self.directory = filename
+        self.mmap = False
+        self.max_open_shards = 1
+        data = np.load(filename)
+        x = data['x']
+        num_examples, num_frames, num_features = x.shape
+        self.index = {'version': FORMAT_VERSION,
+                      'num_examples': num_examples,
+                      'num_features': num_features,
+                      'shards': [{'name': os.path.basename(filename)}]}
+        offsets = np.arange(num_examples + 1) * num_frames
+        self._offsets = {0: offsets}
+        self._shards = OrderedDict([(0, (x.reshape(-1, num_features),
+                                         data['labels'].reshape(-1), offsets,
+                                         data['sample_names']))])
+
+
+def open_dataset(path, mmap=True, max_open_shards=2):
+    """
+    Opens a sharded dataset directory, or an old single file npz dataset.
+    """
+    if os.path.isdir(path):
+        return ShardedDataset(path, mmap=mmap,
+                              max_open_shards=max_open_shards)
+    return NpzDataset(path)
@@ -4,30 +4,130 @@ import numpy as np
 from madmom.processors import OutputProcessor
 
 
+COMBINE_MODES = ['max', 'sum', 'soft_or']
+FRAME_SIZES = (1024, 2048, 4096)
+
+
+def label_kernel(fps, frame_sizes=FRAME_SIZES, sample_rate=44100):
+    """
+    The window placed on every marker, as long as the largest frame in
+    frames.
+
+    Returns
+    -------
+    numpy array
+        Hanning window, peaking at the frame of the marker.
+    """
+    return np.hanning(int((max(frame_sizes) / sample_rate) * fps))
+
+
+def rasterize_markers(responses, n_frames, fps, kernel, combine='max'):
+    """
+    Labels for every frame from the marker times of one or more responses to
+    the same clip.
+
+    All the markers of all the responses are placed at once: the markers are
+    counted per frame, and the kernel is applied with one operation over all
+    the frames per kernel element.
+
+    Parameters
+    ----------
+    responses : list of lists of float
+        Marker times in seconds, one list per response.
+    n_frames : int
+        Number of frames of the clip.
+    fps : float
+        Frames per second.
+    kernel : numpy array
+        Window centered on each marker, see label_kernel().
+    combine : str
+        How the windows of markers close to each other add up. 'max' takes
+        the largest, 'sum' adds them (so labels can go above 1), and
+        'soft_or' takes 1 - prod(1 - window), the probability that any of
+        them marks the frame.
+
+    Returns
+    -------
+    numpy array
+        (len(responses), n_frames)
+    """
+    if combine not in COMBINE_MODES:
+        raise ValueError("combine must be one of {}, not {}".format(
+            COMBINE_MODES, combine))
+    num_responses = len(responses)
+    kernel_size = len(kernel)
+    half = kernel_size // 2
+    # markers up to a kernel outside the clip still reach into it
+    width = n_frames + 2 * kernel_size
+
+    times = [np.asarray(response, dtype=np.float64).reshape(-1)
+             for response in responses]
+    times = np.concatenate(times + [[]])
+    rows = np.repeat(np.arange(num_responses),
+                     [len(response) for response in responses])
+    cols = (times * fps).astype(np.int64) + kernel_size
+    inside = (cols >= 0) & (cols < width)
+    counts = np.bincount(rows[inside] * width + cols[inside],
+                         minlength=num_responses * width)
+    counts = counts.reshape(num_responses, width)
+
+    if combine == 'soft_or':
+        labels = np.ones((num_responses, n_frames))
+    else:
+        labels = np.zeros((num_responses, n_frames))
+    for j, value in enumerate(kernel):
+        # frame i is kernel element j of a marker at frame i + half - j
+        start = kernel_size + half - j
+        shifted = counts[:, start:start + n_frames]
+        if combine == 'max':
+            np.maximum(labels, value * (shifted > 0), out=labels)
+        elif combine == 'sum':
+            labels += value * shifted
+        else:
+            labels *= (1 - value) ** shifted
+    if combine == 'soft_or':
+        labels = 1 - labels
+    return labels
+
+
+def consensus_labels(responses, n_frames, fps, frame_sizes=FRAME_SIZES,
+                     combine='max'):
+    """
+    The mean of the labels of every response to a clip, so frames more
+    labelers marked get higher labels.
+
+    Returns
+    -------
+    numpy array
+        (n_frames,)
+    """
+    if len(responses) == 0:
+        return np.zeros(n_frames)
+    kernel = label_kernel(fps, frame_sizes)
+    labels = rasterize_markers(responses, n_frames, fps, kernel, combine)
+    return labels.mean(axis=0)
+
+
 class LabelOutputProcessor(OutputProcessor):
-    """ saved arbitrary data instance. """
+    """
+    Labels for every frame of data, a window centered on each of the
+    response's markers.
+    """
 
-    def __init__(self, response, fps):
+    def __init__(self, response, fps, combine='max'):
         self.response = response
         self.fps = fps
+        self.combine = combine
+        self._kernels = {}
 
     def process(self, data, output, **kwargs):
         # pylint: disable=arguments-differ
-        # Go through each frame in data, associate responses with that frame, and produce labels
-        n_frames = data.shape[0]
-        labels = np.zeros(n_frames)
-        frame_sizes = kwargs.get('frame_sizes', [1024, 2048, 4096])
-        max_frame_size = int((max(frame_sizes) / 44100) * self.fps)
-
-        for marker_time in self.response:
-            center_frame_idx = int(marker_time * self.fps)
-            window = np.hanning(max_frame_size)
-            start = max(center_frame_idx - max_frame_size//2, 0)
-            stop = min(center_frame_idx + max_frame_size//2, n_frames - 1)
-            for i in range(start, stop):
-                labels[i] = window[i - start]
-
-        return data, labels
+        frame_sizes = tuple(kwargs.get('frame_sizes', FRAME_SIZES))
+        if frame_sizes not in self._kernels:
+            self._kernels[frame_sizes] = label_kernel(self.fps, frame_sizes)
+        labels = rasterize_markers([self.response], data.shape[0], self.fps,
+                                   self._kernels[frame_sizes], self.combine)
+        return data, labels[0]
 
 
 class SaveOutputProcessor(OutputProcessor):
@@ -73,5 +173,7 @@ class PlotActivationsProcessor(OutputProcessor):
 
     @classmethod
     def add_arguments(cls, parser):
-        parser.add_argument('--start-idx', default=0, type=int, help='frame number to start plotting at')
-        parser.add_argument('--end-idx', default=-1, type=int, help='frame number to stop plotting at')
+        parser.add_argument('--start-idx', default=0, type=int,
+                            help='frame number to start plotting at')
+        parser.add_argument('--end-idx', default=-1, type=int,
+                            help='frame number to stop plotting at')
@@ -0,0 +1,196 @@
+# encoding: utf-8
+# pylint: skip-file
+"""
+This file contains tests for the madmom.custom_datasets module.
+
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from madmom.custom_datasets import *
+
+
+def make_examples(num, num_frames=20, num_features=3):
+    rng = np.random.RandomState(0)
+    x = rng.uniform(0, 4, (num, num_frames, num_features)).astype(np.float32)
+    labels = rng.uniform(0, 1, (num, num_frames))
+    names = ['sample_{:d}.mp3'.format(i) for i in range(num)]
+    return x, labels, names
+
+
+def make_ragged_examples(lengths, num_features=3):
+    rng = np.random.RandomState(0)
+    x = [rng.uniform(0, 4, (length, num_features)).astype(np.float32)
+         for length in lengths]
+    labels = [rng.uniform(0, 1, length) for length in lengths]
+    names = ['sample_{:d}.mp3'.format(i) for i in range(len(lengths))]
+    return x, labels, names
+
+
+class CountingDataset(ShardedDataset):
+
+    def __init__(self, *args, **kwargs):
+        super(CountingDataset, self).__init__(*args, **kwargs)
+        self.loads = []
+
+    def _load_shard(self, i):
+        self.loads.append(i)
+        return super(CountingDataset, self)._load_shard(i)
+
+
+class TestShardedDatasetClass(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.directory = os.path.join(self.tmp_dir, 'dataset')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, x, labels, names, **kwargs):
+        with ShardedDatasetWriter(self.directory, **kwargs) as writer:
+            for example in zip(x, labels, names):
+                writer.add(*example)
+
+    def test_round_trip(self):
+        x, labels, names = make_examples(5)
+        self.write(x, labels, names, shard_size=2, dtype='float32')
+        dataset = open_dataset(self.directory)
+        self.assertEqual(len(dataset), 5)
+        self.assertEqual(dataset.num_shards, 3)
+        self.assertIsInstance(dataset.shard(0)[0], np.memmap)
+        examples = list(dataset)
+        self.assertEqual(len(examples), 5)
+        for (x_, labels_, name_), x_i, labels_i, name_i in zip(examples, x,
+                                                               labels, names):
+            self.assertTrue(np.array_equal(x_, x_i))
+            self.assertTrue(np.allclose(labels_, labels_i))
+            self.assertEqual(name_, name_i)
+
+    def test_float16(self):
+        x, labels, names = make_examples(3)
+        self.write(x, labels, names, dtype='float16')
+        x_, _, _, _ = open_dataset(self.directory).head(3)
+        self.assertEqual(x_.dtype, np.float32)
+        self.assertTrue(np.allclose(x_, x, atol=1e-2))
+
+    def test_head(self):
+        x, labels, names = make_examples(5)
+        self.write(x, labels, names, shard_size=2)
+        x_, labels_, mask, names_ = open_dataset(self.directory).head(3)
+        self.assertEqual(x_.shape, (3, 20, 3))
+        self.assertEqual(labels_.shape, (3, 20))
+        self.assertTrue(np.all(mask == 1))
+        self.assertEqual(list(names_), names[:3])
+        # more than there are
+        self.assertEqual(len(open_dataset(self.directory).head(10)[0]), 5)
+
+    def test_variable_lengths(self):
+        x, labels, names = make_ragged_examples([5, 12, 3, 8])
+        self.write(x, labels, names, shard_size=3, dtype='float32')
+        dataset = open_dataset(self.directory)
+        self.assertEqual([length for _, _, length in dataset.lengths()],
+                         [5, 12, 3, 8])
+        for (x_, labels_, name_), x_i, labels_i in zip(dataset, x, labels):
+            self.assertTrue(np.array_equal(x_, x_i))
+            self.assertTrue(np.allclose(labels_, labels_i))
+        x_, labels_, mask, names_ = dataset.head(3)
+        self.assertEqual(x_.shape, (3, 12, 3))
+        self.assertEqual(list(mask.sum(axis=1)), [5, 12, 3])
+        self.assertTrue(np.array_equal(x_[2, :3], x[2]))
+        self.assertTrue(np.all(x_[2, 3:] == 0))
+        self.assertTrue(np.all(labels_[2, 3:] == 0))
+
+    def test_batches(self):
+        lengths = [5, 12, 3, 8, 30, 4, 11]
+        x, labels, names = make_ragged_examples(lengths)
+        self.write(x, labels, names, shard_size=3)
+        dataset = open_dataset(self.directory)
+        batches = list(dataset.batches(2, seed=1))
+        self.assertEqual(sorted(len(b[0]) for b in batches), [1, 2, 2, 2])
+        seen = []
+        for x_, labels_, mask, names_ in batches:
+            # examples of similar length go together, so only the longest
+            # isn't padded
+            batch_lengths = [lengths[names.index(name)] for name in names_]
+            self.assertEqual(x_.shape[1], max(batch_lengths))
+            self.assertEqual(list(mask.sum(axis=1)), batch_lengths)
+            seen.extend(names_)
+        self.assertEqual(sorted(seen), sorted(names))
+        # sorted by length, without shuffling
+        batches = list(dataset.batches(3, shuffle=False))
+        self.assertEqual([list(b[2].sum(axis=1)) for b in batches],
+                         [[3, 4, 5], [8, 11, 12], [30]])
+
+    def test_labels_must_match(self):
+        x, labels, names = make_ragged_examples([5, 10])
+        writer = ShardedDatasetWriter(self.directory)
+        writer.add(x[0], labels[0], names[0])
+        writer.add(x[1], labels[1], names[1])
+        with self.assertRaises(ValueError):
+            writer.add(x[1], labels[1][:9], names[1])
+        with self.assertRaises(ValueError):
+            writer.add(x[1][:, :2], labels[1], names[1])
+        with self.assertRaises(ValueError):
+            writer.add(x[1][:, 0], labels[1], names[1])
+
+    def test_open_shards(self):
+        x, labels, names = make_ragged_examples([5, 12, 3, 8, 30, 4, 11])
+        self.write(x, labels, names, shard_size=2)
+        dataset = open_dataset(self.directory, mmap=False, max_open_shards=2)
+        for _ in dataset:
+            self.assertLessEqual(len(dataset._shards), 2)
+        self.assertEqual(list(dataset._shards), [2, 3])
+        for _ in dataset.batches(3):
+            self.assertLessEqual(len(dataset._shards), 2)
+
+    def test_shard_loads(self):
+        # batches mix examples from every shard, memory-mapped shards are
+        # only opened once anyway
+        lengths = np.random.RandomState(1).randint(1, 40, 50)
+        x, labels, names = make_ragged_examples(lengths)
+        self.write(x, labels, names, shard_size=5)
+        dataset = CountingDataset(self.directory, max_open_shards=2)
+        for _ in range(2):
+            for _ in dataset.batches(4):
+                pass
+        self.assertEqual(sorted(dataset.loads), list(range(10)))
+
+        # without mmap, only max_open_shards fit, so batches come from groups
+        # of that many shards and each shard is loaded once per epoch
+        dataset = CountingDataset(self.directory, mmap=False,
+                                  max_open_shards=3)
+        for epoch in range(2):
+            seen = []
+            dataset.loads = []
+            for _, _, mask, names_ in dataset.batches(4, seed=epoch):
+                self.assertLessEqual(len(dataset._shards), 3)
+                seen.extend(names_)
+            self.assertEqual(sorted(seen), sorted(names))
+            self.assertEqual(len(set(dataset.loads)), len(dataset.loads))
+
+    def test_old_version(self):
+        x, labels, names = make_examples(2)
+        self.write(x, labels, names)
+        with open(os.path.join(self.directory, 'index.json'), 'w') as outfile:
+            outfile.write('{"version": 1}')
+        with self.assertRaises(ValueError):
+            open_dataset(self.directory)
+
+    def test_npz(self):
+        x, labels, names = make_examples(4)
+        filename = os.path.join(self.tmp_dir, 'dataset.npz')
+        np.savez(filename, x=x, labels=labels, sample_names=names)
+        dataset = open_dataset(filename)
+        self.assertEqual(len(dataset), 4)
+        x_, labels_, mask, names_ = dataset.head(2)
+        self.assertTrue(np.array_equal(x_, x[:2]))
+        self.assertTrue(np.allclose(labels_, labels[:2]))
+        self.assertEqual(list(names_), names[:2])
@@ -0,0 +1,100 @@
+# encoding: utf-8
+# pylint: skip-file
+"""
+This file contains tests for the madmom.custom_processors module.
+
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import unittest
+
+import numpy as np
+
+from madmom.custom_processors import *
+
+
+def loop_labels(response, fps, n_frames, kernel, combine):
+    # one marker and one frame at a time
+    labels = np.ones(n_frames) if combine == 'soft_or' else np.zeros(n_frames)
+    for marker_time in response:
+        first = int(marker_time * fps) - len(kernel) // 2
+        for j, value in enumerate(kernel):
+            if 0 <= first + j < n_frames:
+                if combine == 'max':
+                    labels[first + j] = max(labels[first + j], value)
+                elif combine == 'sum':
+                    labels[first + j] += value
+                else:
+                    labels[first + j] *= 1 - value
+    return 1 - labels if combine == 'soft_or' else labels
+
+
+class TestRasterizeMarkersFunction(unittest.TestCase):
+
+    def setUp(self):
+        self.kernel = label_kernel(100)
+        rng = np.random.RandomState(0)
+        # overlapping markers, and markers at and past both ends
+        edges = [0, 0.01, 1.99, 2.02, 2.5, -0.02]
+        self.responses = [list(rng.uniform(0, 2, 15)) + edges,
+                          [0.5, 0.52, 0.53], []]
+
+    def test_kernel(self):
+        self.assertEqual(len(self.kernel), 9)
+        self.assertEqual(self.kernel[4], 1)
+
+    def test_modes(self):
+        for combine in COMBINE_MODES:
+            labels = rasterize_markers(self.responses, 200, 100, self.kernel,
+                                       combine)
+            self.assertEqual(labels.shape, (3, 200))
+            for response, response_labels in zip(self.responses, labels):
+                expected = loop_labels(response, 100, 200, self.kernel,
+                                       combine)
+                self.assertTrue(np.allclose(response_labels, expected))
+        self.assertTrue(np.all(labels[2] == 0))
+
+    def test_overlap(self):
+        markers = [[0.5, 0.52]]
+        max_labels, sum_labels, soft_or_labels = [
+            rasterize_markers(markers, 100, 100, self.kernel, combine)[0]
+            for combine in ['max', 'sum', 'soft_or']]
+        self.assertEqual(max_labels[50], 1)
+        self.assertEqual(max_labels[52], 1)
+        self.assertAlmostEqual(sum_labels[51], 2 * self.kernel[5])
+        self.assertTrue(np.all(max_labels <= soft_or_labels + 1e-12))
+        self.assertTrue(np.all(soft_or_labels <= sum_labels + 1e-12))
+        self.assertTrue(np.all(soft_or_labels <= 1))
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            rasterize_markers([[0.5]], 100, 100, self.kernel, 'min')
+
+
+class TestConsensusLabelsFunction(unittest.TestCase):
+
+    def test_mean(self):
+        responses = [[0.5], [0.5, 1.0], [1.5]]
+        labels = consensus_labels(responses, 200, 100)
+        self.assertEqual(labels.shape, (200,))
+        self.assertAlmostEqual(labels[50], 2 / 3)
+        self.assertAlmostEqual(labels[100], 1 / 3)
+        self.assertAlmostEqual(labels[150], 1 / 3)
+        self.assertTrue(np.all(consensus_labels([], 200, 100) == 0))
+
+
+class TestLabelOutputProcessorClass(unittest.TestCase):
+
+    def test_process(self):
+        data = np.zeros((200, 3))
+        processor = LabelOutputProcessor([0.5, 1.0], 100)
+        data_, labels = processor.process(data, None)
+        self.assertIs(data_, data)
+        self.assertEqual(labels.shape, (200,))
+        expected = loop_labels([0.5, 1.0], 100, 200, label_kernel(100), 'max')
+        self.assertTrue(np.allclose(labels, expected))
+        # a larger frame, a longer window
+        _, labels = processor.process(data, None, frame_sizes=[8192])
+        kernel_size = len(label_kernel(100, [8192]))
+        self.assertEqual(np.count_nonzero(labels), 2 * (kernel_size - 2))
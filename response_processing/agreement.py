@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+How much the labelers of each sample agree with each other.
+
+Every pair of responses to a sample is compared like madmom compares onset detections to annotations: markers of
+the two responses within the window of each other match one to one, and the F-measure is 2 * matches divided by the
+number of markers in both responses. The deviation is the mean absolute time between matched markers.
+"""
+import argparse
+import csv
+import multiprocessing
+from itertools import combinations
+
+import numpy as np
+
+from madmom.evaluation import find_closest_matches
+from madmom.evaluation.onsets import onset_evaluation
+
+from response_processing import util
+
+# how far apart two labelers' markers can be and still mark the same thing, in seconds. Markers are placed by hand,
+# so this is wider than madmom's onset and beat windows.
+WINDOW = 0.1
+
+
+def match_to(responses, j, window):
+    """
+    Matches the markers of every response to those of response j, all at once.
+
+    Each marker matches the closest marker of response j, and of the markers matching the same one only the closest
+    counts. This finds every match onset_evaluation() does unless the markers of one of the responses are within two
+    windows of each other, see crowded().
+
+    :param responses: list of sorted numpy arrays of marker times
+    :param j: index of the response to match to
+    :param window: largest time between matched markers
+    :return: (number of matches, sum of absolute errors of the matches), each a numpy array with one entry per
+             response
+    """
+    num_matches = np.zeros(len(responses), dtype=int)
+    total_error = np.zeros(len(responses))
+    annotations = responses[j]
+    if len(annotations) == 0:
+        return num_matches, total_error
+
+    detections = np.concatenate(responses)
+    owners = np.repeat(np.arange(len(responses)), [len(response) for response in responses])
+    matches = find_closest_matches(detections, annotations)
+    errors = np.abs(detections - annotations[matches])
+    hit = errors <= window
+    owners, matches, errors = owners[hit], matches[hit], errors[hit]
+
+    # one to one: a marker of response j matches at most the closest marker of each other response
+    order = np.lexsort((errors, matches, owners))
+    owners, matches, errors = owners[order], matches[order], errors[order]
+    first = np.ones(len(owners), dtype=bool)
+    first[1:] = (owners[1:] != owners[:-1]) | (matches[1:] != matches[:-1])
+    num_matches += np.bincount(owners[first], minlength=len(responses))
+    total_error += np.bincount(owners[first], weights=errors[first], minlength=len(responses))
+    return num_matches, total_error
+
+
+def crowded(response, window):
+    """ :return: whether a marker of another response can be within the window of two markers of this one """
+    return len(response) > 1 and np.min(np.diff(response)) <= 2 * window
+
+
+def pairwise_agreement(responses, window=WINDOW):
+    """
+    :param responses: list of lists of marker times, one per response to the same sample
+    :param window: largest time between matched markers in seconds
+    :return: (F-measures, deviations in seconds), symmetric numpy arrays of (responses, responses). The deviation of
+             two responses without any matches is nan.
+    """
+    responses = [np.sort(np.asarray(response, dtype=float)) for response in responses]
+    num_responses = len(responses)
+    num_markers = np.array([len(response) for response in responses])
+
+    num_matches = np.zeros((num_responses, num_responses), dtype=int)
+    total_error = np.zeros((num_responses, num_responses))
+    for j in range(num_responses):
+        num_matches[:, j], total_error[:, j] = match_to(responses, j, window)
+    # markers close together need onset_evaluation()'s scan through both responses to match as many as possible
+    is_crowded = [crowded(response, window) for response in responses]
+    for i in range(num_responses):
+        for j in range(i + 1, num_responses):
+            if is_crowded[i] or is_crowded[j]:
+                tp, _, _, _, errors = onset_evaluation(responses[i], responses[j], window)
+                num_matches[i, j] = num_matches[j, i] = len(tp)
+                total_error[i, j] = total_error[j, i] = np.sum(np.abs(errors))
+
+    total_markers = num_markers[:, np.newaxis] + num_markers[np.newaxis, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # two responses without any markers agree completely, like madmom's F-measure
+        fmeasures = np.where(total_markers == 0, 1., 2 * num_matches / total_markers)
+        deviations = np.where(num_matches == 0, np.nan, total_error / num_matches)
+    return fmeasures, deviations
+
+
+def sample_agreement(job):
+    """
+    :param job: (sample url, list of (trial id, labeler id, marker times), window)
+    :return: (sample row, list of response rows) for the csv files
+    """
+    url, trials, window = job
+    fmeasures, deviations = pairwise_agreement([markers for _, _, markers in trials], window)
+    pairs = list(combinations(range(len(trials)), 2))
+    pair_fmeasures = np.array([fmeasures[i, j] for i, j in pairs])
+    pair_deviations = np.array([deviations[i, j] for i, j in pairs])
+
+    sample_row = {
+        'url': url,
+        'num_responses': len(trials),
+        'num_pairs': len(pairs),
+        'mean_fmeasure': np.mean(pair_fmeasures) if pairs else np.nan,
+        'min_fmeasure': np.min(pair_fmeasures) if pairs else np.nan,
+        'mean_deviation_ms': 1000 * np.nanmean(pair_deviations) if np.any(np.isfinite(pair_deviations)) else np.nan,
+    }
+
+    response_rows = []
+    others = ~np.eye(len(trials), dtype=bool)
+    for i, (trial_id, labeler_id, markers) in enumerate(trials):
+        other_deviations = deviations[i][others[i]]
+        response_rows.append({
+            'id': trial_id,
+            'labeler_id': labeler_id,
+            'url': url,
+            'num_markers': len(markers),
+            'mean_fmeasure': np.mean(fmeasures[i][others[i]]) if len(trials) > 1 else np.nan,
+            'mean_deviation_ms': (1000 * np.nanmean(other_deviations) if np.any(np.isfinite(other_deviations))
+                                  else np.nan),
+        })
+    return sample_row, response_rows
+
+
+def write_csv(filename, fieldnames, rows):
+    with open(filename, 'w', newline='') as outfile:
+        writer = csv.DictWriter(outfile, fieldnames=fieldnames)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({key: round(value, 4) if isinstance(value, float) else value
+                             for key, value in row.items()})
+
+
+def main():
+    parser = argparse.ArgumentParser("measures how much the labelers of each sample agree with each other")
+    parser.add_argument("dumpfile", help="The output of \"flask dumpdb --outfile=dump.json\"")
+    parser.add_argument("outfile", help="csv file with the agreement of each sample")
+    parser.add_argument("--responses-outfile", help="csv file with the agreement of each response with the other "
+                                                    "responses to its sample, to find unreliable labelers")
+    parser.add_argument("--window", type=float, default=WINDOW,
+                        help="largest time between markers that mark the same thing [default={}s]".format(WINDOW))
+    parser.add_argument("--workers", "-w", default=1, type=int, help="number of processes comparing responses")
+
+    args = parser.parse_args()
+
+    jobs = []
+    for url, trials in util.load_by_url(args.dumpfile).items():
+        trials = [(trial['id'], trial['labeler_id'], [float(t['timestamp']) for t in trial['data']['final_response']])
+                  for trial in trials]
+        jobs.append((url, trials, args.window))
+
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers)
+        results = pool.map(sample_agreement, jobs, chunksize=max(1, len(jobs) // (4 * args.workers)))
+        pool.close()
+        pool.join()
+    else:
+        results = list(map(sample_agreement, jobs))
+
+    sample_rows = [sample_row for sample_row, _ in results]
+    write_csv(args.outfile, ['url', 'num_responses', 'num_pairs', 'mean_fmeasure', 'min_fmeasure',
+                             'mean_deviation_ms'], sample_rows)
+    if args.responses_outfile:
+        write_csv(args.responses_outfile, ['id', 'labeler_id', 'url', 'num_markers', 'mean_fmeasure',
+                                           'mean_deviation_ms'],
+                  [response_row for _, response_rows in results for response_row in response_rows])
+
+    fmeasures = np.array([row['mean_fmeasure'] for row in sample_rows if row['num_pairs'] > 0])
+    if len(fmeasures) > 0:
+        print("{:d} samples, mean F-measure {:.3f}, {:d} below 0.5".format(
+            len(sample_rows), np.mean(fmeasures), int(np.sum(fmeasures < 0.5))))
+    else:
+        print("{:d} samples, none with more than one response".format(len(sample_rows)))
+
+
+if __name__ == '__main__':
+    main()
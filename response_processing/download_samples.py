@@ -2,12 +2,195 @@
 
 import os
 import argparse
-import shutil
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import urlparse
 import urllib3
 
 from response_processing import util
 
+CHUNK_SIZE = 1 << 16
+
+
+def sample_filename(outfolder, sample_url):
+    o = urlparse(sample_url)
+    sample_name = os.path.split(o.path)[-1]
+    return os.path.join(outfolder, sample_name)
+
+
+def load_md5sums(filename):
+    """
+    :param filename: output of md5sum run on the samples, "<hash>  <name>" per line
+    :return: dict from sample name to md5 hex digest
+    """
+    md5sums = {}
+    with open(filename, 'r') as infile:
+        for line in infile:
+            if not line.strip():
+                continue
+            digest, name = line.strip().split(None, 1)
+            md5sums[os.path.basename(name.lstrip('*'))] = digest.lower()
+    return md5sums
+
+
+def file_md5(filename):
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def remote_size(http, url):
+    """ :return: the size the server reports for url, None if it doesn't say or doesn't support HEAD """
+    r = http.request('HEAD', url)
+    if r.status in (405, 501):
+        return None
+    if r.status != 200:
+        raise RuntimeError("HEAD {:s} returned {:d}".format(url, r.status))
+    length = r.headers.get('Content-Length')
+    return int(length) if length is not None else None
+
+
+def fetch(http, url, part_file):
+    """
+    Appends the rest of url to part_file, asking for only the bytes it doesn't have yet with a Range request. Starts
+    over if the server ignores the range.
+
+    :return: the full size of the file according to the server, None if it doesn't say
+    """
+    offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+    headers = {'Range': 'bytes={:d}-'.format(offset)} if offset > 0 else {}
+    r = http.request('GET', url, headers=headers, preload_content=False)
+    try:
+        if r.status == 416 and offset > 0:
+            # nothing past offset. The part file is complete if it's as long as the whole file.
+            total = r.headers.get('Content-Range', '').rpartition('/')[2]
+            if total.isdigit() and int(total) == offset:
+                return offset
+            os.remove(part_file)
+            raise RuntimeError("{:s} was longer than the file on the server, removed it".format(part_file))
+        elif r.status == 206:
+            content_range = r.headers.get('Content-Range', '')
+            start = content_range.split()[-1].split('-')[0] if content_range else ''
+            if start != str(offset):
+                raise RuntimeError("GET {:s} returned range {:s}, asked for {:d}-".format(url, content_range, offset))
+            total = content_range.rpartition('/')[2]
+            total = int(total) if total.isdigit() else None
+            mode = 'ab'
+        elif r.status == 200:
+            length = r.headers.get('Content-Length')
+            total = int(length) if length is not None else None
+            mode = 'wb'
+        else:
+            raise RuntimeError("GET {:s} returned {:d}".format(url, r.status))
+
+        with open(part_file, mode) as outfile:
+            for chunk in r.stream(CHUNK_SIZE):
+                outfile.write(chunk)
+        return total
+    finally:
+        r.release_conn()
+
+
+def download(http, url, outfile, expected_md5=None, check_existing=True, retries=3):
+    """
+    Downloads url to outfile. The data goes to outfile + '.part' first, which is renamed to outfile once its size (and
+    md5, if given) is right, so outfile is never a partial file. An interrupted download is resumed from the part
+    file, here on the next retry or on the next run.
+
+    :param expected_md5: md5 hex digest the file should have. An existing outfile with a different one is downloaded
+                         again.
+    :param check_existing: compare the size of an existing outfile to the server's and download it again if it's off
+    :return: 'skipped', 'resumed', 'downloaded' or 'replaced'
+    """
+    part_file = outfile + '.part'
+
+    if os.path.isfile(outfile) and expected_md5 is not None:
+        # the md5 says more than the size, so there's no need to ask the server
+        if file_md5(outfile) == expected_md5:
+            return 'skipped'
+        print("md5 of {:s} doesn't match, downloading it again".format(outfile))
+        os.remove(outfile)
+        if os.path.exists(part_file):
+            os.remove(part_file)
+        replaced = True
+    else:
+        replaced = False
+
+    if os.path.isfile(outfile):
+        if not check_existing:
+            return 'skipped'
+        size = remote_size(http, url)
+        if size is None or os.path.getsize(outfile) == size:
+            return 'skipped'
+        # written by a version of this script without part files, and cut off
+        if os.path.getsize(outfile) < size:
+            os.replace(outfile, part_file)
+        else:
+            os.remove(outfile)
+
+    resumed = os.path.exists(part_file)
+    for attempt in range(retries + 1):
+        try:
+            total = fetch(http, url, part_file)
+        except (urllib3.exceptions.HTTPError, OSError, RuntimeError) as e:
+            if attempt == retries:
+                raise RuntimeError("{:s} failed after {:d} attempts: {}".format(url, retries + 1, e))
+            resumed = True
+            time.sleep(0.5 * 2 ** attempt)
+            continue
+
+        size = os.path.getsize(part_file)
+        if total is not None and size != total:
+            if attempt == retries:
+                raise RuntimeError("{:s} is {:d} bytes, expected {:d}".format(part_file, size, total))
+            resumed = True
+            continue
+        break
+
+    if expected_md5 is not None and file_md5(part_file) != expected_md5:
+        os.remove(part_file)
+        raise RuntimeError("md5 of {:s} doesn't match, removed it".format(url))
+
+    os.replace(part_file, outfile)
+    if replaced:
+        return 'replaced'
+    return 'resumed' if resumed else 'downloaded'
+
+
+def download_all(sample_urls, outfolder, workers=8, md5sums=None, check_existing=True):
+    """
+    Downloads the urls concurrently, all through one connection pool with at most one connection per worker per host.
+
+    :param md5sums: optional dict from sample name to md5 hex digest to check the downloads against
+    :return: dict from url to its result from download(), or the exception it raised
+    """
+    if not os.path.isdir(outfolder):
+        os.makedirs(outfolder)
+
+    http = urllib3.PoolManager(maxsize=workers, block=True)
+    md5sums = md5sums or {}
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for sample_url in sample_urls:
+            outfile = sample_filename(outfolder, sample_url)
+            expected_md5 = md5sums.get(os.path.basename(outfile))
+            future = executor.submit(download, http, sample_url, outfile, expected_md5, check_existing)
+            futures[future] = (sample_url, outfile)
+
+        for future in as_completed(futures):
+            sample_url, outfile = futures[future]
+            try:
+                results[sample_url] = future.result()
+                print(results[sample_url], sample_url, '->', outfile)
+            except Exception as e:
+                results[sample_url] = e
+                print("failed", sample_url, e)
+    return results
+
 
 def main():
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -15,28 +198,30 @@ def main():
     parser = argparse.ArgumentParser("download all samples references in dumpfile")
     parser.add_argument("dumpfile", help="The output of \"flask dumpdb --outfile=dump.json\"")
     parser.add_argument('outfolder', help='output folder to put samples in')
+    parser.add_argument('--workers', '-w', type=int, default=8, help='number of downloads at a time')
+    parser.add_argument('--md5sums', help='output of md5sum on the samples, to check the downloads and the samples '
+                                          'already in outfolder against')
+    parser.add_argument('--no-check', action='store_true',
+                        help="don't ask the server for the size of samples that are already downloaded")
 
     args = parser.parse_args()
 
     responses_by_url = util.load_by_url(args.dumpfile)
     final_responses_by_url = util.get_final_responses(responses_by_url)
+    md5sums = load_md5sums(args.md5sums) if args.md5sums else None
 
-    for sample_url, final_responses in final_responses_by_url.items():
-        o = urlparse(sample_url)
-        sample_name = os.path.split(o.path)[-1]
-        outfile = os.path.join(args.outfolder, sample_name)
-
-        if os.path.isfile(outfile):
-            print("skipping", outfile)
-            continue
-
-        print(sample_url, '->', outfile)
-
-        http = urllib3.PoolManager()
+    t0 = time.time()
+    results = download_all(final_responses_by_url.keys(), args.outfolder, args.workers, md5sums, not args.no_check)
+    elapsed_s = time.time() - t0
 
-        with http.request('GET', sample_url, preload_content=False) as r, open(outfile, 'wb') as out_file:
-            shutil.copyfileobj(r, out_file)
+    counts = {}
+    for result in results.values():
+        key = result if isinstance(result, str) else 'failed'
+        counts[key] = counts.get(key, 0) + 1
+    print("{:d} samples in {:.1f}s: {:s}".format(
+        len(results), elapsed_s, ", ".join("{:d} {:s}".format(n, k) for k, n in sorted(counts.items()))))
+    return 1 if 'failed' in counts else 0
 
 
 if __name__ == '__main__':
-    main()
+    raise SystemExit(main())
@@ -1,59 +1,170 @@
 #!/usr/bin/env python
+import hashlib
 import json
+import multiprocessing
 import os
 import numpy as np
 import argparse
+from collections import OrderedDict
 from urllib.parse import urlparse
 
-from madmom.custom_processors import LabelOutputProcessor
+from madmom.custom_datasets import DTYPES, ShardedDatasetWriter
+from madmom.custom_processors import COMBINE_MODES, LabelOutputProcessor, consensus_labels
 from madmom.features.tf_beats import TfRhythmicGroupingPreProcessor
-from madmom.processors import _process, IOProcessor
 
 from response_processing import util
 
+# everything the features depend on besides the audio. Bump FEATURES_VERSION when TfRhythmicGroupingPreProcessor
+# changes in a way these don't capture, so the cache starts over.
+FEATURES_VERSION = 1
+# the preprocessor's defaults, which sample_generator.py --features uses too
+FRAME_SIZES = [1024, 2048, 4096]
 
-def main():
-    parser = argparse.ArgumentParser("merges a csv of survey responses, and a sqlite3 database of responses.")
-    parser.add_argument("dumpfile", help="The output of \"flask dumpdb --outfile=dump.json\"")
-    parser.add_argument("samples", help="folder with the actual mp3 samples")
-    parser.add_argument('outfile', help='output file (EX: train_dataset.npz)')
-    parser.add_argument('--fps', action='store', type=float, default=100, help='frames per second [default=100]')
+_preprocessor = None
 
-    args = parser.parse_args()
 
-    trials = json.load(open(args.dumpfile, "r"))['dataset']
+def feature_params_digest(frame_sizes):
+    params = {'version': FEATURES_VERSION, 'preprocessor': 'TfRhythmicGroupingPreProcessor',
+              'frame_sizes': list(frame_sizes)}
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def file_sha1(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(1 << 16), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
 
-    data = []
-    labels = []
-    sample_names = []
-    for trial in trials:
-        final_response = [r['timestamp'] for r in trial['data']['final_response']]
-        sample_url = trial['url']
+def compute_features(job):
+    """
+    The features of one sample, from the cache if they're in it.
 
-        o = urlparse(sample_url)
-        sample_name = os.path.split(o.path)[-1]
-        preprocessor = TfRhythmicGroupingPreProcessor()
+    :param job: (sample file, cache directory, frame sizes, whether to use sample_generator.py's sidecar files)
+    :return: (sample file, file with the features, whether they were cached, error or None)
+    """
+    global _preprocessor
+    infile, cache_dir, frame_sizes, use_sidecars = job
+    try:
+        sha1 = file_sha1(infile)
+        if use_sidecars:
+            # written by sample_generator.py --features, named by the sha1 of the clip they're next to
+            sidecar = os.path.join(os.path.dirname(infile), sha1 + '.npy')
+            if os.path.exists(sidecar):
+                return infile, sidecar, True, None
 
-        infile = os.path.join(args.samples, sample_name)
+        cache_file = os.path.join(cache_dir, '{:s}.{:s}.npy'.format(sha1, feature_params_digest(frame_sizes)))
+        if os.path.exists(cache_file):
+            return infile, cache_file, True, None
 
-        print(infile)
+        # one preprocessor per worker, it caches its FFT windows
+        if _preprocessor is None:
+            _preprocessor = TfRhythmicGroupingPreProcessor(frame_sizes=frame_sizes)
+        features = _preprocessor(infile)
 
-        label_processor = LabelOutputProcessor(final_response, args.fps)
+        tmp_file = '{:s}.{:d}.tmp'.format(cache_file, os.getpid())
+        with open(tmp_file, 'wb') as outfile:
+            np.save(outfile, features)
+        os.replace(tmp_file, cache_file)
+        return infile, cache_file, False, None
+    except Exception as e:
+        return infile, None, False, e
 
-        # create an IOProcessor
-        processor = IOProcessor(preprocessor, label_processor)
-        sample_data, sample_labels = _process((processor, infile, None, vars(args)))
-        data.append(sample_data)
 
-        if sample_data.shape != data[0].shape:
-            print("Shapes do not match, ", data[0].shape, sample_data.shape, "Skipping.")
-            data.pop()
+def main():
+    parser = argparse.ArgumentParser("merges a csv of survey responses, and a sqlite3 database of responses.")
+    parser.add_argument("dumpfile", help="The output of \"flask dumpdb --outfile=dump.json\"")
+    parser.add_argument("samples", help="folder with the actual mp3 samples")
+    parser.add_argument('outfile', help='output directory for the dataset (EX: train_dataset)')
+    parser.add_argument('--fps', action='store', type=float, default=100, help='frames per second [default=100]')
+    parser.add_argument('--from-database', action='store_true',
+                        help='dumpfile is a sqlite3 database, read the markers table instead of a json dump')
+    parser.add_argument('--workers', '-w', default=1, type=int, help="number of processes computing features")
+    parser.add_argument('--cache-dir', help="where to keep the features of each sample, by the sha1 of the file and "
+                                            "the preprocessor's parameters [default=<samples>/.features]")
+    parser.add_argument('--sidecars', action='store_true',
+                        help="use the features sample_generator.py --features saved next to the samples. They're "
+                             "computed before encoding, so they're slightly off for mp3s.")
+    parser.add_argument('--dtype', choices=DTYPES, default='float16', help="what to store the features as")
+    parser.add_argument('--shard-size', type=int, default=256, help="examples per shard")
+    parser.add_argument('--combine', choices=COMBINE_MODES, default='max',
+                        help="how the label windows of markers close together add up [default=max]")
+    parser.add_argument('--consensus', action='store_true',
+                        help="one example per sample, labeled with the mean of the labels of all its responses, "
+                             "instead of one example per response")
+
+    args = parser.parse_args()
+    cache_dir = args.cache_dir or os.path.join(args.samples, '.features')
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    if args.from_database:
+        final_responses_by_url = util.load_final_responses_from_db(args.dumpfile)
+    else:
+        final_responses_by_url = util.get_final_responses_list(util.load_by_url(args.dumpfile))
+
+    trials = [(sample_url, final_response) for sample_url, final_responses in final_responses_by_url.items()
+              for final_response in final_responses]
+
+    # every sample's features are computed once, however many labelers responded to it
+    infiles = OrderedDict()
+    for sample_url, _ in trials:
+        sample_name = os.path.split(urlparse(sample_url).path)[-1]
+        infiles[sample_name] = os.path.join(args.samples, sample_name)
+
+    jobs = [(infile, cache_dir, FRAME_SIZES, args.sidecars) for infile in infiles.values()]
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers)
+        results = pool.imap_unordered(compute_features, jobs)
+    else:
+        pool = None
+        results = map(compute_features, jobs)
+
+    feature_files = {}
+    num_cached = 0
+    for infile, feature_file, cached, error in results:
+        if error is not None:
+            print("failed: {:s} ({})".format(infile, error))
             continue
+        print(infile, "(cached)" if cached else "")
+        feature_files[infile] = feature_file
+        num_cached += int(cached)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    print("{:d} samples, {:d} from the cache, {:d} failed".format(
+        len(jobs), num_cached, len(jobs) - len(feature_files)))
+
+    # samples keep all their frames, however long they are
+    writer = ShardedDatasetWriter(args.outfile, shard_size=args.shard_size, dtype=args.dtype)
+
+    if args.consensus:
+        examples = list(final_responses_by_url.items())
+    else:
+        examples = trials
+
+    # the trials of a sample are next to each other, so only its features need to be in memory
+    loaded_file, sample_data = None, None
+    for sample_url, response in examples:
+        sample_name = os.path.split(urlparse(sample_url).path)[-1]
+        infile = infiles[sample_name]
+        if infile not in feature_files:
+            continue
+        if infile != loaded_file:
+            loaded_file, sample_data = infile, np.load(feature_files[infile])
+
+        if args.consensus:
+            sample_labels = consensus_labels(response, len(sample_data), args.fps, FRAME_SIZES, args.combine)
+        else:
+            label_processor = LabelOutputProcessor(response, args.fps, args.combine)
+            _, sample_labels = label_processor.process(sample_data, None, **vars(args))
 
-        labels.append(sample_labels)
-        sample_names.append(sample_name)
+        writer.add(sample_data, sample_labels, sample_name)
 
-    np.savez(args.outfile, x=data, labels=labels, sample_names=sample_names)
+    writer.close()
+    print("wrote {:d} examples to {:s}".format(len(writer), args.outfile))
 
 
 if __name__ == '__main__':
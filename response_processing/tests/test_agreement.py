@@ -0,0 +1,94 @@
+import unittest
+
+import numpy as np
+from madmom.evaluation.onsets import onset_evaluation
+
+from response_processing import agreement
+
+WINDOW = agreement.WINDOW
+
+
+def random_responses(rng):
+    """ a few responses to one sample: noisy copies of the same markers, with some markers dropped and added """
+    duration = rng.choice([2., 10., 30.])
+    markers = np.sort(rng.uniform(0, duration, rng.randint(0, 12)))
+    responses = []
+    for _ in range(rng.randint(1, 6)):
+        response = markers + rng.normal(0, rng.choice([0.01, 0.05, 0.1]), len(markers))
+        response = response[rng.uniform(size=len(response)) > rng.choice([0, 0.2, 0.5])]
+        response = np.concatenate([response, rng.uniform(0, duration, rng.randint(0, 3))])
+        responses.append(np.sort(response))
+    return responses
+
+
+def evaluate_pairs(responses, window):
+    """ the F-measures and deviations of every pair of responses, from onset_evaluation() pair by pair """
+    num_responses = len(responses)
+    fmeasures = np.ones((num_responses, num_responses))
+    deviations = np.full((num_responses, num_responses), np.nan)
+    for i in range(num_responses):
+        for j in range(num_responses):
+            if i == j:
+                if len(responses[i]) > 0:
+                    deviations[i, j] = 0.
+                continue
+            tp, _, _, _, errors = onset_evaluation(responses[min(i, j)], responses[max(i, j)], window)
+            num_markers = len(responses[i]) + len(responses[j])
+            if num_markers > 0:
+                fmeasures[i, j] = 2. * len(tp) / num_markers
+            if len(tp) > 0:
+                deviations[i, j] = np.mean(np.abs(errors))
+    return fmeasures, deviations
+
+
+class TestPairwiseAgreement(unittest.TestCase):
+
+    def assert_same_as_onset_evaluation(self, responses, window=WINDOW):
+        fmeasures, deviations = agreement.pairwise_agreement(responses, window)
+        expected_fmeasures, expected_deviations = evaluate_pairs(responses, window)
+        np.testing.assert_allclose(fmeasures, expected_fmeasures)
+        np.testing.assert_allclose(deviations, expected_deviations)
+
+    def test_random_trials(self):
+        rng = np.random.RandomState(0)
+        num_crowded = 0
+        for _ in range(3000):
+            responses = random_responses(rng)
+            num_crowded += any(agreement.crowded(response, WINDOW) for response in responses)
+            self.assert_same_as_onset_evaluation(responses)
+        # both the vectorized matching and the fallback to onset_evaluation() were tried
+        self.assertGreater(num_crowded, 100)
+        self.assertLess(num_crowded, 2900)
+
+    def test_match_to(self):
+        rng = np.random.RandomState(1)
+        for _ in range(1000):
+            responses = [response for response in random_responses(rng)
+                         if not agreement.crowded(response, WINDOW)]
+            for j in range(len(responses)):
+                num_matches, total_error = agreement.match_to(responses, j, WINDOW)
+                for i in range(len(responses)):
+                    tp, _, _, _, errors = onset_evaluation(responses[i], responses[j], WINDOW)
+                    self.assertEqual(num_matches[i], len(tp))
+                    self.assertAlmostEqual(total_error[i], np.sum(np.abs(errors)))
+
+    def test_crowded(self):
+        # both markers of the first response are closest to the first marker of the second, so only onset_evaluation()
+        # matches the second marker of each
+        responses = [np.array([1.0, 1.09]), np.array([1.08, 1.18])]
+        self.assertTrue(agreement.crowded(responses[0], WINDOW))
+        self.assertEqual(agreement.match_to(responses, 1, WINDOW)[0][0], 1)
+        fmeasures, _ = agreement.pairwise_agreement(responses)
+        self.assertEqual(fmeasures[0, 1], 1.)
+        self.assert_same_as_onset_evaluation(responses)
+
+    def test_empty(self):
+        fmeasures, deviations = agreement.pairwise_agreement([[], [], [1.]])
+        self.assertEqual(fmeasures[0, 1], 1.)
+        self.assertEqual(fmeasures[0, 2], 0.)
+        self.assertTrue(np.isnan(deviations[0, 1]))
+        self.assertTrue(np.isnan(deviations[0, 2]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,176 @@
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import urllib3
+
+from response_processing import download_samples
+
+CONTENT = bytes(range(256)) * 1000
+
+
+class SampleHandler(BaseHTTPRequestHandler):
+    """
+    Serves CONTENT at /<mode>/<name>, where mode is
+     - range: honors Range requests
+     - norange: ignores Range and always sends the whole file with a 200
+     - truncate: cuts off the first GET halfway through, then honors Range
+     - nohead: like range, but answers HEAD with the status in the name, e.g. /nohead/405
+     - missing: answers HEAD with a 404
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        parts = self.path.split('/')
+        if parts[1] in ('nohead', 'missing'):
+            self.send_response(int(parts[2]) if parts[1] == 'nohead' else 404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(CONTENT)))
+        self.end_headers()
+
+    def do_GET(self):
+        mode = self.path.split('/')[1]
+        self.server.requests.append((self.path, self.headers.get('Range')))
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range') or '')
+
+        if mode == 'truncate' and self.server.truncated < 1:
+            self.server.truncated += 1
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(CONTENT)))
+            self.end_headers()
+            self.wfile.write(CONTENT[:len(CONTENT) // 2])
+            self.close_connection = True
+            return
+
+        if match is not None and mode != 'norange':
+            start = int(match.group(1))
+            if start >= len(CONTENT):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{:d}'.format(len(CONTENT)))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {:d}-{:d}/{:d}'.format(start, len(CONTENT) - 1, len(CONTENT)))
+            body = CONTENT[start:]
+        else:
+            self.send_response(200)
+            body = CONTENT
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TestDownload(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), SampleHandler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        cls.base_url = 'http://127.0.0.1:{:d}'.format(cls.server.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.requests = []
+        self.server.truncated = 0
+        self.tmp_dir = tempfile.mkdtemp()
+        self.outfile = os.path.join(self.tmp_dir, 'sample.mp3')
+        self.http = urllib3.PoolManager(retries=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def download(self, mode, **kwargs):
+        return download_samples.download(self.http, '{:s}/{:s}/sample.mp3'.format(self.base_url, mode), self.outfile,
+                                         **kwargs)
+
+    def assertDownloaded(self):
+        with open(self.outfile, 'rb') as infile:
+            self.assertEqual(infile.read(), CONTENT)
+        self.assertFalse(os.path.exists(self.outfile + '.part'))
+
+    def write_part(self, data):
+        with open(self.outfile + '.part', 'wb') as outfile:
+            outfile.write(data)
+
+    def test_download(self):
+        self.assertEqual(self.download('range'), 'downloaded')
+        self.assertDownloaded()
+        self.assertEqual(self.download('range'), 'skipped')
+
+    def test_resume(self):
+        self.write_part(CONTENT[:1000])
+        self.assertEqual(self.download('range'), 'resumed')
+        self.assertDownloaded()
+        self.assertEqual(self.server.requests, [('/range/sample.mp3', 'bytes=1000-')])
+
+    def test_resume_complete_part(self):
+        self.write_part(CONTENT)
+        self.assertEqual(self.download('range'), 'resumed')
+        self.assertDownloaded()
+
+    def test_server_ignores_range(self):
+        # a part file with the wrong bytes in it is thrown away, not appended to
+        self.write_part(b'x' * 1000)
+        self.assertEqual(self.download('norange'), 'resumed')
+        self.assertDownloaded()
+
+    def test_truncated(self):
+        self.assertEqual(self.download('truncate', retries=2), 'resumed')
+        self.assertDownloaded()
+        self.assertEqual(self.server.requests[0][1], None)
+        # picks up from the last chunk written before the cut, not from the start
+        start = int(re.match(r'bytes=(\d+)-$', self.server.requests[-1][1]).group(1))
+        self.assertTrue(0 < start <= len(CONTENT) // 2)
+
+    def test_md5(self):
+        md5 = hashlib.md5(CONTENT).hexdigest()
+        self.assertEqual(self.download('range', expected_md5=md5), 'downloaded')
+        self.assertDownloaded()
+        os.remove(self.outfile)
+        with self.assertRaises(RuntimeError):
+            self.download('range', expected_md5='0' * 32)
+        self.assertFalse(os.path.exists(self.outfile))
+        self.assertFalse(os.path.exists(self.outfile + '.part'))
+
+    def test_md5_existing(self):
+        md5 = hashlib.md5(CONTENT).hexdigest()
+        # same size as the real file, so only the md5 can tell
+        with open(self.outfile, 'wb') as outfile:
+            outfile.write(b'x' * len(CONTENT))
+        self.assertEqual(self.download('range', expected_md5=md5, check_existing=False), 'replaced')
+        self.assertDownloaded()
+        self.server.requests = []
+        self.assertEqual(self.download('range', expected_md5=md5), 'skipped')
+        self.assertEqual(self.server.requests, [])
+
+    def test_no_head(self):
+        for status in (405, 501):
+            url = '{:s}/nohead/{:d}'.format(self.base_url, status)
+            self.assertIsNone(download_samples.remote_size(self.http, url))
+            # an existing file of unknown size is kept
+            with open(self.outfile, 'wb') as outfile:
+                outfile.write(b'x')
+            self.assertEqual(download_samples.download(self.http, url, self.outfile), 'skipped')
+        with self.assertRaises(RuntimeError):
+            download_samples.remote_size(self.http, '{:s}/missing/sample.mp3'.format(self.base_url))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from interface.interface import interface
+from response_processing import util
+
+SCHEMA = os.path.join(os.path.dirname(__file__), '..', '..', 'interface', 'interface', 'schema.sql')
+
+
+class TestLoadFinalResponsesFromDb(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.database = os.path.join(self.tmp_dir, 'responses.db')
+        self.db = sqlite3.connect(self.database)
+        with open(SCHEMA, 'r') as infile:
+            self.db.executescript(infile.read())
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def add_response(self, url, timestamps, with_markers=True):
+        data = {'final_response': [{'timestamp': t, 'size': 'small'} for t in timestamps], 'edit_history': []}
+        cur = self.db.execute('INSERT INTO responses (url, ip_addr, stamp, labeler_id, experiment_id, data) '
+                              'VALUES (?, ?, ?, ?, ?, ?)', [url, '127.0.0.1', 0, 'L', 'E', json.dumps(data)])
+        if with_markers:
+            self.db.executemany('INSERT INTO markers (response_id, timestamp, size) VALUES (?, ?, ?)',
+                                [(cur.lastrowid, t, 'small') for t in timestamps])
+        self.db.commit()
+
+    def test_load(self):
+        self.add_response('a', [2.0, 1.0])
+        self.add_response('a', [])
+        self.add_response('b', [0.5])
+        final_responses = util.load_final_responses_from_db(self.database)
+        self.assertEqual([list(r) for r in final_responses['a']], [[1.0, 2.0], []])
+        self.assertEqual([list(r) for r in final_responses['b']], [[0.5]])
+
+    def test_not_backfilled(self):
+        self.add_response('a', [1.0])
+        self.add_response('b', [0.5], with_markers=False)
+        with self.assertRaisesRegex(RuntimeError, 'backfill_markers'):
+            util.load_final_responses_from_db(self.database)
+
+    def test_no_markers_table(self):
+        self.add_response('a', [1.0])
+        self.db.execute('DROP TABLE markers')
+        self.db.commit()
+        with self.assertRaisesRegex(RuntimeError, 'upgradedb'):
+            util.load_final_responses_from_db(self.database)
+
+
+class TestReadDump(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'dump')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read(self, text):
+        with open(self.filename, 'w') as outfile:
+            outfile.write(text)
+        return list(util.read_dump(self.filename))
+
+    def test_formats(self):
+        responses = [{'id': 1, 'url': 'a'}, {'id': 2, 'url': 'b'}]
+        self.assertEqual(self.read(json.dumps({'dataset': responses}, indent=2)), responses)
+        self.assertEqual(self.read(''.join(json.dumps(r) + '\n' for r in responses)), responses)
+
+    def test_empty(self):
+        # what --format ndjson writes when --since or --experiment match nothing
+        self.assertEqual(self.read(''), [])
+        self.assertEqual(self.read('\n'), [])
+        self.assertEqual(self.read(json.dumps({'dataset': []})), [])
+
+
+class TestIncrementalDump(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.database = os.path.join(self.tmp_dir, 'responses.db')
+        self.outfile = os.path.join(self.tmp_dir, 'dump.json')
+        with sqlite3.connect(self.database) as db, open(SCHEMA, 'r') as infile:
+            db.executescript(infile.read())
+        db.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def add_response(self, url):
+        data = {'final_response': [{'timestamp': 1.0, 'size': 'small'}], 'edit_history': []}
+        with sqlite3.connect(self.database) as db:
+            db.execute('INSERT INTO responses (url, ip_addr, stamp, labeler_id, experiment_id, metadata, data) '
+                       'VALUES (?, ?, ?, ?, ?, ?, ?)', [url, '127.0.0.1', '2018-06-01 00:00:00', 'L', 'E', '{}', json.dumps(data)])
+        db.close()
+
+    def dump(self):
+        with interface.app.app_context():
+            interface.dump_db_incremental(self.outfile, self.database, quiet=True)
+
+    def test_no_new_responses(self):
+        self.add_response('a')
+        self.dump()
+        self.add_response('b')
+        self.dump()
+        self.dump()
+        self.assertEqual([trial['url'] for trial in util.load_trials(self.outfile)], ['a', 'b'])
+
+    def test_no_new_responses_first(self):
+        # nothing new since the first dump, so there's nothing to append to a delta
+        self.add_response('a')
+        self.dump()
+        self.dump()
+        self.assertFalse(os.path.exists(self.outfile + '.delta'))
+        self.assertEqual([trial['url'] for trial in util.load_trials(self.outfile)], ['a'])
+
+    def test_empty_delta(self):
+        # left by dumps from before the delta was only created for new responses
+        self.add_response('a')
+        self.dump()
+        open(self.outfile + '.delta', 'w').close()
+        self.assertEqual([trial['url'] for trial in util.load_trials(self.outfile)], ['a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
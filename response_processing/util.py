@@ -1,9 +1,86 @@
 import json
+import os
+import sqlite3
+from collections import OrderedDict
+from itertools import groupby
+
 import numpy as np
 
 
+def read_npz_dump(filename):
+    """
+    yields the responses in a dump written by "flask dumpdb --format npz". Those have no metadata or edit history,
+    so the responses only have the fields the npz file keeps.
+    """
+    with np.load(filename) as dump:
+        offsets = dump['marker_offsets']
+        timestamps = dump['marker_timestamps']
+        sizes = dump['marker_sizes']
+        for i, response_id in enumerate(dump['id']):
+            markers = [{'timestamp': float(timestamps[j]), 'size': str(sizes[j])}
+                       for j in range(offsets[i], offsets[i + 1])]
+            yield {
+                'id': int(response_id),
+                'url': str(dump['url'][i]),
+                'stamp': str(dump['stamp'][i]),
+                'labeler_id': str(dump['labeler_id'][i]),
+                'experiment_id': str(dump['experiment_id'][i]),
+                'data': {'duration_seconds': float(dump['duration_seconds'][i]), 'final_response': markers},
+            }
+
+
+def read_dump(filename):
+    """
+    yields the responses in one dump file written by "flask dumpdb", in any of its formats. This is the only reader
+    of dump files, the server uses it too.
+    """
+    with open(filename, 'rb') as infile:
+        is_npz = infile.read(4) == b'PK\x03\x04'
+    if is_npz:
+        yield from read_npz_dump(filename)
+        return
+
+    with open(filename, 'r') as infile:
+        first_line = infile.readline()
+        try:
+            first = json.loads(first_line)
+        except ValueError:
+            first = None
+
+        if isinstance(first, dict) and 'id' in first:
+            # ndjson, one response per line
+            yield first
+            for line in infile:
+                if line.strip():
+                    yield json.loads(line)
+        elif first_line.lstrip().startswith('{'):
+            infile.seek(0)
+            yield from json.load(infile)['dataset']
+        # anything else is an ndjson dump of no responses, an empty file
+
+
+def load_trials(json_filename):
+    """
+    Read a dump, merged with the delta written next to it by "flask dumpdb --incremental" if there is one
+    :param json_filename: the base dump file. Its delta is json_filename + '.delta'
+    :return: list of trials, one per responses.id
+    """
+    trials = list(read_dump(json_filename))
+
+    delta_filename = json_filename + '.delta'
+    if not os.path.isfile(delta_filename):
+        return trials
+
+    # an interrupted incremental dump can write the same trial twice, keep the newest copy
+    trials_by_id = OrderedDict()
+    for trial in trials + list(read_dump(delta_filename)):
+        trials_by_id[trial['id']] = trial
+
+    return list(trials_by_id.values())
+
+
 def load_by_labeler(json_filename):
-    trials = json.load(open(json_filename, "r"))['dataset']
+    trials = load_trials(json_filename)
 
     # group by labeler into a dict
     responses_by_labeler = {}
@@ -17,7 +94,7 @@ def load_by_labeler(json_filename):
 
 
 def load_by_experiment(json_filename):
-    trials = json.load(open(json_filename, "r"))['dataset']
+    trials = load_trials(json_filename)
 
     # group by experiment into a dict
     responses_by_experiment = {}
@@ -31,7 +108,7 @@ def load_by_experiment(json_filename):
 
 
 def load_by_url(json_filename):
-    trials = json.load(open(json_filename, "r"))['dataset']
+    trials = load_trials(json_filename)
 
     # group by experiment into a dict
     responses_by_url = {}
@@ -44,6 +121,59 @@ def load_by_url(json_filename):
     return responses_by_url
 
 
+def check_markers_backfilled(db, database):
+    """
+    Raises a RuntimeError if the database has no markers table, or responses with markers in their JSON but none in
+    the markers table. Those were recorded before the table existed, and would be read as responses without markers.
+    Only the JSON of responses without any marker rows is parsed, which are few once the markers are backfilled.
+    """
+    fix = "run `flask upgradedb --database {0:s}` and `flask backfill_markers --database {0:s}` first".format(database)
+    if db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'markers'").fetchone() is None:
+        raise RuntimeError("{:s} has no markers table, {:s}".format(database, fix))
+
+    responses_cur = db.execute('SELECT data FROM responses '
+                               'WHERE NOT EXISTS (SELECT 1 FROM markers WHERE markers.response_id = responses.id)')
+    num_missing = 0
+    for (data,) in responses_cur:
+        try:
+            final_response = json.loads(data).get('final_response')
+        except (TypeError, ValueError, AttributeError):
+            continue
+        if final_response:
+            num_missing += 1
+    if num_missing > 0:
+        raise RuntimeError("{:d} responses in {:s} have markers that aren't in the markers table, {:s}".format(
+            num_missing, database, fix))
+
+
+def load_final_responses_from_db(database):
+    """
+    Read the final responses straight from the markers table of a responses database, without parsing any JSON.
+    Needs a database that has been upgraded with `flask upgradedb` and `flask backfill_markers`.
+    :param database: sqlite3 database file of responses downloaded from the server
+    :return: the same thing as get_final_responses(load_by_url(...)), a dict from url to a list of numpy arrays of
+             marker times, one array per response
+    :raises RuntimeError: if the markers of some responses are only in their JSON, where this can't see them
+    """
+    db = sqlite3.connect(database)
+    try:
+        check_markers_backfilled(db, database)
+        markers_cur = db.execute('SELECT responses.url, responses.id, markers.timestamp FROM responses '
+                                 'LEFT JOIN markers ON markers.response_id = responses.id '
+                                 'ORDER BY responses.url, responses.id, markers.timestamp')
+
+        final_responses = {}
+        for url, rows_by_url in groupby(markers_cur, key=lambda row: row[0]):
+            final_responses[url] = []
+            for _, rows_by_response in groupby(rows_by_url, key=lambda row: row[1]):
+                # responses without markers come back as a single row with a NULL timestamp
+                timestamps = [row[2] for row in rows_by_response if row[2] is not None]
+                final_responses[url].append(np.array(timestamps, dtype=float))
+    finally:
+        db.close()
+    return final_responses
+
+
 def get_final_responses_list(experiments):
     """
     Convert the result of load() to numpy arrays of final times
@@ -58,6 +188,7 @@ def get_final_responses_list(experiments):
             final_responses[key].append(final_response)
     return final_responses
 
+
 def get_final_responses(experiments):
     """
     Convert the result of load() to numpy arrays of final times
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""
+Compares the speed of padding clips with noise the old way, with pydub, to the noise bank in sample_generator.py.
+Only the noise and fades are timed, not decoding or encoding.
+"""
+
+import argparse
+import sys
+import time
+
+import numpy as np
+from pydub import AudioSegment, generators
+
+from sample_generator import sample_generator as sg
+
+
+def pydub_noise(song, starts):
+    for start_time_ms in starts:
+        clip = song[start_time_ms:start_time_ms + sg.SAMPLE_LENGTH_MS]
+        noise_length_ms = sg.NOISE_LENGTH_MS
+        noise = generators.WhiteNoise().to_audio_segment(duration=noise_length_ms, volume=sg.NOISE_DBFS)
+        clip = noise.append(clip, crossfade=noise_length_ms / 2)
+        clip = clip.append(noise, crossfade=noise_length_ms / 2)
+        clip = clip.fade_in(duration=sg.FADE_LENGTH_MS)
+        clip = clip.fade_out(duration=sg.FADE_LENGTH_MS)
+        # pydub builds the clip lazily, this is what export would read
+        clip.raw_data
+
+
+def bank_noise(song, starts, band=None):
+    noise_bank = sg.get_noise_bank(0)
+    rng = np.random.RandomState(0)
+    noise_length = sg.ms_to_frames(sg.NOISE_LENGTH_MS)
+    sample_length = sg.ms_to_frames(sg.SAMPLE_LENGTH_MS)
+    for start_time_ms in starts:
+        start = sg.ms_to_frames(start_time_ms)
+        noise = [noise_bank.take(noise_length, rng, band) * sg.db_to_gain(sg.NOISE_DBFS) for _ in range(2)]
+        pieces = sg.clip_pieces(song, start, start + sample_length, noise=noise)
+        # the same samples pydub ends up with
+        sg.to_int16(np.concatenate(pieces))
+
+
+def main():
+    parser = argparse.ArgumentParser("bench_noise.py")
+    parser.add_argument('infile', help='song to cut clips from')
+    parser.add_argument('--clips', '-n', type=int, default=200, help='number of clips to make')
+    args = parser.parse_args()
+
+    song = sg.decode(args.infile)
+    song_segment = AudioSegment(data=sg.to_int16(song).tobytes(), sample_width=2, frame_rate=sg.SAMPLE_RATE,
+                                channels=sg.CHANNELS)
+    max_start_ms = len(song) * 1000 / sg.SAMPLE_RATE - sg.SAMPLE_LENGTH_MS
+    starts = np.random.RandomState(0).uniform(0, max_start_ms, args.clips)
+
+    # build the banks up front, their cost is paid once per worker
+    sg.get_noise_bank(0)._bank((200, 2000))
+
+    for name, run in [('pydub', lambda: pydub_noise(song_segment, starts)),
+                      ('noise bank', lambda: bank_noise(song, starts)),
+                      ('noise bank, band limited', lambda: bank_noise(song, starts, band=(200, 2000)))]:
+        t0 = time.time()
+        run()
+        elapsed_s = time.time() - t0
+        print("{:s}: {:d} clips in {:.2f}s ({:.1f} clips/s)".format(
+            name, args.clips, elapsed_s, args.clips / elapsed_s))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,233 @@
+"""
+Audio fingerprints for finding duplicate samples, after Haitsma & Kalker, "A Highly Robust Audio Fingerprinting
+System" (ISMIR 2002).
+
+Every frame of a clip gets a 32 bit hash: bit m is set when the energy difference between bands m and m + 1 grows
+from the previous frame. The hashes hardly change under re-encoding or a little noise, and frames overlap by 31/32 so
+two clips cut from the same audio at different offsets still line up. Two clips are duplicates when enough of their
+frames line up with few differing bits.
+"""
+
+import subprocess
+
+import numpy as np
+
+FFMPEG = 'ffmpeg'
+SAMPLE_RATE = 44100
+DOWNSAMPLE = 8  # fingerprints are computed at 5512.5Hz, everything above 2kHz is thrown away anyway
+FRAME_SIZE = 2048
+HOP_SIZE = 64
+NUM_BANDS = 33  # one hash bit for each pair of neighbouring bands
+MIN_FREQ = 300
+MAX_FREQ = 2000
+# only hashes divisible by this go in the lookup table. Both clips of a duplicate keep the same frames, since it
+# depends only on the hash, and the table is that many times smaller.
+INDEX_MODULUS = 4
+# hashes found in more frames than this, like the ones of silence, say nothing about which clip they come from
+MAX_BUCKET_SIZE = 1000
+MIN_VOTES = 2
+MAX_CANDIDATES = 5
+MAX_BIT_ERROR_RATE = 0.35
+MIN_OVERLAP = 0.5
+
+
+def decode_mono(filename):
+    """
+    :return: float32 array of the file's audio downmixed to mono at SAMPLE_RATE
+    """
+    command = [FFMPEG, '-v', 'error', '-i', filename, '-f', 'f32le', '-acodec', 'pcm_f32le', '-ac', '1',
+               '-ar', str(SAMPLE_RATE), '-']
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError("ffmpeg couldn't decode {:s}: {:s}".format(filename, result.stderr.decode().strip()))
+    return np.frombuffer(result.stdout, dtype=np.float32)
+
+
+def _band_matrix():
+    freqs = np.fft.rfftfreq(FRAME_SIZE, DOWNSAMPLE / SAMPLE_RATE)
+    edges = np.geomspace(MIN_FREQ, MAX_FREQ, NUM_BANDS + 1)
+    return ((freqs[:, np.newaxis] >= edges[np.newaxis, :-1]) &
+            (freqs[:, np.newaxis] < edges[np.newaxis, 1:])).astype(np.float32)
+
+
+_bands = _band_matrix()
+_window = np.hanning(FRAME_SIZE).astype(np.float32)
+_bit_values = np.left_shift(np.uint32(1), np.arange(NUM_BANDS - 1, dtype=np.uint32))
+
+
+def fingerprint(samples):
+    """
+    :param samples: mono audio at SAMPLE_RATE, or (frames, channels) which is downmixed
+    :return: uint32 array with one hash per frame. Empty if the audio is shorter than a frame.
+    """
+    samples = np.asarray(samples, dtype=np.float32)
+    if samples.ndim == 2:
+        samples = samples.mean(axis=1)
+
+    # averaging blocks of DOWNSAMPLE samples doubles as the low pass filter
+    num_blocks = len(samples) // DOWNSAMPLE
+    samples = samples[:num_blocks * DOWNSAMPLE].reshape(num_blocks, DOWNSAMPLE).mean(axis=1)
+
+    num_frames = (len(samples) - FRAME_SIZE) // HOP_SIZE + 1
+    if num_frames < 2:
+        return np.zeros(0, dtype=np.uint32)
+    stride = samples.strides[0]
+    frames = np.lib.stride_tricks.as_strided(samples, shape=(num_frames, FRAME_SIZE),
+                                             strides=(HOP_SIZE * stride, stride))
+
+    power = np.abs(np.fft.rfft(frames * _window, axis=1)) ** 2
+    energy = power.astype(np.float32).dot(_bands)
+    band_diff = energy[:, :-1] - energy[:, 1:]
+    bits = (band_diff[1:] - band_diff[:-1]) > 0
+    return bits.astype(np.uint32).dot(_bit_values).astype(np.uint32)
+
+
+def fingerprint_file(filename):
+    return fingerprint(decode_mono(filename))
+
+
+def to_blob(hashes):
+    return np.asarray(hashes, dtype='<u4').tobytes()
+
+
+def from_blob(blob):
+    return np.frombuffer(blob, dtype='<u4').astype(np.uint32)
+
+
+def bit_error_rate(a, b):
+    """ fraction of bits that differ between two equally long hash arrays """
+    differing = np.unpackbits(np.bitwise_xor(a, b).view(np.uint8)).sum()
+    return differing / (32 * len(a))
+
+
+def _cap_buckets(hashes, *columns):
+    """
+    Keeps the first MAX_BUCKET_SIZE entries of every hash in a table sorted by hash
+    :return: hashes and columns, without the rest
+    """
+    if len(hashes) == 0:
+        return (hashes,) + columns
+    starts = np.flatnonzero(np.concatenate([[True], hashes[1:] != hashes[:-1]]))
+    bucket_start = np.repeat(starts, np.diff(np.append(starts, len(hashes))))
+    keep = np.arange(len(hashes)) - bucket_start < MAX_BUCKET_SIZE
+    return tuple(column[keep] for column in (hashes,) + columns)
+
+
+def _sorted_run(hashes, clip_ids, frames):
+    # a stable sort, so the entries of each hash stay in the order they were added
+    order = np.argsort(hashes, kind='stable')
+    return _cap_buckets(hashes[order], clip_ids[order], frames[order])
+
+
+class FingerprintIndex(object):
+    """
+    Lookup table from frame hashes to the clips and frames they're in.
+
+    Finding the duplicates of a clip looks up each of its frames' hashes, so it takes the same time however many
+    clips are in the index. Every hit votes for the clip it's from at the offset between the two frames. The clips
+    with the most votes are compared over their overlap at that offset.
+
+    The table is columns of numpy arrays (hash, clip, frame) sorted by hash and searched with searchsorted, 12 bytes
+    per entry. Each clip added is a new sorted run, merged with the runs before it while they're less than twice
+    its size, so adding is amortized O(log M) per entry for M entries and a lookup searches O(log M) runs. Like a
+    bucket of a hash table, the entries of a hash are kept in the order they were added, up to MAX_BUCKET_SIZE.
+    """
+
+    def __init__(self, max_bit_error_rate=MAX_BIT_ERROR_RATE, min_overlap=MIN_OVERLAP):
+        """
+        :param max_bit_error_rate: fraction of differing bits up to which aligned frames are the same audio
+        :param min_overlap: fraction of the shorter clip that has to be the same audio for them to be duplicates
+        """
+        self.max_bit_error_rate = max_bit_error_rate
+        self.min_overlap = min_overlap
+        self._runs = []  # (hashes, clip ids, frames), sorted by hash, oldest first
+        self._keys = []  # clip id -> key
+        self._clip_ids = {}  # key -> clip id
+        self._hashes = []  # clip id -> hashes
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._clip_ids
+
+    @staticmethod
+    def _indexed_frames(hashes):
+        return np.flatnonzero((hashes % INDEX_MODULUS == 0) & (hashes != 0))
+
+    def add(self, key, hashes):
+        if key in self._clip_ids:
+            clip_id = self._clip_ids[key]
+            self._hashes[clip_id] = hashes
+        else:
+            clip_id = len(self._keys)
+            self._clip_ids[key] = clip_id
+            self._keys.append(key)
+            self._hashes.append(hashes)
+
+        frames = self._indexed_frames(hashes)
+        if len(frames) == 0:
+            return
+        self._runs.append(_sorted_run(np.asarray(hashes[frames], dtype=np.uint32),
+                                      np.full(len(frames), clip_id, dtype=np.int32), frames.astype(np.int32)))
+        while len(self._runs) > 1 and len(self._runs[-2][0]) < 2 * len(self._runs[-1][0]):
+            newer = self._runs.pop()
+            older = self._runs.pop()
+            self._runs.append(_sorted_run(*(np.concatenate([a, b]) for a, b in zip(older, newer))))
+
+    def find(self, hashes):
+        """
+        :return: (key, overlap, bit error rate) of the best matching clip, or None if there's no duplicate in the
+                 index. overlap is the fraction of the shorter clip that lines up.
+        """
+        frames = self._indexed_frames(hashes)
+        query = np.asarray(hashes[frames], dtype=np.uint32)
+        # entries of each query hash found so far. The oldest runs come first, so these are the first ones added.
+        num_found = np.zeros(len(frames), dtype=np.int64)
+        hit_clip_ids = []
+        hit_offsets = []
+        hit_order = []
+        for run_hashes, run_clip_ids, run_frames in self._runs:
+            lo = np.searchsorted(run_hashes, query, side='left')
+            hi = np.searchsorted(run_hashes, query, side='right')
+            counts = np.minimum(hi - lo, MAX_BUCKET_SIZE - num_found)
+            total = counts.sum()
+            if total > 0:
+                # the indices lo[i] to lo[i] + counts[i] of every query hash i, one after the other
+                within = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+                hits = np.repeat(lo, counts) + within
+                hit_clip_ids.append(run_clip_ids[hits])
+                hit_offsets.append(run_frames[hits].astype(np.int64) - np.repeat(frames, counts))
+                # query frame, then place in the hash's bucket
+                hit_order.append(np.repeat(np.arange(len(frames)) * MAX_BUCKET_SIZE + num_found, counts) + within)
+            num_found += counts
+        if len(hit_clip_ids) == 0:
+            return None
+
+        # count the votes for every (clip, offset) packed into one int64. Candidates with as many votes are taken in
+        # the order they were first hit.
+        pairs = (np.concatenate(hit_clip_ids).astype(np.int64) << 32) | (np.concatenate(hit_offsets) + 2 ** 31)
+        pairs, pair_of_hit, votes = np.unique(pairs, return_inverse=True, return_counts=True)
+        first_hit = np.full(len(pairs), np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(first_hit, pair_of_hit, np.concatenate(hit_order))
+        candidates = np.lexsort((first_hit, -votes))[:MAX_CANDIDATES]
+
+        best = None
+        for pair, num_votes in zip(pairs[candidates], votes[candidates]):
+            if num_votes < MIN_VOTES:
+                break
+            key = self._keys[int(pair) >> 32]
+            offset = (int(pair) & 0xffffffff) - 2 ** 31
+            other = self._hashes[self._clip_ids[key]]
+            # frame i of hashes lines up with frame i + offset of other
+            start = max(0, -offset)
+            stop = min(len(hashes), len(other) - offset)
+            if stop <= start:
+                continue
+            overlap = (stop - start) / min(len(hashes), len(other))
+            if overlap < self.min_overlap:
+                continue
+            error_rate = bit_error_rate(hashes[start:stop], other[start + offset:stop + offset])
+            if error_rate <= self.max_bit_error_rate and (best is None or error_rate < best[2]):
+                best = (key, overlap, error_rate)
+        return best
@@ -1,46 +1,620 @@
 #!/usr/bin/env python
 
 import argparse
+import bisect
+import csv
+import hashlib
+import json
+import multiprocessing
 import os
+import subprocess
 import sys
+import tempfile
+import time
 import uuid
+import wave
+from collections import OrderedDict
+from functools import partial
 
 import numpy as np
-from pydub import AudioSegment, generators
 
+from sample_generator import fingerprint
 
-def generate_samples_for_file(infile, args):
-    sample_length_ms = 8000  # milliseconds
-    fade_length_ms = 500
+FFMPEG = 'ffmpeg'
+SAMPLE_RATE = 44100
+CHANNELS = 2
+SAMPLE_LENGTH_MS = 8000
+FADE_LENGTH_MS = 500
+# the noise is crossfaded into the clip over half its length, which is also the fade length
+NOISE_LENGTH_MS = 2 * FADE_LENGTH_MS
+NOISE_DBFS = -45
+NOISE_BANK_LENGTH_MS = 20000
+SILENCE_DB = -120  # fades start and end here, like pydub's
+OUTPUT_FORMATS = ['mp3', 'flac', 'wav']
+SNAP_TARGETS = ['beats', 'downbeats', 'onsets']
+MANIFEST_FILENAME = 'manifest.csv'
+# the seed of the latest run, written before any clip is made so a run that crashes early is picked up with it
+SEED_FILENAME = 'seed.txt'
+# the options that change which clips are made and how they sound, which all runs into one output folder must share
+OPTIONS_FILENAME = 'options.json'
+CLIP_OPTIONS = ['sample_percentage', 'min_gap', 'snap', 'time_shift', 'noise', 'noise_band', 'background_noise',
+                'gain_jitter']
+CACHE_DIRNAME = '.cache'
+# duplicate_of is the id of the clip that a clip skipped with --dedup skip duplicates, empty for other clips
+MANIFEST_FIELDS = ['song', 'sample_idx', 'id', 'start_time', 'stop_time', 'seed', 'duplicate_of']
+DEDUP_MODES = ['report', 'skip']
 
-    song = AudioSegment.from_mp3(infile)
 
-    song_duration_ms = song.duration_seconds * 1000
-    num_samples = int((song_duration_ms / sample_length_ms) * args.sample_percentage)  # 0.25 is fairly arbitrary
-    for sample_idx in range(num_samples):
-        start_time_ms = np.random.uniform(0, (song.duration_seconds * 1000 - sample_length_ms))
-        end_time_ms = start_time_ms + sample_length_ms
-        clip = song[start_time_ms:end_time_ms]
+def ms_to_frames(ms):
+    return int(round(ms * SAMPLE_RATE / 1000))
 
-        # enveloping and fading. noise is possible but not used in this case
+
+def db_to_gain(db):
+    return 10 ** (np.asarray(db, dtype=np.float32) / 20)
+
+
+def decode(infile):
+    """
+    Decodes a whole song in one ffmpeg call
+    :return: read only (frames, channels) float32 array at SAMPLE_RATE
+    """
+    command = [FFMPEG, '-v', 'error', '-i', infile, '-f', 'f32le', '-acodec', 'pcm_f32le', '-ac', str(CHANNELS),
+               '-ar', str(SAMPLE_RATE), '-']
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError("ffmpeg couldn't decode {:s}: {:s}".format(infile, result.stderr.decode().strip()))
+    return np.frombuffer(result.stdout, dtype=np.float32).reshape(-1, CHANNELS)
+
+
+def fade_in_envelope(num_frames):
+    """ gains for fading in, linear in dB like pydub's fade_in. Shaped (frames, 1) to broadcast over channels. """
+    return db_to_gain(np.linspace(SILENCE_DB, 0, num_frames, endpoint=False))[:, np.newaxis]
+
+
+class NoiseBank(object):
+    """
+    Noise generated once and shared by every clip, which take windows of it from random offsets, instead of
+    generating new noise for each clip. Band limited versions are filtered from the white noise once per band.
+    """
+
+    def __init__(self, seed, length_ms=NOISE_BANK_LENGTH_MS):
+        rng = np.random.RandomState(seed)
+        self.white = rng.uniform(-1, 1, (ms_to_frames(length_ms), CHANNELS)).astype(np.float32)
+        self.white.setflags(write=False)
+        self._bands = {}
+
+    def _bank(self, band):
+        if band is None:
+            return self.white
+
+        if band not in self._bands:
+            low_hz, high_hz = band
+            spectrum = np.fft.rfft(self.white, axis=0)
+            freqs = np.fft.rfftfreq(len(self.white), 1 / SAMPLE_RATE)
+            spectrum[(freqs < low_hz) | (freqs > high_hz)] = 0
+            filtered = np.fft.irfft(spectrum, len(self.white), axis=0)
+            # as loud as the white noise, so the same dBFS sounds about as loud either way
+            filtered *= np.sqrt(np.mean(self.white ** 2) / np.mean(filtered ** 2))
+            filtered = filtered.astype(np.float32)
+            filtered.setflags(write=False)
+            self._bands[band] = filtered
+        return self._bands[band]
+
+    def take(self, num_frames, rng, band=None):
+        """
+        :param rng: RandomState to pick the offset with
+        :param band: (low, high) in Hz to limit the noise to, or None for white noise
+        :return: read only (frames, channels) view of the bank, at full scale
+        """
+        bank = self._bank(band)
+        offset = rng.randint(0, len(bank) - num_frames + 1)
+        return bank[offset:offset + num_frames]
+
+
+_noise_banks = {}
+
+
+def get_noise_bank(seed):
+    """ one bank per seed and process, so a worker builds it once for all its songs """
+    if seed not in _noise_banks:
+        _noise_banks[seed] = NoiseBank(seed)
+    return _noise_banks[seed]
+
+
+def clip_pieces(song, start, stop, noise=None):
+    """
+    Cuts song[start:stop] and fades it in and out. Only the faded ends are copied, the middle is a view of the song.
+    With noise, the noise is crossfaded onto each end first, as pydub's append(crossfade=) would.
+    :param noise: (head, tail) arrays of NOISE_LENGTH_MS of noise each, or None for no noise
+    :return: list of (frames, channels) arrays which make up the clip when concatenated
+    """
+    clip = song[start:stop]
+    fade = ms_to_frames(FADE_LENGTH_MS)
+    fade_in = fade_in_envelope(fade)
+    fade_out = fade_in[::-1]
+
+    if noise is None:
+        return [clip[:fade] * fade_in, clip[fade:-fade], clip[-fade:] * fade_out]
+
+    noise_head, noise_tail = noise
+    return [noise_head[:fade] * fade_in,
+            noise_head[fade:] * fade_out + clip[:fade] * fade_in,
+            clip[fade:-fade],
+            clip[-fade:] * fade_out + noise_tail[:fade] * fade_in,
+            noise_tail[fade:] * fade_out]
+
+
+def augment(pieces, rng, gain_jitter_db=None, background=None):
+    """
+    Augmentations applied to the whole clip, for making training data. Without any, the pieces are returned as is.
+    :param gain_jitter_db: the clip's gain is changed by up to this many dB either way
+    :param background: noise as long as the clip to mix into all of it
+    :return: the augmented pieces, and the gain change in dB
+    """
+    gain_db = 0
+    if gain_jitter_db:
+        gain_db = rng.uniform(-gain_jitter_db, gain_jitter_db)
+        gain = db_to_gain(gain_db)
+        pieces = [piece * gain for piece in pieces]
+
+    if background is not None:
+        clip = np.concatenate(pieces)
+        clip += background
+        pieces = [clip]
+
+    return pieces, gain_db
+
+
+def to_int16(samples):
+    return (np.clip(samples, -1, 1) * 32767).astype('<i2')
+
+
+def write_wav(outfile, pieces):
+    with wave.open(outfile, 'wb') as wav:
+        wav.setnchannels(CHANNELS)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        for piece in pieces:
+            wav.writeframes(to_int16(piece).tobytes())
+
+
+def encode_clips(clips, fmt):
+    """
+    Encodes all the clips of a song with a single ffmpeg process, instead of starting one per clip.
+    The clips are streamed back to back into ffmpeg's stdin and split into one output file each.
+    :param clips: list of (outfile, pieces, metadata)
+    :param fmt: 'mp3' or 'flac'
+    """
+    num_clips = len(clips)
+    filters = ['[0:a]asplit={:d}{:s}'.format(num_clips, ''.join('[s{:d}]'.format(i) for i in range(num_clips)))]
+    outputs = []
+    offset = 0
+    for i, (outfile, pieces, metadata) in enumerate(clips):
+        num_frames = sum(len(piece) for piece in pieces)
+        filters.append('[s{:d}]atrim=start_sample={:d}:end_sample={:d},asetpts=PTS-STARTPTS[o{:d}]'.format(
+            i, offset, offset + num_frames, i))
+        offset += num_frames
+
+        outputs += ['-map', '[o{:d}]'.format(i)]
+        for key, value in metadata.items():
+            outputs += ['-metadata', '{:s}={}'.format(key, value)]
+        if fmt == 'mp3':
+            outputs += ['-id3v2_version', '3']
+        else:
+            outputs += ['-sample_fmt', 's16']
+        outputs += ['-f', fmt, '-y', outfile]
+
+    command = [FFMPEG, '-v', 'error', '-f', 'f32le', '-ar', str(SAMPLE_RATE), '-ac', str(CHANNELS), '-i', '-',
+               '-filter_complex', ';'.join(filters)] + outputs
+
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=stderr)
+        try:
+            for _, pieces, _ in clips:
+                for piece in pieces:
+                    process.stdin.write(memoryview(np.ascontiguousarray(piece)).cast('B'))
+        except BrokenPipeError:
+            pass  # ffmpeg quit early, the error is in stderr
+        finally:
+            process.stdin.close()
+        if process.wait() != 0:
+            stderr.seek(0)
+            raise RuntimeError("ffmpeg couldn't encode: {:s}".format(stderr.read().decode().strip()))
+
+
+def song_seed(seed, infile):
+    """ each song gets its own random stream, so its plan doesn't depend on which worker gets it or when """
+    digest = hashlib.sha1('{:d}:{:s}'.format(seed, infile).encode('utf-8')).digest()
+    return int.from_bytes(digest[:4], 'little')
+
+
+def mono_signal(samples):
+    """ madmom processors only downmix audio they load from files themselves, so arrays are downmixed here """
+    # madmom is only needed for snapping and features, so it's imported when it's used
+    from madmom.audio.signal import Signal
+    return Signal(samples.mean(axis=1), sample_rate=SAMPLE_RATE)
+
+
+def detect_beats(song):
+    """
+    :return: (beats, 2) array of beat times in seconds and their position in the bar, 1 being the downbeat
+    """
+    from madmom.features.beats import RNNDownBeatProcessor, DBNDownBeatTrackingProcessor
+
+    activations = RNNDownBeatProcessor()(mono_signal(song))
+    return DBNDownBeatTrackingProcessor(beats_per_bar=[3, 4], fps=100)(activations)
+
+
+def detect_onsets(song):
+    """
+    :return: onset times in seconds
+    """
+    from madmom.features.onsets import RNNOnsetProcessor, OnsetPeakPickingProcessor
+
+    activations = RNNOnsetProcessor()(mono_signal(song))
+    return OnsetPeakPickingProcessor(fps=100)(activations)
+
+
+def snap_times(infile, song, target, cache_dir):
+    """
+    The times clips may be snapped to. Running the networks over a whole song is slow, so the detections are cached
+    in cache_dir per song, and redone only if the song is modified.
+    :param target: one of SNAP_TARGETS
+    :return: sorted times in seconds
+    """
+    analysis = 'onsets' if target == 'onsets' else 'beats'
+    key = hashlib.sha1(os.path.abspath(infile).encode('utf-8')).hexdigest()
+    cache_file = os.path.join(cache_dir, '{:s}.{:s}.npy'.format(key, analysis))
+    if os.path.exists(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(infile):
+        detections = np.load(cache_file)
+    else:
+        detections = detect_onsets(song) if analysis == 'onsets' else detect_beats(song)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = cache_file + '.tmp'
+        with open(tmp_file, 'wb') as outfile:
+            np.save(outfile, detections)
+        os.replace(tmp_file, cache_file)
+
+    if target == 'beats':
+        return detections[:, 0]
+    elif target == 'downbeats':
+        return detections[detections[:, 1] == 1, 0]
+    return detections
+
+
+def place_clips(num_frames, num_samples, rng, min_gap=None, snap_points=None):
+    """
+    Picks the start frames of a song's clips
+    :param min_gap: fewest frames between the end of a clip and the start of the next, or None to allow overlaps
+    :param snap_points: sorted frames clips are allowed to start at, or None to start anywhere
+    :return: list of start frames. There are fewer than num_samples if they don't fit with the given gap.
+    """
+    sample_length = ms_to_frames(SAMPLE_LENGTH_MS)
+    last_start = num_frames - sample_length
+    if num_samples <= 0 or last_start < 0:
+        return []
+
+    if snap_points is not None:
+        candidates = snap_points[(snap_points >= 0) & (snap_points <= last_start)]
+        rng.shuffle(candidates)
+        if min_gap is None:
+            return [int(start) for start in candidates[:num_samples]]
+
+        # take the candidates in random order, keeping the ones which leave enough room to their neighbours
+        stride = sample_length + min_gap
+        starts = []
+        for start in candidates:
+            i = bisect.bisect(starts, start)
+            if (i == 0 or start - starts[i - 1] >= stride) and (i == len(starts) or starts[i] - start >= stride):
+                starts.insert(i, int(start))
+                if len(starts) == num_samples:
+                    break
+        return starts
+
+    if min_gap is None:
+        return [int(rng.uniform(0, last_start)) for _ in range(num_samples)]
+
+    # lay the clips out back to back with min_gap between them, then spread what's left of the song randomly
+    # between the gaps. Every layout with at least min_gap between clips is equally likely.
+    stride = sample_length + min_gap
+    num_samples = min(num_samples, last_start // stride + 1)
+    slack = last_start - (num_samples - 1) * stride
+    offsets = np.sort(rng.randint(0, slack + 1, num_samples))
+    return [int(offset) + i * stride for i, offset in enumerate(offsets)]
+
+
+def plan_clips(infile, num_frames, seed, sample_percentage, min_gap=None, snap_points=None, max_shift=0):
+    """
+    Picks the clips to cut from a song. The same seed, song, length and placement options always give the same plan.
+    :param min_gap: see place_clips
+    :param snap_points: see place_clips
+    :param max_shift: each clip is moved by up to this many frames either way after it's placed. It can make clips
+                      closer than min_gap, and off the snap points.
+    :return: list of manifest rows, one per clip
+    """
+    rng = np.random.RandomState(song_seed(seed, infile))
+    sample_length = ms_to_frames(SAMPLE_LENGTH_MS)
+    num_samples = int((num_frames / sample_length) * sample_percentage)  # 0.25 is fairly arbitrary
+    starts = place_clips(num_frames, num_samples, rng, min_gap, snap_points)
+    if max_shift > 0:
+        shifts = rng.randint(-max_shift, max_shift + 1, len(starts))
+        starts = [int(np.clip(start + shift, 0, num_frames - sample_length)) for start, shift in zip(starts, shifts)]
+
+    plan = []
+    for sample_idx, start in enumerate(starts):
+        stop = start + sample_length
+        clip_id = uuid.uuid5(uuid.NAMESPACE_URL, '{:s}#{:d}/{:d}'.format(infile, seed, sample_idx))
+        plan.append({
+            'song': infile,
+            'sample_idx': sample_idx,
+            'id': str(clip_id),
+            'start_time': start * 1000 / SAMPLE_RATE,
+            'stop_time': stop * 1000 / SAMPLE_RATE,
+            'seed': seed,
+            'duplicate_of': '',
+        })
+    return plan
+
+
+def clip_filename(clip, fmt):
+    infile_short = os.path.basename(clip['song'])[:8]
+    filename = infile_short + '_' + str(clip['sample_idx']) + '_' + clip['id'] + '.' + fmt
+    return filename.replace(" ", "_")
+
+
+def read_manifest(manifest_filename):
+    """
+    Rows are only ever appended to the manifest, so a clip's latest row replaces its earlier ones.
+    :return: dict from song to the list of its clips, or an empty dict if there's no manifest yet
+    """
+    clips = OrderedDict()
+    if not os.path.exists(manifest_filename):
+        return {}
+
+    with open(manifest_filename, 'r', newline='') as infile:
+        for row in csv.DictReader(infile):
+            if None in row.values():
+                continue  # cut short by a crash
+            row['sample_idx'] = int(row['sample_idx'])
+            row['seed'] = int(row['seed'])
+            row['start_time'] = float(row['start_time'])
+            row['stop_time'] = float(row['stop_time'])
+            clips[row['id']] = row
+
+    plans = {}
+    for clip in clips.values():
+        plans.setdefault(clip['song'], []).append(clip)
+    return plans
+
+
+def append_to_manifest(manifest_filename, plan):
+    write_header = not os.path.exists(manifest_filename)
+    with open(manifest_filename, 'a', newline='') as outfile:
+        writer = csv.DictWriter(outfile, MANIFEST_FIELDS)
+        if write_header:
+            writer.writeheader()
+        writer.writerows(plan)
+
+
+def read_seed(seed_filename):
+    """ :return: the seed saved by write_seed(), or None if there isn't one """
+    if not os.path.exists(seed_filename):
+        return None
+    with open(seed_filename, 'r') as infile:
+        return int(infile.read().strip())
+
+
+def write_seed(seed_filename, seed):
+    tmp_filename = seed_filename + '.tmp'
+    with open(tmp_filename, 'w') as outfile:
+        outfile.write('{:d}\n'.format(seed))
+    os.replace(tmp_filename, seed_filename)
+
+
+def clip_options(args):
+    """ :return: the CLIP_OPTIONS of args, as they read back from the options file """
+    return json.loads(json.dumps({name: getattr(args, name) for name in CLIP_OPTIONS}))
+
+
+def read_options(options_filename):
+    """ :return: the options saved by write_options(), or None if there aren't any """
+    if not os.path.exists(options_filename):
+        return None
+    with open(options_filename, 'r') as infile:
+        return json.load(infile)
+
+
+def write_options(options_filename, options):
+    tmp_filename = options_filename + '.tmp'
+    with open(tmp_filename, 'w') as outfile:
+        json.dump(options, outfile, indent=2, sort_keys=True)
+    os.replace(tmp_filename, options_filename)
+
+
+def fingerprints_filename(cache_dir, infile):
+    key = hashlib.sha1(os.path.abspath(infile).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, '{:s}.fingerprints.npz'.format(key))
+
+
+def load_fingerprint_index(cache_dir):
+    """ an index of the fingerprints of every clip made in earlier runs """
+    index = fingerprint.FingerprintIndex()
+    if not os.path.isdir(cache_dir):
+        return index
+
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith('.fingerprints.npz'):
+            with np.load(entry.path) as fingerprints:
+                for clip_id in fingerprints.files:
+                    index.add(clip_id, fingerprints[clip_id])
+    return index
+
+
+def save_fingerprints(cache_dir, infile, fingerprints):
+    """ adds to the fingerprints saved for the clips of a song """
+    filename = fingerprints_filename(cache_dir, infile)
+    if os.path.exists(filename):
+        with np.load(filename) as saved:
+            fingerprints = dict({clip_id: saved[clip_id] for clip_id in saved.files}, **fingerprints)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = filename + '.tmp'
+    with open(tmp_file, 'wb') as outfile:
+        np.savez(outfile, **fingerprints)
+    os.replace(tmp_file, filename)
+
+
+def check_duplicates(index, plan, fingerprints, args):
+    """
+    Looks the clips that were just written up in the index of earlier clips, and adds the ones that aren't
+    duplicates. With --dedup skip, duplicates are deleted and marked in the plan, so later runs don't make them again.
+    :param fingerprints: dict from clip id to the hashes of the clips that were written
+    :return: the clips of the plan that were marked as duplicates
+    """
+    duplicates = []
+    kept = {}
+    for clip in plan:
+        hashes = fingerprints.get(clip['id'])
+        if hashes is None:
+            continue
+
+        match = index.find(hashes)
+        if match is None or args.dedup == 'report':
+            index.add(clip['id'], hashes)
+            kept[clip['id']] = hashes
+        if match is None:
+            continue
+
+        other_id, overlap, error_rate = match
+        print("duplicate: {:s} matches clip {:s} ({:.0%} overlap, {:.1%} of bits differ)".format(
+            clip_filename(clip, args.format), other_id, overlap, error_rate))
+        if args.dedup == 'skip':
+            clip_file = os.path.join(args.outdir, clip_filename(clip, args.format))
+            # and the features saved next to it with --features, which are named after its content. A clip with
+            # exactly the same audio can be the same file (wavs have no tags), sharing them, so those are kept.
+            sidecar = features_filename(clip_file)
+            if os.path.exists(sidecar) and not (overlap == 1 and error_rate == 0):
+                os.remove(sidecar)
+            os.remove(clip_file)
+            clip['duplicate_of'] = other_id
+            duplicates.append(clip)
+
+    save_fingerprints(os.path.join(args.outdir, CACHE_DIRNAME), plan[0]['song'], kept)
+    return duplicates
+
+
+def file_sha1(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(1 << 16), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def features_filename(clip_file):
+    return os.path.join(os.path.dirname(clip_file), file_sha1(clip_file) + '.npy')
+
+
+def write_features(clip_file, pieces):
+    """
+    Saves the network input features of a clip next to it as <sha1 of the clip file>.npy, so building a dataset
+    doesn't have to decode the clip again. They're computed from the audio before it's encoded, so for mp3s they
+    differ slightly from the features of the decoded file (by the encoder delay and the lossy encoding).
+    """
+    from madmom.features.tf_beats import TfRhythmicGroupingPreProcessor
+
+    sidecar = features_filename(clip_file)
+    if os.path.exists(sidecar):
+        return
+
+    features = TfRhythmicGroupingPreProcessor()(mono_signal(np.concatenate(pieces)))
+    tmp_file = sidecar + '.tmp'
+    with open(tmp_file, 'wb') as outfile:
+        np.save(outfile, features.astype(np.float32))
+    os.replace(tmp_file, sidecar)
+
+
+def generate_samples_for_file(infile, args, plan=None):
+    """
+    Cuts the clips of a song which aren't in outdir yet
+    :param plan: the song's clips from the manifest, or None to plan them
+    :return: the plan, the number of clips written, the song's duration in seconds, and a dict from clip id to
+             fingerprint for the clips written if args.dedup is set
+    """
+    song = decode(infile)
+    song_duration_s = len(song) / SAMPLE_RATE
+    if plan is None:
+        min_gap = None if args.min_gap is None else ms_to_frames(args.min_gap * 1000)
+        snap_points = None
+        if args.snap is not None:
+            times = snap_times(infile, song, args.snap, os.path.join(args.outdir, CACHE_DIRNAME))
+            # start early by the fade, so the beat lands just as the clip is fully faded in
+            snap_points = np.round(times * SAMPLE_RATE).astype(int) - ms_to_frames(FADE_LENGTH_MS)
+        max_shift = ms_to_frames(args.time_shift)
+        plan = plan_clips(infile, len(song), args.seed, args.sample_percentage, min_gap, snap_points, max_shift)
+
+    band = None if args.noise_band is None else tuple(args.noise_band)
+    if args.noise or args.background_noise is not None:
+        noise_bank = get_noise_bank(args.seed)
+
+    clips = []
+    fingerprints = {}
+    for clip in plan:
+        outfile = os.path.join(args.outdir, clip_filename(clip, args.format))
+        if clip['duplicate_of'] or os.path.exists(outfile):
+            continue
+
+        start = ms_to_frames(clip['start_time'])
+        stop = ms_to_frames(clip['stop_time'])
+        # the augmentations are seeded by the clip, so redoing a clip gives the same file
+        rng = np.random.RandomState(int(clip['id'][:8], 16))
+        noise = None
         if args.noise:
-            noise_length_ms = 1000
-            quiet = -45
-            noise = generators.WhiteNoise().to_audio_segment(duration=noise_length_ms, volume=quiet)
-            clip = noise.append(clip, crossfade=noise_length_ms / 2)
-            clip = clip.append(noise, crossfade=noise_length_ms / 2)
-
-        clip = clip.fade_in(duration=fade_length_ms)
-        clip = clip.fade_out(duration=fade_length_ms)
-
-        # export file
-        infile_short = os.path.basename(infile)[:8]
-        uid = str(uuid.uuid4())
-        outfile = os.path.join(args.outdir, infile_short + '_' + str(sample_idx) + '_' + uid + '.mp3')
-        outfile = outfile.replace(" ", "_")
+            noise_length = ms_to_frames(NOISE_LENGTH_MS)
+            noise = [noise_bank.take(noise_length, rng, band) * db_to_gain(NOISE_DBFS) for _ in range(2)]
+        pieces = clip_pieces(song, start, stop, noise=noise)
+
+        background = None
+        if args.background_noise is not None:
+            clip_length = sum(len(piece) for piece in pieces)
+            background = noise_bank.take(clip_length, rng, band) * db_to_gain(args.background_noise)
+        pieces, gain_db = augment(pieces, rng, args.gain_jitter, background)
+
         print('exporting:', outfile)
-        metadata = {'start_time': start_time_ms, 'stop_time': end_time_ms, 'song': infile}
-        clip.export(outfile, tags=metadata)
+        metadata = {'start_time': clip['start_time'], 'stop_time': clip['stop_time'], 'song': infile}
+        if gain_db != 0:
+            metadata['gain_db'] = gain_db
+        if args.dedup is not None:
+            fingerprints[clip['id']] = fingerprint.fingerprint(np.concatenate(pieces))
+        # written under a temporary name, so an interrupted run never leaves a partial file that looks finished
+        clips.append((outfile + '.part', pieces, metadata))
+
+    if args.format == 'wav':
+        # wav has nowhere to put the metadata
+        for part_file, pieces, _ in clips:
+            write_wav(part_file, pieces)
+    elif len(clips) > 0:
+        encode_clips(clips, args.format)
+
+    for part_file, _, _ in clips:
+        os.replace(part_file, part_file[:-len('.part')])
+
+    if args.features:
+        for part_file, pieces, _ in clips:
+            write_features(part_file[:-len('.part')], pieces)
+
+    return plan, len(clips), song_duration_s, fingerprints
+
+
+def process_file(job, args):
+    """ runs in a worker. Errors are returned rather than raised so one bad song doesn't stop the others. """
+    infile, plan = job
+    t0 = time.time()
+    try:
+        new_plan, num_written, song_duration_s, fingerprints = generate_samples_for_file(infile, args, plan)
+    except Exception as e:
+        return infile, None, False, None, None, None, time.time() - t0, e
+    return infile, new_plan, plan is None, num_written, song_duration_s, fingerprints, time.time() - t0, None
 
 
 def main():
@@ -50,16 +624,129 @@ def main():
     parser.add_argument('outdir', help='output directory')
     parser.add_argument('--workers', '-w', default=1, type=int, help="number of workers to use")
     parser.add_argument('--sample-percentage', '-n', type=float, default=0.25, help="percentage of samples")
-    parser.add_argument('--noise', action='store_true', help='add noise')
-    parser.add_argument('--seed', type=int, help='seed the random number generation')
+    parser.add_argument('--noise', action='store_true', help='pad both ends of the clips with noise')
+    parser.add_argument('--noise-band', type=float, nargs=2, metavar=('LOW_HZ', 'HIGH_HZ'),
+                        help='limit the noise to this band, instead of white noise')
+    parser.add_argument('--background-noise', type=float, metavar='DBFS',
+                        help='mix noise this loud under the whole clip')
+    parser.add_argument('--gain-jitter', type=float, metavar='DB',
+                        help='change the gain of each clip by a random amount up to this many dB')
+    parser.add_argument('--time-shift', type=float, default=0, metavar='MS',
+                        help='move each clip by a random amount up to this many milliseconds after placing it')
+    parser.add_argument('--seed', type=int,
+                        help='seed the random number generation. Defaults to the seed of the last run in outdir, '
+                             'if there is one, and otherwise a random seed')
+    parser.add_argument('--min-gap', type=float,
+                        help='seconds between the end of one clip and the start of the next from the same song. '
+                             'Clips may overlap if not given.')
+    parser.add_argument('--snap', choices=SNAP_TARGETS,
+                        help="start clips on a beat, downbeat or onset found by madmom's networks")
+    parser.add_argument('--features', action='store_true',
+                        help="also save each clip's TfRhythmicGroupingPreProcessor features, as <sha1 of clip>.npy")
+    parser.add_argument('--dedup', choices=DEDUP_MODES,
+                        help='fingerprint the clips, and report or delete ones with the same audio as an earlier clip')
+    parser.add_argument('--format', '-f', choices=OUTPUT_FORMATS, default='mp3',
+                        help='format of the clips. wav and flac skip the lossy re-encode, but the interface only '
+                             'serves mp3s')
     args = parser.parse_args()
 
     if not os.path.isdir(args.outdir):
         print("[{:s}] is not a directory.".format(args.outdir))
         return
 
-    for f in args.infiles:
-        generate_samples_for_file(f, args)
+    # songs already in the manifest keep their plan, and are skipped if all of their clips exist
+    manifest_filename = os.path.join(args.outdir, MANIFEST_FILENAME)
+    plans = read_manifest(manifest_filename)
+
+    # clip ids and file names only depend on the seed and the plan, so a clip made with other options would be
+    # taken for one made with these
+    options_filename = os.path.join(args.outdir, OPTIONS_FILENAME)
+    options = clip_options(args)
+    saved_options = read_options(options_filename)
+    if saved_options is not None and saved_options != options:
+        changed = sorted(name for name in set(options) | set(saved_options)
+                         if options.get(name) != saved_options.get(name))
+        print("[{:s}] was made with other options ({:s}). Use a new output folder, or the same options as in "
+              "[{:s}].".format(args.outdir, ', '.join(changed), options_filename))
+        return 1
+    if saved_options is None:
+        write_options(options_filename, options)
+
+    seed_filename = os.path.join(args.outdir, SEED_FILENAME)
+    if args.seed is None:
+        # carry on with the seed of the last run, so a song it didn't get to record gets the same clips. Output
+        # folders from before the seed file only have it in the manifest.
+        args.seed = read_seed(seed_filename)
+    if args.seed is None:
+        seeds = [plan[-1]['seed'] for plan in plans.values()]
+        args.seed = seeds[-1] if len(seeds) > 0 else int(np.random.randint(2 ** 31))
+    if read_seed(seed_filename) != args.seed:
+        write_seed(seed_filename, args.seed)
+    print("seed: {:d}".format(args.seed))
+    jobs = []
+    for infile in args.infiles:
+        plan = plans.get(infile)
+        if plan is not None and all(clip['duplicate_of'] or
+                                    os.path.exists(os.path.join(args.outdir, clip_filename(clip, args.format)))
+                                    for clip in plan):
+            continue
+        jobs.append((infile, plan))
+    if len(jobs) < len(args.infiles):
+        print("skipping {:d} songs which are already done".format(len(args.infiles) - len(jobs)))
+
+    # duplicates are looked up here rather than in the workers, so clips from songs in different workers are
+    # compared too
+    index = None
+    if args.dedup is not None:
+        index = load_fingerprint_index(os.path.join(args.outdir, CACHE_DIRNAME))
+
+    work = partial(process_file, args=args)
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers)
+        results = pool.imap_unordered(work, jobs)
+    else:
+        pool = None
+        results = map(work, jobs)
+
+    t0 = time.time()
+    total_samples = 0
+    total_duration_s = 0
+    failures = []
+    num_duplicates = 0
+    for infile, plan, is_new_plan, num_samples, song_duration_s, fingerprints, elapsed_s, error in results:
+        if error is not None:
+            print("failed: {:s} ({})".format(infile, error))
+            failures.append(infile)
+            continue
+
+        duplicates = []
+        if index is not None and len(fingerprints) > 0:
+            duplicates = check_duplicates(index, plan, fingerprints, args)
+            num_duplicates += len(duplicates)
+        if is_new_plan:
+            append_to_manifest(manifest_filename, plan)
+        else:
+            append_to_manifest(manifest_filename, duplicates)
+        total_samples += num_samples
+        total_duration_s += song_duration_s
+        print("{:s}: {:d} clips in {:.1f}s ({:.1f} clips/s, {:.1f}x realtime)".format(
+            infile, num_samples, elapsed_s, num_samples / elapsed_s, song_duration_s / elapsed_s))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    elapsed_s = time.time() - t0
+    print("{:d} songs, {:d} clips in {:.1f}s with {:d} workers ({:.1f} clips/s, {:.1f}x realtime)".format(
+        len(jobs) - len(failures), total_samples, elapsed_s, args.workers, total_samples / elapsed_s,
+        total_duration_s / elapsed_s))
+    if args.dedup == 'skip':
+        print("skipped {:d} duplicate clips".format(num_duplicates))
+    if len(failures) > 0:
+        print("{:d} songs failed:".format(len(failures)))
+        for infile in failures:
+            print("  " + infile)
+        return 1
 
 
 if __name__ == '__main__':